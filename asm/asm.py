@@ -14,46 +14,41 @@
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
 
+import io
+import json
+import os
 import sys
 import re
 
-# Opcodes
-OPCODES = {
-    "ADD":  {"type": 2, "code": "10100000"},
-    "AND":  {"type": 2, "code": "10101000"},
-    "CALL": {"type": 1, "code": "01010000"},
-    "CMP":  {"type": 2, "code": "10100111"},
-    "DEC":  {"type": 1, "code": "01100110"},
-    "DIV":  {"type": 2, "code": "10100011"},
-    "HLT":  {"type": 0, "code": "00000001"},
-    "INC":  {"type": 1, "code": "01100101"},
-    "INT":  {"type": 1, "code": "01010010"},
-    "IRET": {"type": 0, "code": "00010011"},
-    "JEQ":  {"type": 1, "code": "01010101"},
-    "JGE":  {"type": 1, "code": "01011010"},
-    "JGT":  {"type": 1, "code": "01010111"},
-    "JLE":  {"type": 1, "code": "01011001"},
-    "JLT":  {"type": 1, "code": "01011000"},
-    "JMP":  {"type": 1, "code": "01010100"},
-    "JNE":  {"type": 1, "code": "01010110"},
-    "LD":   {"type": 2, "code": "10000011"},
-    "LDI":  {"type": 8, "code": "10000010"},
-    "MOD":  {"type": 2, "code": "10100100"},
-    "MUL":  {"type": 2, "code": "10100010"},
-    "NOP":  {"type": 0, "code": "00000000"},
-    "NOT":  {"type": 1, "code": "01101001"},
-    "OR":   {"type": 2, "code": "10101010"},
-    "POP":  {"type": 1, "code": "01000110"},
-    "PRA":  {"type": 1, "code": "01001000"},
-    "PRN":  {"type": 1, "code": "01000111"},
-    "PUSH": {"type": 1, "code": "01000101"},
-    "RET":  {"type": 0, "code": "00010001"},
-    "SHL":  {"type": 2, "code": "10101100"},
-    "SHR":  {"type": 2, "code": "10101101"},
-    "ST":   {"type": 2, "code": "10000100"},
-    "SUB":  {"type": 2, "code": "10100001"},
-    "XOR":  {"type": 2, "code": "10101011"},
-}
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ls8'))
+
+import isa
+from isa import REG_USE, COND_JUMPS
+
+# Opcodes, generated from the instruction set description in ls8/isa.py
+OPCODES = isa.asm_opcodes()
+
+# Opcodes after which nothing is known about the registers
+BLOCK_END = {"CALL", "HLT", "INT", "IRET", "JMP", "RET"}
+
+# Registers the CPU reads between instructions (IM, IS) or implicitly (SP),
+# so a write to them is never dead
+LIVE_REGS = {5, 6, 7}
+
+# How deep .include and macro expansion may nest
+MAX_NESTING = 16
+
+# Most macro expansions in one unit; nesting alone doesn't stop a few
+# levels that each invoke the next many times
+MAX_EXPANSIONS = 10000
+
+# Object file format written by `asm.py -c` and read by link.py
+OBJECT_FORMAT = "ls8obj"
+OBJECT_VERSION = 1
+
+# Regex for macro parameter references: \name, or \@ for a number unique
+# to each expansion
+REGEX_MACRO_ARG = r"\\(\w+|@)"
 
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
@@ -64,11 +59,28 @@ REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
 REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
 
 
+def enable_extensions():
+    """Accept the block instructions in isa.EXTENSIONS from now on."""
+
+    OPCODES.update(isa.asm_opcodes(extensions=True))
+
+
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [-c] [-x] [-P] [inputfile] [outputfile] [linefile]
     """
 
+    linefile = None
+
+    # -O turns on the peephole optimizer, -c writes an object file, -x
+    # allows the extension instructions, -P partially evaluates the image
+    optimize_code = "-O" in argv[1:]
+    object_file = "-c" in argv[1:]
+    preevaluate_image = "-P" in argv[1:]
+    if "-x" in argv[1:]:
+        enable_extensions()
+    argv = [arg for arg in argv if arg not in ("-O", "-c", "-x", "-P")]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -81,11 +93,21 @@ def parse_commandline(argv):
         inputfile = argv[1]
         outputfile = argv[2]
 
+    elif len(argv) == 4:
+        inputfile = argv[1]
+        outputfile = argv[2]
+        linefile = argv[3]
+
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [-c] [-x] [-P] [infile.asm] [outfile.ls8|outfile.o] "
+              "[outfile.lines]", file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    if preevaluate_image and (object_file or linefile is not None):
+        print("asm.py: -P can't be used with -c or a line table", file=sys.stderr)
+        sys.exit(1)
+
+    return inputfile, outputfile, linefile, optimize_code, object_file, preevaluate_image
 
 
 def open_files(inputfile, outputfile):
@@ -127,7 +149,152 @@ def p8(v):
     return "{:08b}".format(v)
 
 
-def pass1(inputfile, sym, code):
+def new_unit():
+    """
+    State gathered by `preprocess`: the expanded source lines, where each
+    came from as (file, line number), macro definitions, exported and
+    imported symbols, and every file read.
+    """
+
+    return {
+        "lines": [],
+        "origins": [],
+        "macros": {},
+        "exports": [],
+        "imports": [],
+        "deps": [],
+        "expansions": 0,
+    }
+
+
+def preprocess(inputfile, filename, unit, depth=0, allow_include=True):
+    """
+    Pass 0
+
+    * Read `.include "file"`, relative to the including file, unless
+      `allow_include` is false (source from an untrusted client)
+    * Record `.macro NAME param, ...` ... `.endm` definitions
+    * Expand macro invocations, substituting `\\param` and `\\@`
+    * Record `.export NAME` and `.import NAME`
+    * Append everything else to unit["lines"]
+    """
+
+    if depth > MAX_NESTING:
+        print(f"{filename}: .include or macros nested too deeply", file=sys.stderr)
+        sys.exit(2)
+
+    if filename != "-":
+        unit["deps"].append(filename)
+
+    # Name, parameters and body of the macro being defined
+    macro = None
+
+    for line_num, line in enumerate(inputfile, 1):
+        line = line.rstrip("\r\n")
+
+        comment_index = line.find(';')
+        text = (line if comment_index == -1 else line[:comment_index]).strip()
+        words = text.replace(',', ' ').split()
+        directive = words[0].lower() if words else ''
+
+        if macro is not None:
+            if directive == '.endm':
+                unit["macros"][macro[0]] = (macro[1], macro[2])
+                macro = None
+            else:
+                macro[2].append(line)
+            continue
+
+        if directive == '.include':
+            if not allow_include:
+                print(f"{filename}:{line_num}: .include is not allowed", file=sys.stderr)
+                sys.exit(2)
+            name = text[len('.include'):].strip().strip('"')
+            path = os.path.join(os.path.dirname(filename), name)
+            try:
+                with open(path) as f:
+                    preprocess(f, path, unit, depth + 1, allow_include)
+            except OSError:
+                print(f"{filename}:{line_num}: can't include {name}", file=sys.stderr)
+                sys.exit(2)
+
+        elif directive == '.macro':
+            if len(words) < 2:
+                print(f"{filename}:{line_num}: missing macro name", file=sys.stderr)
+                sys.exit(2)
+            macro = (words[1].upper(), [w.upper() for w in words[2:]], [])
+
+        elif directive == '.endm':
+            print(f"{filename}:{line_num}: .endm outside a macro", file=sys.stderr)
+            sys.exit(2)
+
+        elif directive in ('.export', '.import'):
+            unit[directive[1:] + "s"].extend(w.upper() for w in words[1:])
+
+        else:
+            m = re.match(r"(?:(\w+?):)?\s*(\w+)?", text)
+            label, name = normalize_line(m.groups())
+
+            if name in unit["macros"]:
+                if label is not None:
+                    unit["lines"].append(f"{label}:")
+                    unit["origins"].append((filename, line_num))
+                expand_macro(name, text[m.end():], filename, line_num, unit, depth,
+                             allow_include)
+            else:
+                unit["lines"].append(line)
+                unit["origins"].append((filename, line_num))
+
+    if macro is not None:
+        print(f"{filename}: macro {macro[0]} has no .endm", file=sys.stderr)
+        sys.exit(2)
+
+
+def expand_macro(name, args, filename, line_num, unit, depth, allow_include=True):
+    """Expand one macro invocation. Its lines all count as the invoking line."""
+
+    params, body = unit["macros"][name]
+    args = [a.strip() for a in args.split(',')] if args.strip() else []
+
+    if len(args) != len(params):
+        print(f"{filename}:{line_num}: {name} takes {len(params)} arguments",
+              file=sys.stderr)
+        sys.exit(2)
+
+    values = dict(zip(params, args))
+    unit["expansions"] += 1
+    if unit["expansions"] > MAX_EXPANSIONS:
+        print(f"{filename}:{line_num}: more than {MAX_EXPANSIONS} macro expansions",
+              file=sys.stderr)
+        sys.exit(2)
+    values['@'] = str(unit["expansions"])
+
+    def substitute(m):
+        key = m.group(1) if m.group(1) == '@' else m.group(1).upper()
+        if key not in values:
+            print(f"{filename}:{line_num}: unknown macro parameter {m.group(0)}",
+                  file=sys.stderr)
+            sys.exit(2)
+        return values[key]
+
+    expanded = [re.sub(REGEX_MACRO_ARG, substitute, line) for line in body]
+
+    # Expand nested invocations and includes, then credit the invoking line
+    inner = new_unit()
+    inner["macros"] = unit["macros"]
+    inner["expansions"] = unit["expansions"]
+    preprocess(expanded, filename, inner, depth + 1, allow_include)
+    if filename != "-":
+        inner["deps"].remove(filename)
+
+    unit["expansions"] = inner["expansions"]
+    unit["lines"].extend(inner["lines"])
+    unit["origins"].extend((filename, line_num) for _ in inner["lines"])
+    for key in ("exports", "imports", "deps"):
+        unit[key].extend(inner[key])
+
+
+def pass1(inputfile, sym, code, lines=None, origins=None):
     """
     Pass 1
 
@@ -135,6 +302,10 @@ def pass1(inputfile, sym, code):
     * Parse labels, opcodes, and operands
     * Record label offsets
     * Emit machine code
+    * Record (address, line number, is data) for each line that emits
+      bytes, if `lines` is given
+
+    `origins` from `preprocess` lets errors name the file and line.
     """
 
     # Source line number
@@ -143,6 +314,15 @@ def pass1(inputfile, sym, code):
     # Current code address (for labels)
     addr = 0
 
+    def where():
+        """Where the current line came from, for error messages"""
+
+        if origins is None:
+            return f"line {line_num}"
+
+        filename, source_line = origins[line_num - 1]
+        return f"{filename}:{source_line}"
+
     def get_reg(op, fatal=True):
         """Get a register number from a string, e.g. "R2" -> 2"""
 
@@ -152,7 +332,7 @@ def pass1(inputfile, sym, code):
 
         if m is None:
             if fatal:
-                print(f"Line {line_num}: unknown register {op}",
+                print(f"{where()}: unknown register {op}",
                       file=sys.stderr)
                 sys.exit(1)
             else:
@@ -223,7 +403,7 @@ def pass1(inputfile, sym, code):
         m = re.match(REGEX_DS, line, re.IGNORECASE)
 
         if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
+            print(f"{where()}: missing argument to DS", file=sys.stderr)
             sys.exit(2)
 
         data = m.group(2)
@@ -257,7 +437,7 @@ def pass1(inputfile, sym, code):
             val = int(data, 0)
 
         except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
+            print(f"{where()}: invalid integer argument to DB",
                   file=sys.stderr)
             sys.exit(2)
 
@@ -274,17 +454,17 @@ def pass1(inputfile, sym, code):
         def check_ops_count(desired, found):
             # Makes sure we have right operand count
             if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
+                print(f"{where()}: missing operand to {opcode}",
                       file=sys.stderr)
                 sys.exit(1)
             elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
+                print(f"{where()}: unexpected operand to {opcode}",
                       file=sys.stderr)
                 sys.exit(1)
 
         # Make sure we know this opcode at all
         if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
+            print(f"{where()}: unknown opcode {opcode}", file=sys.stderr)
             sys.exit(2)
 
         op_type = OPCODES[opcode]["type"]
@@ -344,6 +524,8 @@ def pass1(inputfile, sym, code):
                 code.append(f'# {label} (address {addr}):')
 
             if opcode is not None:
+                start_addr = addr
+
                 if opcode == 'DS':
                     handle_ds(line)
                 elif opcode == 'DB':
@@ -356,11 +538,223 @@ def pass1(inputfile, sym, code):
                     op_info = OPCODES[opcode]
                     handler = type_f[op_info["type"]]
                     handler(opcode, op_a, op_b, op_info["code"])
+
+                if lines is not None and addr != start_addr:
+                    lines.append((start_addr, line_num, opcode in ('DS', 'DB')))
         else:
             print(f"No match: {input}", file=sys.stderr)
             sys.exit(3)
 
 
+def decode(code, lines):
+    """
+    Split pass 1 output back into items, one per source line that emitted
+    bytes. Each item is a dict with the labels in front of it, its line
+    number, whether it's DS/DB data, the mnemonic and register operands of
+    an instruction, and its `code` entries.
+    """
+
+    data_starts = {addr: line_num for addr, line_num, is_data in lines if is_data}
+    line_at = {addr: line_num for addr, line_num, is_data in lines}
+    names = {info["code"]: name for name, info in OPCODES.items()}
+
+    items = []
+    labels = []
+    addr = 0
+    i = 0
+
+    while i < len(code):
+        c = code[i]
+
+        if c.startswith('#'):
+            # "# LABEL (address N):"
+            labels.append(c[2:c.index(' (address')])
+            i += 1
+            continue
+
+        item = {"labels": labels, "line": line_at[addr], "data": False,
+                "op": None, "a": None, "b": None, "code": []}
+        labels = []
+
+        if addr in data_starts:
+            item["data"] = True
+            while True:
+                item["code"].append(code[i])
+                i += 1
+                addr += 1
+                if (i == len(code) or code[i].startswith('#') or
+                        addr in line_at):
+                    break
+        else:
+            op = names[c[:8]]
+            size = isa.instruction_size(int(c[:8], 2))
+            item["op"] = op
+            item["code"] = code[i:i + size]
+            if size > 1:
+                item["a"] = int(item["code"][1], 2)
+            if size > 2 and OPCODES[op]["type"] != 8:
+                item["b"] = int(item["code"][2], 2)
+            i += size
+            addr += size
+
+        items.append(item)
+
+    if labels:
+        # Labels after the last byte
+        items.append({"labels": labels, "line": None, "data": False,
+                      "op": None, "a": None, "b": None, "code": []})
+
+    return items
+
+
+def encode(items, sym, code, lines):
+    """
+    Rebuild `code` and `lines` from decoded items, relocating every label
+    in `sym` to wherever its item ended up.
+    """
+
+    code.clear()
+    lines.clear()
+    addr = 0
+
+    for item in items:
+        for label in item["labels"]:
+            sym[label] = addr
+            code.append(f'# {label} (address {addr}):')
+
+        if item["code"]:
+            lines.append((addr, item["line"], item["data"]))
+            code.extend(item["code"])
+            addr += len(item["code"])
+
+
+def reg_sets(item):
+    """Registers an instruction item reads and writes."""
+
+    reads, writes = REG_USE[item["op"]]
+    regs = {"a": item["a"], "b": item["b"], "s": 7}
+    if "n" in reads:
+        regs["n"] = item["a"] + 1
+
+    return ({regs[r] for r in reads}, {regs[r] for r in writes})
+
+
+def dead_ldi(items, i):
+    """
+    True if the LDI at `items[i]` is overwritten before anything reads it,
+    without leaving the straight-line code it's in.
+    """
+
+    reg = items[i]["a"]
+
+    if reg in LIVE_REGS:
+        return False
+
+    for item in items[i + 1:]:
+        if item["labels"] or item["op"] is None:
+            return False
+
+        reads, writes = reg_sets(item)
+
+        if reg in reads:
+            return False
+        if reg in writes:
+            return True
+        if item["op"] in BLOCK_END or item["op"] in COND_JUMPS:
+            return False
+
+    return False
+
+
+def peephole(items):
+    """
+    One pass over the items. Removes:
+
+    * an LDI whose register is written again before it's read
+    * a PUSH Rx immediately followed by POP Rx
+    * an LDI loading a register with the value it already holds, e.g. a
+      repeated `LDI R0,label` before each `JMP R0`
+
+    Labels on a removed item move to the item after it. Returns the
+    removed items.
+    """
+
+    removed = []
+    # Register -> code entry of the value an earlier LDI put there
+    known = {}
+    i = 0
+
+    while i < len(items):
+        item = items[i]
+        op = item["op"]
+
+        if item["labels"] or item["data"] or op is None:
+            known = {}
+
+        if op is None:
+            i += 1
+            continue
+
+        drop = 0
+
+        if op == "LDI" and (dead_ldi(items, i) or
+                            known.get(item["a"]) == item["code"][2]):
+            drop = 1
+
+        elif (op == "PUSH" and i + 1 < len(items) and item["a"] != 7 and
+              items[i + 1]["op"] == "POP" and items[i + 1]["a"] == item["a"] and
+              not items[i + 1]["labels"]):
+            drop = 2
+
+        if drop:
+            labels = item["labels"]
+            removed.extend(items[i:i + drop])
+            del items[i:i + drop]
+            if i < len(items):
+                items[i]["labels"] = labels + items[i]["labels"]
+            elif labels:
+                items.append({"labels": labels, "line": None, "data": False,
+                              "op": None, "a": None, "b": None, "code": []})
+            continue
+
+        reads, writes = reg_sets(item)
+        for reg in writes:
+            known.pop(reg, None)
+        if op == "LDI":
+            known[item["a"]] = item["code"][2]
+        if op in BLOCK_END:
+            known = {}
+
+        i += 1
+
+    return removed
+
+
+def optimize(code, sym, lines):
+    """
+    Optional peephole pass between pass 1 and pass 2. Rewrites `code`,
+    `sym` and `lines` in place and returns (bytes saved, instructions
+    removed). Each removed instruction is a cycle saved every time that
+    spot is passed through.
+
+    Only labels are relocated: code that jumps to or reads from a numeric
+    address past the first removal will break, as will self-modifying code.
+    """
+
+    items = decode(code, lines)
+    removed = []
+
+    while True:
+        pass_removed = peephole(items)
+        if not pass_removed:
+            break
+        removed.extend(pass_removed)
+
+    encode(items, sym, code, lines)
+
+    return sum(len(item["code"]) for item in removed), len(removed)
+
+
 def pass2(outputfile, sym, code):
     """
     Output the code, substituting in any symbols.
@@ -381,22 +775,243 @@ def pass2(outputfile, sym, code):
         outputfile.write(f"{c}\n")
 
 
+def locate(lines, origins):
+    """
+    Turn pass 1 line entries, numbered by expanded source line, into
+    (address, file, line number, is data) using `preprocess` origins.
+    """
+
+    result = []
+
+    for addr, line_num, is_data in lines:
+        filename, source_line = origins[line_num - 1]
+        result.append((addr, filename, source_line, is_data))
+
+    return result
+
+
+def write_line_table(outputfile, lines):
+    """
+    Write the line table: "address line" per source line that emitted
+    bytes, address in hex, with a trailing "d" for DS/DB data, and a
+    "file name" line whenever the source file changes. Addresses between
+    two entries belong to the earlier one.
+    """
+
+    current = None
+
+    for addr, filename, line_num, is_data in lines:
+        if filename != current:
+            outputfile.write(f"file {filename}\n")
+            current = filename
+
+        suffix = " d" if is_data else ""
+        outputfile.write(f"{addr:02x} {line_num}{suffix}\n")
+
+
+def read_line_table(inputfile):
+    """
+    Read a line table back as a list of (address, file, line number,
+    is data) in address order.
+    """
+
+    filename = None
+    lines = []
+
+    for line in inputfile:
+        line = line.strip()
+
+        if line.startswith("file "):
+            filename = line[5:]
+        elif line != '':
+            fields = line.split()
+            lines.append((int(fields[0], 16), filename, int(fields[1]),
+                          fields[2:] == ['d']))
+
+    return lines
+
+
+def pass2_object(unit, sym, code):
+    """
+    Like pass 2, but for an object file: returns the bytes with every
+    symbol reference left as a relocation. A local label's byte holds its
+    offset in this object and gets the object's load address added at
+    link time; an imported symbol's byte is filled in by the linker.
+    """
+
+    data = []
+    relocs = []
+
+    for c in code:
+        if c[:1] == '#':
+            continue
+
+        if c[:4] == 'sym:':
+            s = c[4:].strip()
+
+            if s in sym:
+                relocs.append([len(data), None])
+                data.append(sym[s])
+
+            elif s in unit["imports"]:
+                relocs.append([len(data), s])
+                data.append(0)
+
+            else:
+                print(f"unknown symbol: {s}", file=sys.stderr)
+                sys.exit(2)
+
+        else:
+            data.append(int(c[:8], 2))
+
+    for s in unit["exports"]:
+        if s not in sym:
+            print(f"exported symbol not defined: {s}", file=sys.stderr)
+            sys.exit(2)
+
+    return data, relocs
+
+
+def assemble_unit(inputfile, filename="-", optimize_code=False, allow_include=True):
+    """
+    Run passes 0 and 1 (and the optimizer). Returns the unit, the symbol
+    table, pass 1 code and the located line table.
+    """
+
+    unit = new_unit()
+    sym = {}
+    code = []
+    lines = []
+
+    preprocess(inputfile, filename, unit, allow_include=allow_include)
+    pass1(unit["lines"], sym, code, lines, unit["origins"])
+
+    if optimize_code:
+        saved_bytes, saved_insns = optimize(code, sym, lines)
+        unit["saved"] = (saved_bytes, saved_insns)
+
+    return unit, sym, code, locate(lines, unit["origins"])
+
+
+def assemble(inputfile, lines=None, optimize_code=False, filename="-", allow_include=True):
+    """
+    Assemble source lines in memory. Returns the `.ls8` text and the symbol
+    table (label -> address). Fills in `lines` with the line table, if
+    given, and runs the peephole optimizer if `optimize_code` is set.
+    With `allow_include` false, `.include` is an error, even from a macro.
+    """
+
+    unit, sym, code, located = assemble_unit(inputfile, filename, optimize_code,
+                                             allow_include)
+    outputfile = io.StringIO()
+
+    pass2(outputfile, sym, code)
+
+    if lines is not None:
+        lines.extend(located)
+
+    return outputfile.getvalue(), sym
+
+
+def preevaluate(text, filename="-"):
+    """
+    Partially evaluate assembled `.ls8` text with ls8/preval.py. Returns the
+    reduced image's text, or `text` itself if it was kept.
+    """
+
+    import cpu_fast
+    import preval
+
+    image = cpu_fast.parse_program(text.splitlines(), filename)
+    # Run the extension instructions if the source was allowed to use them
+    reduction = preval.reduce(image, extensions="COPY" in OPCODES)
+    print(preval.describe(filename, reduction), file=sys.stderr)
+    if not reduction.reduced:
+        return text
+
+    outputfile = io.StringIO()
+    preval.write_image(outputfile, reduction)
+    return outputfile.getvalue()
+
+
+def assemble_object(inputfile, filename="-", optimize_code=False):
+    """Assemble one module into an object (a dict, saved as JSON)."""
+
+    unit, sym, code, located = assemble_unit(inputfile, filename, optimize_code)
+
+    return make_object(unit, sym, code, located, filename)
+
+
+def make_object(unit, sym, code, located, filename):
+    data, relocs = pass2_object(unit, sym, code)
+
+    return {
+        "format": OBJECT_FORMAT,
+        "version": OBJECT_VERSION,
+        "source": filename,
+        "deps": unit["deps"],
+        "code": data,
+        "relocs": relocs,
+        "labels": sym,
+        "exports": unit["exports"],
+        "imports": unit["imports"],
+        "lines": located,
+        "optimized": "saved" in unit,
+    }
+
+
+def write_object(outputfile, obj):
+    json.dump(obj, outputfile)
+    outputfile.write("\n")
+
+
+def read_object(path):
+    """Load an object file, or None if it isn't one this assembler wrote."""
+
+    try:
+        with open(path) as f:
+            obj = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (not isinstance(obj, dict) or obj.get("format") != OBJECT_FORMAT or
+            obj.get("version") != OBJECT_VERSION):
+        return None
+
+    obj["lines"] = [tuple(entry) for entry in obj["lines"]]
+
+    return obj
+
+
 def main(argv):
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    (inputfile, outputfile, linefile,
+     optimize_code, object_file, preevaluate_image) = parse_commandline(argv)
+    source = inputfile
 
     # Open files
     inputfile, outputfile = open_files(inputfile, outputfile)
 
-    # Set up the symbol table
-    sym = {}
+    # Assemble (pass 0 reads includes and expands macros)
+    unit, sym, code, lines = assemble_unit(inputfile, source, optimize_code)
 
-    # Set up the machine code output
-    code = []
+    if object_file:
+        write_object(outputfile, make_object(unit, sym, code, lines, source))
+    elif preevaluate_image:
+        text = io.StringIO()
+        pass2(text, sym, code)
+        outputfile.write(preevaluate(text.getvalue(), source))
+    else:
+        pass2(outputfile, sym, code)
 
-    # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    if optimize_code:
+        saved_bytes, saved_insns = unit["saved"]
+        print(f"peephole: removed {saved_insns} instructions, {saved_bytes} bytes, "
+              f"~{saved_insns} cycles per pass through them", file=sys.stderr)
+
+    if linefile is not None:
+        with open(linefile, "w") as f:
+            write_line_table(f, lines)
 
     return 0
 
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# Linker for LS-8 object files
+#
+#   python link.py [-O] [-P] [-o out.ls8] [-l out.lines] main.asm lib.asm lib2.o ...
+#
+# Objects are written by `asm.py -c` (see `asm.assemble_object`). They are
+# laid out in the order given, the first one at address 0, so the first
+# module is the entry point. -P partially evaluates the linked image with
+# ls8/preval.py, as `asm.py -P` does for a single file.
+#
+# A `.asm` argument is built into the `.o` next to it first, unless that
+# object is newer than the source and every file it `.include`d, so only
+# the modules that changed get reassembled.
+#
+# Example modules:
+#
+#  ; main.asm
+#  .import PrintNum
+#      LDI R0,42
+#      LDI R1,PrintNum
+#      CALL R1
+#      HLT
+#
+#  ; lib.asm
+#  .export PrintNum
+#  PrintNum:
+#      PRN R0
+#      RET
+
+import io
+import os
+import sys
+
+import asm
+
+# Bytes of RAM a linked image may fill
+MEMORY_SIZE = 256
+
+
+def parse_commandline(argv):
+    """
+    Usage: link.py [-O] [-P] [-o outputfile] [-l linefile] inputfile...
+    """
+
+    outputfile = "-"
+    linefile = None
+    optimize_code = False
+    preevaluate_image = False
+    inputfiles = []
+
+    args = iter(argv[1:])
+
+    for arg in args:
+        if arg == "-O":
+            optimize_code = True
+        elif arg == "-P":
+            preevaluate_image = True
+        elif arg in ("-o", "-l"):
+            value = next(args, None)
+            if value is None:
+                break
+            if arg == "-o":
+                outputfile = value
+            else:
+                linefile = value
+        else:
+            inputfiles.append(arg)
+
+    if not inputfiles:
+        print("usage: link.py [-O] [-P] [-o out.ls8] [-l out.lines] "
+              "module.asm|module.o ...", file=sys.stderr)
+        sys.exit(1)
+
+    if preevaluate_image and linefile is not None:
+        print("link.py: -P can't be used with a line table", file=sys.stderr)
+        sys.exit(1)
+
+    return inputfiles, outputfile, linefile, optimize_code, preevaluate_image
+
+
+def object_path(source):
+    return os.path.splitext(source)[0] + ".o"
+
+
+def up_to_date(obj, path, optimize_code):
+    """True if the object at `path` is newer than everything it was built from."""
+
+    if obj is None or obj["optimized"] != optimize_code:
+        return False
+
+    built = os.path.getmtime(path)
+
+    for dep in obj["deps"]:
+        if not os.path.exists(dep) or os.path.getmtime(dep) > built:
+            return False
+
+    return True
+
+
+def build(source, optimize_code=False):
+    """
+    Return the object for `source`, reassembling it only if it's out of
+    date. Returns (object, whether it was rebuilt).
+    """
+
+    path = object_path(source)
+    obj = asm.read_object(path)
+
+    if up_to_date(obj, path, optimize_code):
+        return obj, False
+
+    with open(source) as inputfile:
+        obj = asm.assemble_object(inputfile, source, optimize_code)
+
+    with open(path, "w") as outputfile:
+        asm.write_object(outputfile, obj)
+
+    return obj, True
+
+
+def load(inputfile, optimize_code=False):
+    """Object for a command line argument, building `.asm` files as needed."""
+
+    if inputfile.endswith(".asm"):
+        obj, rebuilt = build(inputfile, optimize_code)
+        state = "assembled" if rebuilt else "up to date"
+        print(f"{state}: {inputfile}", file=sys.stderr)
+        return obj
+
+    obj = asm.read_object(inputfile)
+
+    if obj is None:
+        print(f"{inputfile}: not an LS-8 object file", file=sys.stderr)
+        sys.exit(2)
+
+    return obj
+
+
+def link(objects):
+    """
+    Lay out `objects` one after another, resolve imports against exports
+    and apply relocations. Returns the image as a list of bytes, the
+    global symbol table, the line table and a listing of (address,
+    comment) pairs for the output.
+    """
+
+    # Global symbol -> address
+    exports = {}
+    bases = []
+    addr = 0
+
+    for obj in objects:
+        bases.append(addr)
+
+        for s in obj["exports"]:
+            if s in exports:
+                print(f"{obj['source']}: {s} is already exported by another module",
+                      file=sys.stderr)
+                sys.exit(2)
+            exports[s] = addr + obj["labels"][s]
+
+        addr += len(obj["code"])
+
+    if addr > MEMORY_SIZE:
+        print(f"linked image is {addr} bytes, more than {MEMORY_SIZE}",
+              file=sys.stderr)
+        sys.exit(2)
+
+    image = []
+    lines = []
+    listing = []
+
+    for obj, base in zip(objects, bases):
+        code = list(obj["code"])
+
+        for offset, s in obj["relocs"]:
+            if s is None:
+                code[offset] += base
+            elif s in exports:
+                code[offset] = exports[s]
+            else:
+                print(f"{obj['source']}: unresolved import {s}", file=sys.stderr)
+                sys.exit(2)
+
+        image.extend(code)
+
+        listing.append((base, f"{obj['source']} (address {base})"))
+        for label, offset in sorted(obj["labels"].items(), key=lambda item: item[1]):
+            listing.append((base + offset, f"{label} (address {base + offset}):"))
+
+        for offset, filename, line_num, is_data in obj["lines"]:
+            lines.append((base + offset, filename, line_num, is_data))
+
+    return image, exports, lines, listing
+
+
+def write_image(outputfile, image, listing):
+    """Write the image as `.ls8` text, with the listing as comments."""
+
+    comments = {}
+    for addr, comment in listing:
+        comments.setdefault(addr, []).append(comment)
+
+    for addr, byte in enumerate(image):
+        for comment in comments.get(addr, []):
+            outputfile.write(f"# {comment}\n")
+        outputfile.write(f"{asm.p8(byte)}\n")
+
+
+def main(argv):
+    (inputfiles, outputfile, linefile, optimize_code,
+     preevaluate_image) = parse_commandline(argv)
+
+    objects = [load(inputfile, optimize_code) for inputfile in inputfiles]
+
+    image, exports, lines, listing = link(objects)
+
+    text = io.StringIO()
+    write_image(text, image, listing)
+    text = text.getvalue()
+    if preevaluate_image:
+        text = asm.preevaluate(text, inputfiles[0])
+
+    if outputfile == "-":
+        sys.stdout.write(text)
+    else:
+        with open(outputfile, "w") as f:
+            f.write(text)
+
+    if linefile is not None:
+        with open(linefile, "w") as f:
+            asm.write_line_table(f, lines)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,18 @@
+; Prints Hello, world! with the PRS extension instruction
+;
+; Same output as printstr.asm, in one instruction instead of a loop of six
+; per character. Needs the extensions: asm.py -x, FastCPU(extensions=True)
+;
+; Expected output: Hello, world!
+
+	LDI R0,Hello         ; address of "Hello, world!" bytes
+	LDI R1,14            ; number of bytes to print
+	PRS R0               ; print R1 bytes from the address in R0
+	HLT                  ; halt
+
+; Start of printable data
+
+Hello:
+
+	ds Hello, world!
+	db 0x0a             ; newline
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""Run a batch of LS-8 programs, optionally through the result cache.
+
+    python3 batch.py [--cache DIR] [--cache-size BYTES] [--max-cycles N]
+                     [--watchdog] [--output] program.ls8[:input.log] ...
+
+Each program runs on a fresh FastCPU. A replay log (see `replay.py`) after
+a colon supplies its key presses and interrupts. One line per program gives
+the stop reason, instructions executed and whether the result came from the
+cache; `--output` prints what each program printed after it.
+"""
+
+import argparse
+import sys
+
+from cpu_fast import LS8Error, parse_program
+from replay import Recording
+import runcache
+
+
+def parse_job(arg):
+    """`program.ls8[:input.log]` -> (program, image, events)."""
+
+    program, _, log = arg.partition(":")
+    with open(program) as f:
+        image = parse_program(f, program)
+    events = Recording.load(log).events if log else ()
+    return program, image, events
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run a batch of LS-8 programs")
+    parser.add_argument("programs", nargs="+", help="program.ls8[:input.log]")
+    parser.add_argument("--cache", help="result cache directory")
+    parser.add_argument("--cache-size", type=int, default=runcache.MAX_BYTES)
+    parser.add_argument("--max-cycles", type=int, default=None)
+    parser.add_argument("--watchdog", action="store_true",
+                        help="stop programs that are stuck in a loop")
+    parser.add_argument("--output", action="store_true", help="print each program's output")
+    args = parser.parse_args(argv[1:])
+
+    cache = runcache.ResultCache(args.cache, args.cache_size) if args.cache else None
+    failures = 0
+    try:
+        for arg in args.programs:
+            try:
+                program, image, events = parse_job(arg)
+                if cache is not None:
+                    result = cache.run(image, events, args.max_cycles, args.watchdog)
+                else:
+                    result = runcache.run_uncached(image, events, args.max_cycles, args.watchdog)
+            except (OSError, LS8Error) as e:
+                print(f"{arg}: {e}")
+                failures += 1
+                continue
+
+            source = "cached" if result.hit else "ran"
+            loop = f" in {result.loop[0]:02X}-{result.loop[1]:02X}" if result.loop else ""
+            print(f"{program}: {result.reason}{loop} after {result.cycles} instructions ({source})")
+            if args.output:
+                print(result.output, end="")
+    finally:
+        if cache is not None:
+            print(runcache.format_stats(cache.stats, cache.size, cache.max_bytes), file=sys.stderr)
+            cache.close()
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""Micro-benchmark: dict-of-bound-methods CPU vs slotted list-dispatch CPU.
+
+    python3 bench_fast.py [iterations]
+
+Both machines run the same counting loop (ADD / CMP / JNE back-edge) from a
+fresh power-on state, with no I/O in the hot path.
+"""
+
+import sys
+import timeit
+
+from cpu_table import CPU
+from cpu_fast import FastCPU
+
+# LDI R0,0 / LDI R1,1 / LDI R2,250 / LDI R3,LOOP
+# LOOP: ADD R0,R1 / CMP R0,R2 / JNE R3 / HLT
+LOOP_PROGRAM = [
+    "10000010", "00000000", "00000000",
+    "10000010", "00000001", "00000001",
+    "10000010", "00000010", "11111010",
+    "10000010", "00000011", "00001100",
+    "10100000", "00000000", "00000001",
+    "10100111", "00000000", "00000010",
+    "01010110", "00000011",
+    "00000001",
+]
+
+
+def run_table():
+    cpu = CPU()
+    for address, byte in enumerate(LOOP_PROGRAM):
+        cpu.ram[address] = int(byte, 2)
+    cpu.run()
+    return cpu
+
+
+def run_fast():
+    cpu = FastCPU()
+    for address, byte in enumerate(LOOP_PROGRAM):
+        cpu.ram[address] = int(byte, 2)
+    cpu.run()
+    return cpu
+
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 200
+
+    assert run_table().reg[0] == run_fast().reg[0] == 250
+
+    table_time = min(timeit.repeat(run_table, number=iterations, repeat=3))
+    fast_time = min(timeit.repeat(run_fast, number=iterations, repeat=3))
+
+    # 4 setup instructions + 3 per loop pass + HLT
+    instructions = iterations * (4 + 3 * 250)
+    print(f"cpu_table.CPU: {table_time:.3f}s  {instructions / table_time / 1e6:.2f} M instr/s")
+    print(f"FastCPU:       {fast_time:.3f}s  {instructions / fast_time / 1e6:.2f} M instr/s")
+    print(f"speedup:       {table_time / fast_time:.2f}x")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
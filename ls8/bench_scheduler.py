@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""Benchmark: scheduling overhead and memory per guest.
+
+    python3 bench_scheduler.py [guests] [quantum]
+
+Runs the same counting loop on every guest, first back to back with no
+scheduler, then time-sliced by `Scheduler`, and reports the difference per
+context switch. Memory per guest is measured with tracemalloc.
+"""
+
+import sys
+import time
+import tracemalloc
+
+from bench_fast import LOOP_PROGRAM
+from cpu_fast import FastCPU
+from scheduler import Scheduler, ROUND_ROBIN, PRIORITY
+
+IMAGE = [int(byte, 2) for byte in LOOP_PROGRAM]
+
+
+def run_direct(guests):
+    start = time.perf_counter()
+    for _ in range(guests):
+        cpu = FastCPU()
+        cpu.load_image(IMAGE)
+        cpu.run()
+    return time.perf_counter() - start
+
+
+def run_scheduled(guests, quantum, policy):
+    scheduler = Scheduler(quantum=quantum, policy=policy)
+    start = time.perf_counter()
+    for i in range(guests):
+        scheduler.add(image=IMAGE, priority=i % 4)
+    scheduler.run()
+    return time.perf_counter() - start, scheduler
+
+
+def memory_per_guest(guests):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    scheduler = Scheduler()
+    for _ in range(guests):
+        scheduler.add(image=IMAGE)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / guests
+
+
+def main(argv):
+    guests = int(argv[1]) if len(argv) > 1 else 2000
+    quantum = int(argv[2]) if len(argv) > 2 else 100
+
+    direct = min(run_direct(guests) for _ in range(3))
+    print(f"{guests} guests, quantum {quantum}")
+    print(f"direct:       {direct:.3f}s")
+
+    for policy in (ROUND_ROBIN, PRIORITY):
+        elapsed, scheduler = min((run_scheduled(guests, quantum, policy) for _ in range(3)),
+                                 key=lambda result: result[0])
+        overhead = (elapsed - direct) / scheduler.switches
+        print(f"{policy + ':':<13} {elapsed:.3f}s  {scheduler.switches} switches"
+              f"  {overhead * 1e6:.2f} us/switch overhead")
+
+    print(f"memory:       {memory_per_guest(guests) / 1024:.2f} KiB/guest")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""Short programs per second: `ls8.py` per program vs the worker.
+
+    python3 bench_worker.py [program.ls8] [count]
+
+Runs `program.ls8` (default examples/print8.ls8) `count` times three ways:
+a fresh `python3 ls8.py` process each time, a fresh `python3 ls8c.py`
+process each time, and one `ls8c.Client` sending every run down a single
+connection. The worker gets its own socket and is stopped afterwards.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import ls8c
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def per_process(command, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def wait_for_worker(path, worker):
+    """A client for the worker we started, once it is listening."""
+
+    deadline = time.monotonic() + ls8c.START_TIMEOUT
+    while True:
+        try:
+            # Not spawn: that would race ours with a worker of its own
+            return ls8c.Client(path, spawn=False)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if worker.poll() is not None or time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def pipelined(client, program, count):
+    start = time.perf_counter()
+    for result in client.run_many([program] * count):
+        assert "error" not in result, result["error"]
+    return time.perf_counter() - start
+
+
+def main(argv):
+    program = argv[1] if len(argv) > 1 else os.path.join(HERE, "examples", "print8.ls8")
+    count = int(argv[2]) if len(argv) > 2 else 50
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "worker.sock")
+    os.environ["LS8_WORKER"] = path
+    worker = subprocess.Popen([sys.executable, os.path.join(HERE, "worker.py"), "--socket", path])
+    try:
+        with wait_for_worker(path, worker) as client:
+            # Warm up: the worker parses the program once
+            client.run(program)
+            rates = [
+                ("ls8.py per program", count / per_process(
+                    [sys.executable, os.path.join(HERE, "ls8.py"), program], count)),
+                ("ls8c.py per program", count / per_process(
+                    [sys.executable, os.path.join(HERE, "ls8c.py"), program], count)),
+                ("one client, pipelined", count * 20 / pipelined(client, program, count * 20)),
+            ]
+    finally:
+        worker.terminate()
+        worker.wait()
+        shutil.rmtree(directory)
+
+    base = rates[0][1]
+    for name, rate in rates:
+        print(f"{name:<22} {rate:10.1f} programs/s  {rate / base:7.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+"""Source-level coverage and hot lines for LS-8 programs.
+
+    python3 cover.py program.asm [--max-cycles N] [--top N] [-o report.txt]
+    python3 cover.py program.ls8 --lines program.lines [...]
+
+`asm.py` and `link.py` can write a line table next to the `.ls8` file mapping
+each address to the file and line that emitted it. An `.asm` given here is
+assembled in memory with the same table.
+
+While the program runs, `Coverage` counts how often each address is executed
+by giving the CPU its own dispatch table in which every handler first bumps
+a counter for the current PC. The counts and a 256-bit bitmap of executed
+addresses are then mapped back through the line table, and the source is
+printed gcov-style: execution count, line number, source text. Lines that
+emit code but never ran are marked `#####`; lines with no code get `-`.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'asm'))
+
+import asm
+
+from cpu_fast import FastCPU, LS8Error, parse_program
+
+
+class Coverage:
+    """
+    Attach to a FastCPU and count executed addresses.
+
+        coverage = Coverage(cpu)
+        cpu.run()
+        coverage.finish()
+        coverage.counts[0x10], coverage.bitmap()
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # The table we replace, put back by `uninstall`
+        self.base = cpu.dispatch
+        # Executions per address
+        self.counts = [0] * 256
+        self.install()
+
+    def install(self):
+        counts = self.counts
+
+        def make_counter(original):
+            def counted(cpu, operand_a, operand_b):
+                counts[cpu.pc & 0xFF] += 1
+                original(cpu, operand_a, operand_b)
+            return counted
+
+        self.cpu.dispatch = [make_counter(handler) for handler in self.base]
+
+    def uninstall(self):
+        self.cpu.dispatch = self.base
+
+    def finish(self):
+        """HLT never reaches the dispatch table, so count it once stopped on it."""
+
+        if self.cpu.halted:
+            self.counts[self.cpu.pc & 0xFF] += 1
+
+    def bitmap(self):
+        """32 bytes, bit `address & 7` of byte `address >> 3` set if executed."""
+
+        bits = bytearray(32)
+        for address, count in enumerate(self.counts):
+            if count:
+                bits[address >> 3] |= 1 << (address & 7)
+        return bytes(bits)
+
+
+class LineReport:
+    """Coverage counts mapped onto source lines through a line table."""
+
+    def __init__(self, counts, lines):
+        self.counts = counts
+        # (file, line number) -> (executions, is data). A line that emits
+        # several instructions (a macro) shows its most executed one.
+        self.by_line = {}
+        for address, filename, line_num, is_data in lines:
+            key = (filename, line_num)
+            previous = self.by_line.get(key, (0, is_data))[0]
+            self.by_line[key] = (max(previous, counts[address]), is_data)
+
+    def files(self):
+        """Source files in the order the line table first mentions them."""
+
+        return list(dict.fromkeys(filename for filename, line_num in self.by_line))
+
+    def code_lines(self):
+        return [key for key, (count, is_data) in self.by_line.items() if not is_data]
+
+    def covered(self):
+        """(code lines executed, code lines)"""
+
+        code = self.code_lines()
+        return sum(1 for key in code if self.by_line[key][0]), len(code)
+
+    def hot(self, n = 10):
+        """The `n` most executed lines as ((file, line number), executions)."""
+
+        rows = [(key, self.by_line[key][0]) for key in self.code_lines()]
+        rows.sort(key=lambda row: -row[1])
+        return [row for row in rows[:n] if row[1]]
+
+    def annotate(self, filename, source_lines, out = sys.stdout):
+        for line_num, text in enumerate(source_lines, 1):
+            count, is_data = self.by_line.get((filename, line_num), (None, True))
+            if is_data:
+                mark = "-"
+            elif count:
+                mark = str(count)
+            else:
+                mark = "#####"
+            print(f"{mark:>9}:{line_num:>5}: {text.rstrip()}", file=out)
+
+    def print_summary(self, sources, total, top = 10, out = sys.stdout):
+        executed, code = self.covered()
+        percent = executed / code if code else 0
+        print(f"{executed}/{code} lines executed ({percent:.1%}), "
+              f"{total} instructions", file=out)
+        for (filename, line_num), count in self.hot(top):
+            source_lines = sources.get(filename, [])
+            text = source_lines[line_num - 1].strip() if line_num <= len(source_lines) else ""
+            print(f"{count:>9} {count / (total or 1):>6.1%} "
+                  f"{filename}:{line_num}: {text}", file=out)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Coverage report for LS-8 programs")
+    parser.add_argument("program", help=".asm source, or .ls8 with --lines")
+    parser.add_argument("--lines", help="line table written by asm.py or link.py")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    parser.add_argument("--top", type=int, default=10, help="hot lines to list")
+    parser.add_argument("-o", "--output", help="write the annotated source here")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        if args.lines is None:
+            lines = []
+            with open(args.program) as f:
+                text, sym = asm.assemble(f, lines, filename=args.program)
+            image = parse_program(text.splitlines(), args.program)
+        else:
+            with open(args.lines) as f:
+                lines = asm.read_line_table(f)
+            with open(args.program) as f:
+                image = parse_program(f, args.program)
+    except (OSError, LS8Error) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    cpu = FastCPU()
+    coverage = Coverage(cpu)
+    try:
+        cpu.load_image(image)
+        cpu.run(max_cycles=args.max_cycles)
+    except LS8Error as e:
+        print(f"\n{e}", file=sys.stderr)
+    coverage.finish()
+
+    report = LineReport(coverage.counts, lines)
+    sources = {}
+    out = open(args.output, "w") if args.output else sys.stderr
+    try:
+        for filename in report.files():
+            path = filename
+            if args.lines is not None and not os.path.exists(path):
+                # Names in the table are relative to where it was written
+                path = os.path.join(os.path.dirname(args.lines), filename)
+            try:
+                with open(path) as f:
+                    sources[filename] = f.readlines()
+            except OSError as e:
+                print(e, file=sys.stderr)
+                continue
+            if len(report.files()) > 1:
+                print(f"==> {filename} <==", file=out)
+            report.annotate(filename, sources[filename], out)
+    finally:
+        if out is not sys.stderr:
+            out.close()
+    report.print_summary(sources, cpu.cycles, args.top, sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -2,15 +2,7 @@
 
 import sys
 
-HLT = 1
-LDI = 10000010 
-PRN = 1000111
-PUSH = 1000101 
-POP = 1000110 
-MUL = 10100010
-ADD = 10100000
-CALL = 1010000
-RET = 10001 
+from isa import HLT, LDI, PRN, PUSH, POP, MUL, ADD, CALL, RET, ADVANCE
 
 class CPU:
     """Main CPU class."""
@@ -86,7 +78,7 @@ class CPU:
                     if command == '':
                         continue
 
-                    instruction = int(command)
+                    instruction = int(command, 2)
                     self.ram[address] = instruction
 
                     address += 1
@@ -107,7 +99,6 @@ class CPU:
             self.reg[reg_a] *= self.reg[reg_b]
         else:
             raise Exception("Unsupported ALU operation")
-        self.pc += 3
 
     def trace(self):
         """
@@ -129,18 +120,11 @@ class CPU:
 
         print()
     
-    def convert(self, binary):
-        binary_str = str(binary)
-        binary_str.replace("0b", '')
-        return int(binary_str, 2) 
-
     def ldi(self, reg_num, value):
         self.reg[reg_num] = value
-        self.pc += 3
 
     def prn(self, reg_num):
         print(self.reg[reg_num])
-        self.pc += 2
 
     def push(self, reg_num):
         # decrement the stack pointer
@@ -150,7 +134,6 @@ class CPU:
         # put the value at the stack pointer address
         sp = self.reg[7]
         self.ram[sp] = value
-        self.pc += 2
 
     def pop(self, operand_a):
         # get the stack pointer (where do we look?)
@@ -161,7 +144,6 @@ class CPU:
         self.reg[operand_a] = value
         # increment our stack pointer
         self.reg[7] += 1
-        self.pc += 2
 
     def call(self, reg_num):
         ### get the address to jump to, from the register
@@ -190,10 +172,9 @@ class CPU:
         ir = self.ram_read(self.pc)
 
         while ir != HLT:
-            ir = self.ram_read(self.pc)
             # Using ram_read(), read the bytes at PC+1 and PC+2 from RAM into variables operand_a and operand_b in case the instruction needs them.
-            operand_a = self.convert(self.ram_read(self.pc+1))
-            operand_b = self.convert(self.ram_read(self.pc+2))
+            operand_a = self.ram_read(self.pc+1)
+            operand_b = self.ram_read(self.pc+2)
 
             if ir == MUL:
                 op = "MUL"
@@ -214,6 +195,10 @@ class CPU:
             elif ir == RET:
                 self.return_from_call()
 
+            # CALL and RET set the PC themselves, everything else moves past
+            # its operands (worked out from the opcode bits, see isa.py)
+            self.pc += ADVANCE[ir]
+            ir = self.ram_read(self.pc)
+
             # print(self.ram)
-            # print(self.reg)
-            # self.pc += 1
\ No newline at end of file
+            # print(self.reg)
\ No newline at end of file
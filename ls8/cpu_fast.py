@@ -0,0 +1,861 @@
+"""Fast CPU functionality.
+
+Same machine as `cpu_table.CPU`, but the state lives in `__slots__` and the
+dispatch goes through a 256-entry list indexed directly by the opcode byte.
+Handlers are plain functions that take the CPU as their first argument, so
+there is no bound-method creation or dict lookup per instruction.
+"""
+
+import time
+from collections import namedtuple
+
+import isa
+from isa import (HLT, PRN, PUSH, CALL, JEQ, JNE, JGT, JLT, JLE, JGE, ST, PRA,
+                 INT, IRET, ADVANCE, COPY, FILL, PRS)
+
+# R5 is reserved as the interrupt mask (IM)
+# R6 is reserved as the interrupt status (IS)
+# R7 is reserved as the stack pointer (SP)
+IM = 5
+IS = 6
+SP = 7
+
+# Interrupt numbers, and where their vectors and the keyboard byte live
+TIMER_INTERRUPT = 0
+KEYBOARD_INTERRUPT = 1
+VECTOR_TABLE = 0xF8
+KEY_PRESSED = 0xF4
+
+# `FL` bits: `00000LGE`
+FL_L = 0b100
+FL_G = 0b010
+FL_E = 0b001
+
+# Which FL bits each conditional jump tests, and whether it jumps when any of
+# them is set (True) or when all of them are clear (False)
+JUMP_CONDITIONS = {
+    JEQ: (FL_E, True),
+    JNE: (FL_E, False),
+    JGT: (FL_G, True),
+    JLT: (FL_L, True),
+    JGE: (FL_G | FL_E, True),
+    JLE: (FL_L | FL_E, True),
+}
+
+# Why a bounded run stopped
+HALTED = "halted"
+MAX_CYCLES = "max_cycles"
+UNTIL_PC = "until_pc"
+TIMEOUT = "timeout"
+BREAKPOINT = "breakpoint"
+WATCHPOINT = "watchpoint"
+NON_TERMINATING = "non-terminating"
+# Only seen inside `iter_output`
+OUTPUT = "output"
+
+# How many instructions run between wall-clock checks when a timeout is set
+TIMEOUT_CHECK_INTERVAL = 1024
+
+# How many instructions run between state checks when the watchdog is on
+WATCHDOG_INTERVAL = 256
+
+# ram, R0-R7, PC/FL/interrupts enabled/halted, then cycles as 8 bytes
+SNAPSHOT_SIZE = 256 + 8 + 4 + 8
+
+# `loop` is the (first, last) PC of the loop a NON_TERMINATING run was stuck in
+RunResult = namedtuple("RunResult", ["reason", "cycles", "elapsed", "loop"], defaults=[None])
+
+
+class LS8Error(Exception):
+    """Base class for errors raised by the CPU instead of exiting."""
+
+
+class ProgramLoadError(LS8Error):
+    """The program file is missing, malformed or too large for RAM."""
+
+
+class InvalidInstruction(LS8Error):
+    """The PC reached a byte that is not a supported opcode."""
+
+
+class Trap(Exception):
+    """
+    Raised by a handler swapped into a CPU's dispatch table (see debugger.py)
+    to stop execution. `executed` says whether the trapping instruction ran
+    before the trap fired.
+    """
+
+    def __init__(self, reason, executed = False):
+        super().__init__(reason)
+        self.reason = reason
+        self.executed = executed
+
+
+# Handlers for instructions that don't set the PC (the `C` opcode bit) leave
+# it alone: the run loop moves it past the operands afterwards, by
+# `isa.ADVANCE[opcode]`. Jumps, CALL/RET and INT/IRET set it themselves.
+
+def unknown(cpu, operand_a, operand_b):
+    raise InvalidInstruction(f"Unsupported instruction {cpu.ram[cpu.pc & 0xFF]:08b} at {cpu.pc & 0xFF:02X}")
+
+
+def ldi(cpu, reg_num, value):
+    cpu.reg[reg_num] = value
+
+
+def prn(cpu, reg_num, unused_operand):
+    print(cpu.reg[reg_num], file=cpu.out)
+
+
+def pra(cpu, reg_num, unused_operand):
+    print(chr(cpu.reg[reg_num]), end='', file=cpu.out)
+
+
+def nop(cpu, unused_operand_1, unused_operand_2):
+    pass
+
+
+# Block instructions from isa.EXTENSIONS. rA and rA+1 hold an address and a
+# byte count; a range running past 0xFF carries on from 0x00.
+
+def read_block(ram, start, count):
+    end = start + count
+    if end <= 256:
+        return ram[start:end]
+    return ram[start:] + ram[:end - 256]
+
+
+def write_block(ram, start, data):
+    end = start + len(data)
+    if end <= 256:
+        ram[start:end] = data
+    else:
+        ram[start:] = data[:256 - start]
+        ram[:end - 256] = data[256 - start:]
+
+
+def copy_block(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    write_block(cpu.ram, reg[reg_a], read_block(cpu.ram, reg[reg_b], reg[reg_a + 1]))
+
+
+def fill_block(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    write_block(cpu.ram, reg[reg_a], bytes((reg[reg_b],)) * reg[reg_a + 1])
+
+
+def print_block(cpu, reg_a, unused_operand):
+    reg = cpu.reg
+    print(read_block(cpu.ram, reg[reg_a], reg[reg_a + 1]).decode('latin-1'), end='', file=cpu.out)
+
+
+def ld(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] = cpu.ram[reg[reg_b]]
+
+
+def st(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    cpu.ram[reg[reg_a]] = reg[reg_b]
+
+
+def push(cpu, reg_num, unused_operand):
+    reg = cpu.reg
+    # decrement the stack pointer, then store the register there
+    sp = reg[SP] = (reg[SP] - 1) & 0xFF
+    cpu.ram[sp] = reg[reg_num]
+
+
+def pop(cpu, reg_num, unused_operand):
+    reg = cpu.reg
+    sp = reg[SP]
+    reg[reg_num] = cpu.ram[sp]
+    reg[SP] = (sp + 1) & 0xFF
+
+
+def call(cpu, reg_num, unused_operand):
+    reg = cpu.reg
+    # push the address of the instruction after CALL, then jump
+    sp = reg[SP] = (reg[SP] - 1) & 0xFF
+    cpu.ram[sp] = (cpu.pc + 2) & 0xFF
+    cpu.pc = reg[reg_num]
+
+
+def return_from_call(cpu, unused_operand_1, unused_operand_2):
+    reg = cpu.reg
+    sp = reg[SP]
+    reg[SP] = (sp + 1) & 0xFF
+    cpu.pc = cpu.ram[sp]
+
+
+def add(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] = (reg[reg_a] + reg[reg_b]) & 0xFF
+
+
+def sub(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] = (reg[reg_a] - reg[reg_b]) & 0xFF
+
+
+def div(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    if reg[reg_b] == 0:
+        raise LS8Error("Division by zero in DIV")
+    reg[reg_a] //= reg[reg_b]
+
+
+def inc(cpu, reg_a, unused_operand):
+    reg = cpu.reg
+    reg[reg_a] = (reg[reg_a] + 1) & 0xFF
+
+
+def dec(cpu, reg_a, unused_operand):
+    reg = cpu.reg
+    reg[reg_a] = (reg[reg_a] - 1) & 0xFF
+
+
+def mul(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] = (reg[reg_a] * reg[reg_b]) & 0xFF
+
+
+def comp(cpu, reg_a, reg_b):
+    a = cpu.reg[reg_a]
+    b = cpu.reg[reg_b]
+    cpu.fl = (a < b) << 2 | (a > b) << 1 | (a == b)
+
+
+def bitwise_and(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] &= reg[reg_b]
+
+
+def bitwise_or(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] |= reg[reg_b]
+
+
+def bitwise_xor(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] ^= reg[reg_b]
+
+
+def bitwise_not(cpu, reg_a, unused_operand):
+    reg = cpu.reg
+    reg[reg_a] = ~reg[reg_a] & 0xFF
+
+
+def bitwise_shl(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] = (reg[reg_a] << reg[reg_b]) & 0xFF
+
+
+def bitwise_shr(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    reg[reg_a] = reg[reg_a] >> reg[reg_b]
+
+
+def bitwise_mod(cpu, reg_a, reg_b):
+    reg = cpu.reg
+    if reg[reg_b] == 0:
+        raise LS8Error("Division by zero in MOD")
+    reg[reg_a] %= reg[reg_b]
+
+
+def jump(cpu, reg_num, unused_operand):
+    cpu.pc = cpu.reg[reg_num]
+
+
+def make_conditional_jump(mask, when_set):
+    # Taken/not-taken for each of the eight possible FL values
+    taken = tuple(bool(fl & mask) == when_set for fl in range(8))
+
+    def conditional_jump(cpu, reg_num, unused_operand):
+        if taken[cpu.fl]:
+            cpu.pc = cpu.reg[reg_num]
+        else:
+            cpu.pc += 2
+
+    return conditional_jump
+
+
+def interrupt(cpu, reg_num, unused_operand):
+    # set the nth bit of IS, then service it right away if it's unmasked
+    cpu.reg[IS] |= 1 << (cpu.reg[reg_num] & 7)
+    cpu.pc += 2
+    cpu.check_interrupts()
+
+
+def return_from_interrupt(cpu, unused_operand_1, unused_operand_2):
+    reg = cpu.reg
+    ram = cpu.ram
+    sp = reg[SP]
+    # R6-R0, then FL, then PC come back off the stack
+    for r in range(6, -1, -1):
+        reg[r] = ram[sp]
+        sp = (sp + 1) & 0xFF
+    cpu.fl = ram[sp]
+    cpu.pc = ram[(sp + 1) & 0xFF]
+    reg[SP] = (sp + 2) & 0xFF
+    cpu.interrupts_enabled = True
+    cpu.check_interrupts()
+
+
+# Every opcode byte has a slot, unused ones trap to `unknown`
+dispatch_table = isa.dispatch_table({
+    "LDI": ldi,
+    "PRN": prn,
+    "PUSH": push,
+    "POP": pop,
+    "MUL": mul,
+    "ADD": add,
+    "CALL": call,
+    "RET": return_from_call,
+    "CMP": comp,
+    "JMP": jump,
+    "AND": bitwise_and,
+    "OR": bitwise_or,
+    "XOR": bitwise_xor,
+    "NOT": bitwise_not,
+    "SHL": bitwise_shl,
+    "SHR": bitwise_shr,
+    "MOD": bitwise_mod,
+    "SUB": sub,
+    "DIV": div,
+    "INC": inc,
+    "DEC": dec,
+    "LD": ld,
+    "ST": st,
+    "PRA": pra,
+    "NOP": nop,
+    "INT": interrupt,
+    "IRET": return_from_interrupt,
+}, unknown)
+for opcode, (mask, when_set) in JUMP_CONDITIONS.items():
+    dispatch_table[opcode] = make_conditional_jump(mask, when_set)
+
+# For FastCPU(extensions=True): the standard table plus the block instructions
+extended_dispatch_table = list(dispatch_table)
+extended_dispatch_table[COPY] = copy_block
+extended_dispatch_table[FILL] = fill_block
+extended_dispatch_table[PRS] = print_block
+
+
+# Which RAM addresses an instruction may write, worked out before it runs.
+# Debugging tools use this to watch or undo writes without touching the
+# handlers themselves. Opcodes not listed never write RAM.
+
+def stack_push_addresses(cpu, operand_a, operand_b):
+    return ((cpu.reg[SP] - 1) & 0xFF,)
+
+
+def store_addresses(cpu, operand_a, operand_b):
+    return (cpu.reg[operand_a],)
+
+
+def interrupt_frame_addresses(cpu, operand_a, operand_b):
+    # INT can push PC, FL and R0-R6 below the current SP
+    sp = cpu.reg[SP]
+    return tuple((sp - i) & 0xFF for i in range(1, 10))
+
+
+def iret_frame_addresses(cpu, operand_a, operand_b):
+    # IRET pops nine bytes, and a pending interrupt can push nine straight back
+    sp = cpu.reg[SP]
+    return tuple((sp + i) & 0xFF for i in range(9))
+
+
+def block_addresses(cpu, operand_a, operand_b):
+    # COPY and FILL write the range held in rA, rA+1
+    if operand_a >= 7:
+        return ()
+    start = cpu.reg[operand_a]
+    return tuple((start + i) & 0xFF for i in range(cpu.reg[operand_a + 1]))
+
+
+RAM_WRITES = {
+    PUSH: stack_push_addresses,
+    CALL: stack_push_addresses,
+    ST: store_addresses,
+    INT: interrupt_frame_addresses,
+    IRET: iret_frame_addresses,
+    COPY: block_addresses,
+    FILL: block_addresses,
+}
+
+
+class Watchdog:
+    """
+    Spots a CPU that has come back to exactly the same state, which means it
+    will go round the same loop forever.
+
+    The state is hashed every `WATCHDOG_INTERVAL` instructions. The RAM part
+    of the hash is the XOR of a hash per (address, value), kept up to date
+    by wrapping the handlers in `RAM_WRITES`, so a check costs the same no
+    matter how much RAM the program touches. States are compared Brent
+    style: against one saved state, re-saved at doubling distances, so a
+    cycle is found within about twice its length plus however long it took
+    to enter it, in constant memory. A hash match is confirmed against the
+    saved snapshot.
+
+    Loops that print, or that run with interrupts unmasked in IM (a program
+    waiting for a key or a timer), are never reported.
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.ram_hash = 0
+        for address, value in enumerate(cpu.ram):
+            self.ram_hash ^= hash((address, value))
+        # Bumped by PRN/PRA/PRS
+        self.output = 0
+        # Brent's saved state: (hash, snapshot, output count, cycles)
+        self.saved = None
+        self.power = 1
+        self.steps = 0
+
+    def wrap(self, table):
+        """A copy of `table` that keeps `ram_hash` and `output` up to date."""
+
+        table = list(table)
+        for opcode, write_addresses in RAM_WRITES.items():
+            table[opcode] = self.make_hashing(table[opcode], write_addresses)
+        for opcode in (PRN, PRA, PRS):
+            table[opcode] = self.make_counting(table[opcode])
+        return table
+
+    def make_hashing(self, original, write_addresses):
+        def hashing(cpu, operand_a, operand_b):
+            ram = cpu.ram
+            addresses = write_addresses(cpu, operand_a, operand_b)
+            h = self.ram_hash
+            for address in addresses:
+                h ^= hash((address, ram[address]))
+            original(cpu, operand_a, operand_b)
+            for address in addresses:
+                h ^= hash((address, ram[address]))
+            self.ram_hash = h
+
+        return hashing
+
+    def make_counting(self, original):
+        def counting(cpu, operand_a, operand_b):
+            self.output += 1
+            original(cpu, operand_a, operand_b)
+
+        return counting
+
+    def state_hash(self):
+        cpu = self.cpu
+        return self.ram_hash ^ hash((cpu.pc & 0xFF, tuple(cpu.reg), cpu.fl, cpu.interrupts_enabled))
+
+    def check(self):
+        """True if the CPU is back in the saved state."""
+
+        cpu = self.cpu
+        if cpu.reg[IM]:
+            self.saved = None
+            return False
+
+        h = self.state_hash()
+        saved = self.saved
+        if (saved is not None and h == saved[0] and self.output == saved[2] and
+                cpu.snapshot()[:-8] == saved[1]):
+            return True
+
+        self.steps += 1
+        if saved is None or self.steps >= self.power:
+            self.saved = (h, cpu.snapshot()[:-8], self.output, cpu.cycles)
+            self.power *= 2
+            self.steps = 0
+        return False
+
+    def loop_range(self):
+        """
+        Return the lowest and highest PC of the loop the CPU is stuck in.
+        It is stepped once round, back to the state it is in now, and then
+        restored, so its cycle count doesn't include the trip.
+        """
+
+        cpu = self.cpu
+        start = cpu.snapshot()
+        state = start[:-8]
+        h = self.state_hash()
+        low = high = cpu.pc & 0xFF
+        # The period divides the distance back to the saved state
+        for _ in range(cpu.cycles - self.saved[3]):
+            cpu.execute(1)
+            pc = cpu.pc & 0xFF
+            low = min(low, pc)
+            high = max(high, pc)
+            if self.state_hash() == h and cpu.snapshot()[:-8] == state:
+                break
+        cpu.restore(start)
+        return low, high
+
+
+def parse_program(lines, name = "<program>"):
+    """Turn the lines of an `.ls8` file into a list of byte values."""
+
+    image = []
+    for line_num, line in enumerate(lines, 1):
+        command = line.split('#')[0].strip()
+
+        if command == '':
+            continue
+
+        try:
+            image.append(int(command, 2))
+        except ValueError:
+            raise ProgramLoadError(f"{name}:{line_num}: invalid instruction {command!r}") from None
+
+    return image
+
+
+class FastCPU:
+    """
+    CPU with slotted state and list-based dispatch.
+
+    Besides `load`/`run`/`trace` it can be embedded in a host process:
+    `step(n)` executes a bounded number of instructions and `run()` accepts
+    limits and returns a `RunResult`. Errors are raised as `LS8Error`
+    subclasses, never by exiting the process.
+    """
+
+    __slots__ = ('ram', 'reg', 'pc', 'fl', 'cycles', 'halted',
+                 'interrupts_enabled', 'out', 'dispatch')
+
+    def __init__(self, extensions = False):
+        """Construct a new CPU, running isa.EXTENSIONS too if `extensions` is set."""
+        self.ram = bytearray(256)
+        self.reg = [0] * 8
+        self.reset()
+        # Where PRN/PRA print to, None means the current sys.stdout
+        self.out = None
+        # Shared module table unless a debugger swaps in its own copy
+        self.dispatch = extended_dispatch_table if extensions else dispatch_table
+
+    def reset(self):
+        """
+        Back to the power-on state, reusing the existing RAM and register
+        storage. `out` and `dispatch` are left alone.
+        """
+        # * RAM is cleared to `0`, one byte per address 00-FF.
+        self.ram[:] = bytes(len(self.ram))
+        # * `R0`-`R6` are cleared to `0`, `R7` (SP) is set to `0xF4`.
+        self.reg[:] = [0] * 8
+        self.reg[SP] = 0xF4
+        # * `PC` and `FL` registers are cleared to `0`.
+        self.pc = 0
+        self.fl = 0
+        # Instructions executed since power on, and whether HLT was reached
+        self.cycles = 0
+        self.halted = False
+        self.interrupts_enabled = True
+
+    def ram_read(self, MAR):
+        return self.ram[MAR]
+
+    def ram_write(self, MAR, MDR):
+        self.ram[MAR] = MDR & 0xFF
+
+    def load(self, program):
+        """Load a program from an `.ls8` file into memory."""
+
+        try:
+            with open(program) as file:
+                image = parse_program(file, program)
+        except OSError as e:
+            raise ProgramLoadError(f"{program}: {e.strerror}") from e
+
+        self.load_image(image)
+
+    def load_image(self, image):
+        """Load a program from a sequence of byte values into memory."""
+
+        if len(image) > len(self.ram):
+            raise ProgramLoadError(f"program is {len(image)} bytes, RAM is {len(self.ram)}")
+
+        try:
+            self.ram[:len(image)] = bytes(image)
+        except ValueError as e:
+            raise ProgramLoadError(f"invalid program byte: {e}") from e
+
+    def snapshot(self):
+        """Full machine state as `SNAPSHOT_SIZE` bytes."""
+
+        return (bytes(self.ram) + bytes(self.reg) +
+                bytes((self.pc & 0xFF, self.fl, self.interrupts_enabled, self.halted)) +
+                self.cycles.to_bytes(8, 'little'))
+
+    def restore(self, snapshot):
+        """Put the machine back to a state taken with `snapshot()`."""
+
+        self.ram[:] = snapshot[0:256]
+        self.reg[:] = snapshot[256:264]
+        self.pc, self.fl, interrupts_enabled, halted = snapshot[264:268]
+        self.interrupts_enabled = bool(interrupts_enabled)
+        self.halted = bool(halted)
+        self.cycles = int.from_bytes(snapshot[268:276], 'little')
+
+    def post_interrupt(self, n):
+        """Raise interrupt `n` from outside, e.g. a timer tick."""
+
+        self.reg[IS] |= 1 << n
+
+    def post_key(self, key):
+        """Store a key press at 0xF4 and raise the keyboard interrupt."""
+
+        self.ram[KEY_PRESSED] = key & 0xFF
+        self.reg[IS] |= 1 << KEYBOARD_INTERRUPT
+
+    def check_interrupts(self):
+        """
+        Service the lowest pending unmasked interrupt, if interrupts are
+        enabled. Returns True if the PC was moved to a handler.
+        """
+
+        reg = self.reg
+        masked_interrupts = reg[IM] & reg[IS]
+        if not masked_interrupts or not self.interrupts_enabled:
+            return False
+
+        # lowest set bit wins
+        n = (masked_interrupts & -masked_interrupts).bit_length() - 1
+        self.interrupts_enabled = False
+        reg[IS] &= ~(1 << n) & 0xFF
+
+        ram = self.ram
+        sp = reg[SP]
+        # PC, FL, then R0-R6 go onto the stack
+        for value in [self.pc & 0xFF, self.fl] + reg[0:7]:
+            sp = (sp - 1) & 0xFF
+            ram[sp] = value
+        reg[SP] = sp
+
+        self.pc = ram[VECTOR_TABLE + n]
+        return True
+
+    def trace(self):
+        """
+        Handy function to print out the CPU state. You might want to call this
+        from run() if you need help debugging.
+        """
+
+        ram = self.ram
+        pc = self.pc & 0xFF
+        print(f"TRACE: %02X %02X | %02X %02X %02X |" % (
+            pc,
+            self.fl,
+            ram[pc],
+            ram[(pc + 1) & 0xFF],
+            ram[(pc + 2) & 0xFF]
+        ), end='')
+
+        for i in range(8):
+            print(" %02X" % self.reg[i], end='')
+
+        print()
+
+    def bad_operand(self):
+        # Register operands are 00000rrr, anything bigger is garbage code
+        pc = self.pc & 0xFF
+        return InvalidInstruction(f"Bad register operand in {self.ram[pc]:08b} at {pc:02X}")
+
+    def execute(self, limit, until_pc = None):
+        """
+        Execute at most `limit` instructions, stopping early on HLT or when
+        an instruction leaves the PC at `until_pc`. Returns the number of
+        instructions executed and the stop reason, or None if `limit` ran out.
+        """
+
+        ram = self.ram
+        reg = self.reg
+        table = self.dispatch
+        advance = ADVANCE
+        executed = 0
+        reason = None
+        try:
+            while executed < limit:
+                # Checked before every instruction, so when an interrupt is
+                # taken doesn't depend on how the run is sliced up
+                if reg[IM] & reg[IS]:
+                    self.check_interrupts()
+                pc = self.pc & 0xFF
+                ir = ram[pc]
+                if ir == HLT:
+                    self.halted = True
+                    reason = HALTED
+                    break
+                table[ir](self, ram[(pc + 1) & 0xFF], ram[(pc + 2) & 0xFF])
+                self.pc += advance[ir]
+                executed += 1
+                if self.pc == until_pc:
+                    reason = UNTIL_PC
+                    break
+        except Trap as trap:
+            if trap.executed:
+                self.pc += advance[ir]
+                executed += 1
+            reason = trap.reason
+        except IndexError:
+            raise self.bad_operand() from None
+        finally:
+            self.cycles += executed
+
+        return executed, reason
+
+    def step(self, n = 1):
+        """Execute up to `n` instructions. Returns how many actually ran."""
+
+        return self.execute(n)[0]
+
+    def run(self, max_cycles = None, until_pc = None, timeout = None, watchdog = False):
+        """
+        Run the CPU until HLT, or until one of the optional limits is hit:
+
+        * `max_cycles`: number of instructions to execute
+        * `until_pc`: stop once an instruction leaves the PC at this address
+        * `timeout`: wall-clock seconds
+        * `watchdog`: stop with NON_TERMINATING as soon as the machine is
+          seen in exactly the same state twice (see `Watchdog`)
+
+        Returns a `RunResult(reason, cycles, elapsed, loop)`.
+        """
+
+        start = time.perf_counter()
+
+        if max_cycles is None and until_pc is None and timeout is None and not watchdog:
+            executed, reason = self.run_to_halt()
+            return RunResult(reason, executed, time.perf_counter() - start)
+
+        if watchdog:
+            dog = Watchdog(self)
+            table = self.dispatch
+            self.dispatch = dog.wrap(table)
+
+        remaining = max_cycles if max_cycles is not None else float("inf")
+        deadline = start + timeout if timeout is not None else None
+        executed = 0
+        loop = None
+        try:
+            while True:
+                if remaining <= 0:
+                    reason = MAX_CYCLES
+                    break
+                limit = remaining
+                if deadline is not None:
+                    if time.perf_counter() >= deadline:
+                        reason = TIMEOUT
+                        break
+                    limit = min(limit, TIMEOUT_CHECK_INTERVAL)
+                if watchdog:
+                    limit = min(limit, WATCHDOG_INTERVAL)
+                n, reason = self.execute(limit, until_pc)
+                executed += n
+                remaining -= n
+                if reason is not None:
+                    break
+                if watchdog and dog.check():
+                    loop = dog.loop_range()
+                    reason = NON_TERMINATING
+                    break
+        finally:
+            if watchdog:
+                self.dispatch = table
+
+        return RunResult(reason, executed, time.perf_counter() - start, loop)
+
+    def run_to_halt(self):
+        """
+        Unbounded run loop. Returns the number of instructions executed and
+        the stop reason, which is HALTED unless a trap fired.
+        """
+
+        ram = self.ram
+        reg = self.reg
+        table = self.dispatch
+        advance = ADVANCE
+        executed = 0
+        try:
+            while True:
+                if reg[IM] & reg[IS]:
+                    self.check_interrupts()
+                pc = self.pc & 0xFF
+                ir = ram[pc]
+                if ir == HLT:
+                    break
+                table[ir](self, ram[(pc + 1) & 0xFF], ram[(pc + 2) & 0xFF])
+                self.pc += advance[ir]
+                executed += 1
+            self.halted = True
+        except Trap as trap:
+            if trap.executed:
+                self.pc += advance[ir]
+                executed += 1
+            return executed, trap.reason
+        except IndexError:
+            raise self.bad_operand() from None
+        finally:
+            self.cycles += executed
+
+        return executed, HALTED
+
+    def iter_output(self, max_cycles = None):
+        """
+        Run lazily, yielding each value as it is printed: an int for PRN, a
+        one-character string for PRA (and the whole string for PRS).
+        Nothing is written to `out`. The
+        machine stops right after the printing instruction and only runs on
+        when the next value is asked for, so a consumer that stops early
+        leaves it paused there; `run()` or another `iter_output()` carries
+        on from the same place.
+
+        The generator returns a `RunResult` for the whole run once the
+        program halts, `max_cycles` instructions have run or a trap fires.
+        """
+
+        start = time.perf_counter()
+        table = self.dispatch
+        printed = []
+
+        def print_number(cpu, reg_num, unused_operand):
+            printed.append(cpu.reg[reg_num])
+            raise Trap(OUTPUT, executed=True)
+
+        def print_char(cpu, reg_num, unused_operand):
+            printed.append(chr(cpu.reg[reg_num]))
+            raise Trap(OUTPUT, executed=True)
+
+        def print_string(cpu, reg_a, unused_operand):
+            printed.append(read_block(cpu.ram, cpu.reg[reg_a], cpu.reg[reg_a + 1]).decode('latin-1'))
+            raise Trap(OUTPUT, executed=True)
+
+        capturing = list(table)
+        capturing[PRN] = print_number
+        capturing[PRA] = print_char
+        if table[PRS] is print_block:
+            capturing[PRS] = print_string
+
+        remaining = max_cycles
+        executed = 0
+        while remaining is None or remaining > 0:
+            self.dispatch = capturing
+            try:
+                if remaining is None:
+                    n, reason = self.run_to_halt()
+                else:
+                    n, reason = self.execute(remaining)
+                    remaining -= n
+            finally:
+                # Put the caller's table back while paused, too
+                self.dispatch = table
+            executed += n
+            if reason != OUTPUT:
+                break
+            yield printed.pop()
+        else:
+            reason = MAX_CYCLES
+
+        return RunResult(reason or MAX_CYCLES, executed, time.perf_counter() - start)
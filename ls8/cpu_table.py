@@ -1,297 +1,281 @@
-"""CPU functionality."""
-
-import sys
-
-HLT = 1
-LDI = 10000010 
-PRN = 1000111
-PUSH = 1000101 
-POP = 1000110 
-MUL = 10100010
-ADD = 10100000
-CALL = 1010000
-RET = 10001 
-CMP = 10100111
-JMP = 1010100
-JEQ = 1010101
-JNE = 1010110
-AND = 10101000
-OR = 10101010
-XOR = 10101011
-NOT = 1101001
-SHL = 10101100
-SHR = 10101101
-MOD = 10100100
-
-class CPU:
-    """Main CPU class."""
-
-    def __init__(self):
-        """Construct a new CPU."""
-        # +-----------------------+
-        # | FF  I7 vector         |    Interrupt vector table
-        # | FE  I6 vector         |
-        # | FD  I5 vector         |
-        # | FC  I4 vector         |
-        # | FB  I3 vector         |
-        # | FA  I2 vector         |
-        # | F9  I1 vector         |
-        # | F8  I0 vector         |
-        # | F7  Reserved          |
-        # | F6  Reserved          |
-        # | F5  Reserved          |
-        # | F4  Key pressed       |    Holds the most recent key pressed on the keyboard
-        # | F3  Start of Stack    |
-        # | F2  [more stack]      |    Stack grows down
-        # | ...                   |
-        # | 01  [more program]    |
-        # | 00  Program entry     |    Program loaded upward in memory starting at 0
-        # +-----------------------+
-        # * RAM is cleared to `0`.
-        self.ram = [0] * 0xFF
-        # * `R0`-`R6` are cleared to `0`.
-        #R5 is reserved as the interrupt mask (IM)
-        #R6 is reserved as the interrupt status (IS)
-        #R7 is reserved as the stack pointer (SP)
-        self.reg = [0] * 8
-        # * `R7` is set to `0xF4`.
-        self.reg[7] = 0xF4
-        # `PC`: Program Counter, address of the currently executing instruction
-        # * `PC` and `FL` registers are cleared to `0`.
-        self.pc = 0
-        # * `FL`: Flags, see below  
-        self.fl = [0] * 8
-        self.dispach_table = {
-            LDI: self.ldi,
-            PRN: self.prn,
-            PUSH: self.push,
-            POP: self.pop,
-            MUL: self.alu,
-            ADD: self.alu,
-            CALL: self.call,
-            RET: self.return_from_call,
-            CMP: self.alu,
-            JMP: self.jump,
-            JEQ: self.jump_if_equal,
-            JNE: self.jump_not_equal,
-            CMP: self.alu,
-            AND: self.alu,
-            OR: self.alu,
-            XOR: self.alu,
-            NOT: self.alu,
-            SHL: self.alu,
-            SHR: self.alu,
-            MOD: self.alu
-        }
-        self.alu_dispach_table = {
-            ADD: self.add,
-            MUL: self.mul,
-            CMP: self.comp,
-            AND: self.bitwise_and,
-            OR: self.bitwise_or,
-            XOR: self.bitwise_xor,
-            NOT: self.bitwise_not,
-            SHL: self.bitwise_shl,
-            SHR: self.bitwise_shr,
-            MOD: self.bitwise_mod
-        }
-        
-    # Inside the CPU, there are two internal registers used for memory operations: the Memory Address Register (MAR) and the Memory Data Register (MDR). The MAR contains the address that is being read or written to. The MDR contains the data that was read or the data to write. You don't need to add the MAR or MDR to your CPU class, but they would make handy parameter names for ram_read() and ram_write(), if you wanted.   
-    # * `MAR`: Memory Address Register, holds the memory address we're reading or writing
-    # * `MDR`: Memory Data Register, holds the value to write or the value just read
-
-    def ram_read(self, MAR): 
-    # should accept the address to read and return the value stored there.
-        if MAR < len(self.ram):
-            return self.ram[MAR]
-        else:
-            return None
-
-    def ram_write(self, MAR, MDR): 
-    # should accept a value to write, and the address to write it to. 
-        self.ram[MAR] = MDR
-
-    def load(self, program = None):
-        """Load a program into memory."""
-
-        if len(sys.argv) < 2:
-            print("Please pass in a second filename: python3 in_and_out.py second_filename.py")
-            sys.exit()
-
-        try:
-            address = 0
-            with open(program) as file:
-                for line in file:
-                    split_line = line.split('#')[0]
-                    command = split_line.strip()
-
-                    if command == '':
-                        continue
-
-                    instruction = int(command)
-                    self.ram_write(address, instruction)
-
-                    address += 1
-
-        except FileNotFoundError:
-            print(f'{sys.argv[0]}: {sys.argv[1]} file was not found')
-            sys.exit()
-
-    def alu(self, operand_a, operand_b):
-        """ALU operations."""  
-        ir = self.ram_read(self.pc)
-        if ir in self.alu_dispach_table:
-            self.alu_dispach_table[ir](operand_a, operand_b)
-        else:
-            raise Exception("Unsupported ALU operation")
-
-    def add(self, reg_a, reg_b):
-        self.reg[reg_a] += self.reg[reg_b]
-        self.pc += 3
-
-    def mul(self, reg_a, reg_b):
-        self.reg[reg_a] *= self.reg[reg_b]
-        self.pc += 3
-
-    def comp(self, reg_a, reg_b):
-        self.fl[5] = 0
-        self.fl[6] = 0
-        self.fl[7] = 0
-        if self.reg[reg_a] < self.reg[reg_b]:
-            self.fl[5] = 1
-        elif self.reg[reg_a] > self.reg[reg_b]:
-            self.fl[6] = 1
-        elif self.reg[reg_a] == self.reg[reg_b]:
-            self.fl[7] = 1
-        self.pc += 3
-
-    def bitwise_and(self, reg_a, reg_b):
-        self.reg[reg_a] = self.reg[reg_a] & self.reg[reg_b]
-        self.pc += 3
-
-    def bitwise_or(self, reg_a, reg_b):
-        self.reg[reg_a] = self.reg[reg_a] | self.reg[reg_b]
-        self.pc += 3
-
-    def bitwise_xor(self, reg_a, reg_b):
-        self.reg[reg_a] = self.reg[reg_a] ^ self.reg[reg_b]
-        self.pc += 3
-
-    def bitwise_not(self, reg_a, unused_operand):
-        self.reg[reg_a] = ~self.reg[reg_a]
-        self.pc += 2
-
-    def bitwise_shl(self, reg_a, reg_b):
-        pass
-
-    def bitwise_shr(self, reg_a, reg_b):
-        pass
-
-    def bitwise_mod(self):
-        pass
-
-        """
-        Handy function to print out the CPU state. You might want to call this
-        from run() if you need help debugging.
-        """
-
-        print(f"TRACE: %02X | %02X %02X %02X |" % (
-            self.pc,
-            #self.fl,
-            #self.ie,
-            self.ram_read(self.pc),
-            self.ram_read(self.pc + 1),
-            self.ram_read(self.pc + 2)
-        ), end='')
-
-        for i in range(8):
-            print(" %02X" % self.reg[i], end='')
-
-        print()
-    
-    def convert(self, binary):
-        binary_str = str(binary)
-        binary_str.replace("0b", '')
-        return int(binary_str, 2) 
-
-    def ldi(self, reg_num, value):
-        self.reg[reg_num] = value
-        self.pc += 3
-
-    def prn(self, reg_num, unused_operand):
-        print(self.reg[reg_num])
-        self.pc += 2
-
-    def push(self, reg_num, unused_operand):
-        # decrement the stack pointer
-        self.reg[7] -= 1
-        # get a value from the given register
-        value = self.reg[reg_num]
-        # put the value at the stack pointer address
-        sp = self.reg[7]
-        self.ram_write(sp, value)
-        self.pc += 2
-
-    def pop(self, reg_num, unused_operand):
-        # get the stack pointer (where do we look?)
-        sp = self.reg[7]
-        # use stack pointer to get the value
-        value = self.ram_read(sp)
-        # put the value into the given register
-        self.reg[reg_num] = value
-        # increment our stack pointer
-        self.reg[7] += 1
-        self.pc += 2
-
-    def call(self, reg_num, unused_operand):
-        ### get the address to jump to, from the register
-        address = self.reg[reg_num]
-        ### push command after CALL onto the stack
-        return_address = self.pc+2
-        ### decrement stack pointer
-        self.reg[7] -= 1
-        sp = self.reg[7]
-        ### put return address on the stack
-        self.ram_write(sp, return_address)
-        ### then look at register, jump to that address
-        self.pc = address
-
-    def return_from_call(self, unused_operand_1, unused_operand_2):
-        # pop the return address off the stack
-        sp = self.reg[7]
-        return_address = self.ram_read(sp)
-        self.ram_write(sp, return_address)
-        self.reg[7] += 1
-        # go to return address: set the pc to return address
-        self.pc = return_address
-
-    def jump(self, reg_num, unused_operand):
-        ### get the address to jump to, from the register
-        address = self.reg[reg_num]
-        ### then look at register, jump to that address
-        self.pc = address
-    
-    def jump_if_equal(self, reg_num, unused_operand):
-        if self.fl[7] == 1:
-            self.jump(reg_num, unused_operand)
-        elif self.fl[7] == 0:
-            self.pc += 2
-
-    def jump_not_equal(self, reg_num, unused_operand):
-        if self.fl[7] == 0:
-            self.jump(reg_num, unused_operand)
-        elif self.fl[7] == 1:
-            self.pc += 2
-
-
-    def run(self):
-        """Run the CPU."""
-        # * `IR`: Instruction Register, contains a copy of the currently executing instruction
-        ir = self.ram_read(self.pc)
-        while ir != HLT:
-            # Using ram_read(), read the bytes at PC+1 and PC+2 from RAM into variables operand_a and operand_b in case the instruction needs them.
-            operand_a = self.convert(self.ram_read(self.pc+1))
-            operand_b = self.convert(self.ram_read(self.pc+2))
-
-            self.dispach_table[ir](operand_a, operand_b)
+"""CPU functionality."""
+
+from isa import (HLT, LDI, PRN, PUSH, POP, MUL, ADD, CALL, RET, CMP, JMP,
+                 JEQ, JNE, JGT, JLT, JLE, JGE, AND, OR, XOR, NOT, SHL, SHR,
+                 MOD, ADVANCE)
+
+# `FL` bits: `00000LGE`
+FL_L = 0b100
+FL_G = 0b010
+FL_E = 0b001
+
+# Which FL bits each conditional jump tests, and whether it jumps when any of
+# them is set (True) or when all of them are clear (False)
+JUMP_CONDITIONS = {
+    "JEQ": (FL_E, True),
+    "JNE": (FL_E, False),
+    "JGT": (FL_G, True),
+    "JLT": (FL_L, True),
+    "JGE": (FL_G | FL_E, True),
+    "JLE": (FL_L | FL_E, True),
+}
+
+# Expanded to a taken/not-taken tuple indexed by the FL byte
+JUMP_TAKEN = {
+    name: tuple(bool(fl & mask) == when_set for fl in range(8))
+    for name, (mask, when_set) in JUMP_CONDITIONS.items()
+}
+
+class CPU:
+    """Main CPU class."""
+
+    def __init__(self):
+        """Construct a new CPU."""
+        # +-----------------------+
+        # | FF  I7 vector         |    Interrupt vector table
+        # | FE  I6 vector         |
+        # | FD  I5 vector         |
+        # | FC  I4 vector         |
+        # | FB  I3 vector         |
+        # | FA  I2 vector         |
+        # | F9  I1 vector         |
+        # | F8  I0 vector         |
+        # | F7  Reserved          |
+        # | F6  Reserved          |
+        # | F5  Reserved          |
+        # | F4  Key pressed       |    Holds the most recent key pressed on the keyboard
+        # | F3  Start of Stack    |
+        # | F2  [more stack]      |    Stack grows down
+        # | ...                   |
+        # | 01  [more program]    |
+        # | 00  Program entry     |    Program loaded upward in memory starting at 0
+        # +-----------------------+
+        # * RAM is cleared to `0`.
+        self.ram = [0] * 0xFF
+        # * `R0`-`R6` are cleared to `0`.
+        #R5 is reserved as the interrupt mask (IM)
+        #R6 is reserved as the interrupt status (IS)
+        #R7 is reserved as the stack pointer (SP)
+        self.reg = [0] * 8
+        # * `R7` is set to `0xF4`.
+        self.reg[7] = 0xF4
+        # `PC`: Program Counter, address of the currently executing instruction
+        # * `PC` and `FL` registers are cleared to `0`.
+        self.pc = 0
+        # * `FL`: Flags `00000LGE`, packed into a single byte
+        self.fl = 0
+        self.dispach_table = {
+            LDI: self.ldi,
+            PRN: self.prn,
+            PUSH: self.push,
+            POP: self.pop,
+            MUL: self.alu,
+            ADD: self.alu,
+            CALL: self.call,
+            RET: self.return_from_call,
+            CMP: self.alu,
+            JMP: self.jump,
+            JEQ: self.conditional_jump,
+            JNE: self.conditional_jump,
+            JGT: self.conditional_jump,
+            JLT: self.conditional_jump,
+            JGE: self.conditional_jump,
+            JLE: self.conditional_jump,
+            CMP: self.alu,
+            AND: self.alu,
+            OR: self.alu,
+            XOR: self.alu,
+            NOT: self.alu,
+            SHL: self.alu,
+            SHR: self.alu,
+            MOD: self.alu
+        }
+        self.alu_dispach_table = {
+            ADD: self.add,
+            MUL: self.mul,
+            CMP: self.comp,
+            AND: self.bitwise_and,
+            OR: self.bitwise_or,
+            XOR: self.bitwise_xor,
+            NOT: self.bitwise_not,
+            SHL: self.bitwise_shl,
+            SHR: self.bitwise_shr,
+            MOD: self.bitwise_mod
+        }
+        # For each conditional jump, whether it is taken for each of the
+        # eight possible FL values
+        self.jump_condition_table = {
+            JEQ: JUMP_TAKEN["JEQ"],
+            JNE: JUMP_TAKEN["JNE"],
+            JGT: JUMP_TAKEN["JGT"],
+            JLT: JUMP_TAKEN["JLT"],
+            JGE: JUMP_TAKEN["JGE"],
+            JLE: JUMP_TAKEN["JLE"],
+        }
+
+    # Inside the CPU, there are two internal registers used for memory operations: the Memory Address Register (MAR) and the Memory Data Register (MDR). The MAR contains the address that is being read or written to. The MDR contains the data that was read or the data to write. You don't need to add the MAR or MDR to your CPU class, but they would make handy parameter names for ram_read() and ram_write(), if you wanted.   
+    # * `MAR`: Memory Address Register, holds the memory address we're reading or writing
+    # * `MDR`: Memory Data Register, holds the value to write or the value just read
+
+    def ram_read(self, MAR): 
+    # should accept the address to read and return the value stored there.
+        if MAR < len(self.ram):
+            return self.ram[MAR]
+        else:
+            return None
+
+    def ram_write(self, MAR, MDR): 
+    # should accept a value to write, and the address to write it to. 
+        self.ram[MAR] = MDR
+
+    def load(self, program = None):
+        """Load a program into memory. Raises FileNotFoundError if it's missing."""
+
+        address = 0
+        with open(program) as file:
+            for line in file:
+                split_line = line.split('#')[0]
+                command = split_line.strip()
+
+                if command == '':
+                    continue
+
+                instruction = int(command, 2)
+                self.ram_write(address, instruction)
+
+                address += 1
+
+    def alu(self, operand_a, operand_b):
+        """ALU operations."""  
+        ir = self.ram_read(self.pc)
+        if ir in self.alu_dispach_table:
+            self.alu_dispach_table[ir](operand_a, operand_b)
+        else:
+            raise Exception("Unsupported ALU operation")
+
+    def add(self, reg_a, reg_b):
+        self.reg[reg_a] += self.reg[reg_b]
+
+    def mul(self, reg_a, reg_b):
+        self.reg[reg_a] *= self.reg[reg_b]
+
+    def comp(self, reg_a, reg_b):
+        a = self.reg[reg_a]
+        b = self.reg[reg_b]
+        self.fl = (a < b) << 2 | (a > b) << 1 | (a == b)
+
+    def bitwise_and(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] & self.reg[reg_b]
+
+    def bitwise_or(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] | self.reg[reg_b]
+
+    def bitwise_xor(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] ^ self.reg[reg_b]
+
+    def bitwise_not(self, reg_a, unused_operand):
+        self.reg[reg_a] = ~self.reg[reg_a]
+
+    def bitwise_shl(self, reg_a, reg_b):
+        pass
+
+    def bitwise_shr(self, reg_a, reg_b):
+        pass
+
+    def bitwise_mod(self):
+        pass
+
+    def trace(self):
+        """
+        Handy function to print out the CPU state. You might want to call this
+        from run() if you need help debugging.
+        """
+
+        print(f"TRACE: %02X %02X | %02X %02X %02X |" % (
+            self.pc,
+            self.fl,
+            self.ram_read(self.pc),
+            self.ram_read(self.pc + 1),
+            self.ram_read(self.pc + 2)
+        ), end='')
+
+        for i in range(8):
+            print(" %02X" % self.reg[i], end='')
+
+        print()
+    
+    def ldi(self, reg_num, value):
+        self.reg[reg_num] = value
+
+    def prn(self, reg_num, unused_operand):
+        print(self.reg[reg_num])
+
+    def push(self, reg_num, unused_operand):
+        # decrement the stack pointer
+        self.reg[7] -= 1
+        # get a value from the given register
+        value = self.reg[reg_num]
+        # put the value at the stack pointer address
+        sp = self.reg[7]
+        self.ram_write(sp, value)
+
+    def pop(self, reg_num, unused_operand):
+        # get the stack pointer (where do we look?)
+        sp = self.reg[7]
+        # use stack pointer to get the value
+        value = self.ram_read(sp)
+        # put the value into the given register
+        self.reg[reg_num] = value
+        # increment our stack pointer
+        self.reg[7] += 1
+
+    def call(self, reg_num, unused_operand):
+        ### get the address to jump to, from the register
+        address = self.reg[reg_num]
+        ### push command after CALL onto the stack
+        return_address = self.pc+2
+        ### decrement stack pointer
+        self.reg[7] -= 1
+        sp = self.reg[7]
+        ### put return address on the stack
+        self.ram_write(sp, return_address)
+        ### then look at register, jump to that address
+        self.pc = address
+
+    def return_from_call(self, unused_operand_1, unused_operand_2):
+        # pop the return address off the stack
+        sp = self.reg[7]
+        return_address = self.ram_read(sp)
+        self.ram_write(sp, return_address)
+        self.reg[7] += 1
+        # go to return address: set the pc to return address
+        self.pc = return_address
+
+    def jump(self, reg_num, unused_operand):
+        ### get the address to jump to, from the register
+        address = self.reg[reg_num]
+        ### then look at register, jump to that address
+        self.pc = address
+    
+    def conditional_jump(self, reg_num, unused_operand):
+        ir = self.ram_read(self.pc)
+        if self.jump_condition_table[ir][self.fl]:
+            self.jump(reg_num, unused_operand)
+        else:
+            self.pc += 2
+
+
+    def run(self):
+        """Run the CPU."""
+        # * `IR`: Instruction Register, contains a copy of the currently executing instruction
+        ir = self.ram_read(self.pc)
+        while ir != HLT:
+            # Using ram_read(), read the bytes at PC+1 and PC+2 from RAM into variables operand_a and operand_b in case the instruction needs them.
+            operand_a = self.ram_read(self.pc+1)
+            operand_b = self.ram_read(self.pc+2)
+
+            self.dispach_table[ir](operand_a, operand_b)
+            # Jumps and calls set the PC themselves, everything else moves
+            # past its operands (worked out from the opcode bits, see isa.py)
+            self.pc += ADVANCE[ir]
             ir = self.ram_read(self.pc)
\ No newline at end of file
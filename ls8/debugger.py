@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+"""Breakpoints and watchpoints for FastCPU.
+
+    python3 debugger.py program.ls8
+
+Nothing here adds a check to the interpreter loop. The debugger gives the CPU
+its own copy of the dispatch table in which only the opcodes that matter are
+swapped for trap handlers:
+
+* a PC breakpoint traps the opcode currently stored at that address
+* a breakpoint with no address (break whenever a condition holds) traps
+  every opcode
+* a watchpoint traps the opcodes that write RAM (`cpu_fast.RAM_WRITES`)
+
+With nothing set, the CPU gets the shared module table back and runs at full
+speed. Traps raise `cpu_fast.Trap`, which `FastCPU.run` turns into a
+BREAKPOINT or WATCHPOINT stop reason.
+
+Scripting:
+
+    dbg = Debugger(cpu)
+    dbg.break_at(0x18)
+    dbg.break_at(0x18, reg_equals(0, 30))
+    dbg.watch(0xF0, 0xF3)
+    result = dbg.cont()
+"""
+
+import sys
+import time
+
+from disasm import Disassembler
+from cpu_fast import (FastCPU, LS8Error, Trap, RunResult, BREAKPOINT, WATCHPOINT,
+                      HALTED, RAM_WRITES)
+
+
+def reg_equals(reg_num, value):
+    """Condition: register `reg_num` holds `value`."""
+
+    return lambda cpu: cpu.reg[reg_num] == value
+
+
+class Breakpoint:
+    __slots__ = ('number', 'pc', 'condition', 'hits')
+
+    def __init__(self, number, pc, condition):
+        self.number = number
+        self.pc = pc
+        self.condition = condition
+        self.hits = 0
+
+
+class Watchpoint:
+    __slots__ = ('number', 'start', 'end', 'hits')
+
+    def __init__(self, number, start, end):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.hits = 0
+
+
+class Debugger:
+    """Attach to a FastCPU and stop it on breakpoints and watchpoints."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.breakpoints = {}
+        self.watchpoints = {}
+        self.next_number = 1
+        # What made the CPU stop last, for the REPL to report
+        self.last_hit = None
+        # PC of the last breakpoint stop, so `cont` can step off it
+        self.break_pc = None
+        # The table traps are added to, restored once there are none
+        self.base = cpu.dispatch
+        # The table without breakpoint traps, for stepping off a breakpoint
+        self.step_table = cpu.dispatch
+
+    # --- setting and clearing ------------------------------------------
+
+    def break_at(self, pc = None, condition = None):
+        """
+        Stop before the instruction at `pc` executes, if `condition(cpu)` is
+        true (or there's no condition). With `pc` None, stop before any
+        instruction for which the condition holds.
+        """
+
+        if pc is None and condition is None:
+            raise ValueError("a breakpoint needs an address, a condition or both")
+
+        bp = Breakpoint(self.next_number, pc, condition)
+        self.breakpoints[bp.number] = bp
+        self.next_number += 1
+        self.install()
+        return bp.number
+
+    def watch(self, start, end = None):
+        """Stop after any instruction writes RAM in `start`..`end` inclusive."""
+
+        wp = Watchpoint(self.next_number, start, start if end is None else end)
+        self.watchpoints[wp.number] = wp
+        self.next_number += 1
+        self.install()
+        return wp.number
+
+    def delete(self, number):
+        self.breakpoints.pop(number, None)
+        self.watchpoints.pop(number, None)
+        self.install()
+
+    # --- trap handlers -------------------------------------------------
+
+    def make_break_trap(self, original):
+        cpu_breakpoints = self.breakpoints
+
+        def break_trap(cpu, operand_a, operand_b):
+            pc = cpu.pc & 0xFF
+            for bp in cpu_breakpoints.values():
+                if bp.pc is not None and bp.pc != pc:
+                    continue
+                if bp.condition is None or bp.condition(cpu):
+                    bp.hits += 1
+                    self.last_hit = bp
+                    self.break_pc = pc
+                    raise Trap(BREAKPOINT)
+            original(cpu, operand_a, operand_b)
+
+        return break_trap
+
+    def make_watch_trap(self, original, write_addresses):
+        watchpoints = self.watchpoints
+
+        def watch_trap(cpu, operand_a, operand_b):
+            addresses = write_addresses(cpu, operand_a, operand_b)
+            before = [cpu.ram[address] for address in addresses]
+            original(cpu, operand_a, operand_b)
+            for address, old in zip(addresses, before):
+                # INT/IRET may or may not push, so only count real changes
+                if len(addresses) > 1 and cpu.ram[address] == old:
+                    continue
+                for wp in watchpoints.values():
+                    if wp.start <= address <= wp.end:
+                        wp.hits += 1
+                        self.last_hit = (wp, address)
+                        raise Trap(WATCHPOINT, executed=True)
+
+        return watch_trap
+
+    def install(self):
+        """Rebuild the CPU's dispatch table for the current break/watchpoints."""
+
+        if not self.breakpoints and not self.watchpoints:
+            self.cpu.dispatch = self.step_table = self.base
+            return
+
+        table = list(self.base)
+
+        if self.watchpoints:
+            for opcode, write_addresses in RAM_WRITES.items():
+                table[opcode] = self.make_watch_trap(table[opcode], write_addresses)
+        self.step_table = list(table)
+
+        if any(bp.pc is None for bp in self.breakpoints.values()):
+            trapped = range(256)
+        else:
+            trapped = {self.cpu.ram[bp.pc] for bp in self.breakpoints.values()}
+        for opcode in trapped:
+            table[opcode] = self.make_break_trap(table[opcode])
+
+        self.cpu.dispatch = table
+
+    # --- running -------------------------------------------------------
+
+    def execute(self, n = 1):
+        """
+        Execute up to `n` instructions without stopping on breakpoints.
+        Watchpoints still stop it. Returns the number executed and the stop
+        reason, as `FastCPU.execute` does.
+        """
+
+        cpu = self.cpu
+        self.last_hit = None
+        table = cpu.dispatch
+        cpu.dispatch = self.step_table
+        try:
+            return cpu.execute(n)
+        finally:
+            cpu.dispatch = table
+
+    def step(self, n = 1):
+        """Execute up to `n` instructions, as `execute`. Returns how many ran."""
+
+        return self.execute(n)[0]
+
+    def cont(self, max_cycles = None):
+        """
+        Continue until HLT, a breakpoint, a watchpoint or `max_cycles`.
+        A breakpoint at the current PC doesn't stop us straight away.
+        """
+
+        cpu = self.cpu
+        self.last_hit = None
+        # Code may have changed since the breakpoints were set
+        self.install()
+
+        executed = 0
+        pc = cpu.pc & 0xFF
+        at_breakpoint = (self.break_pc == pc or
+                         any(bp.pc == pc for bp in self.breakpoints.values()))
+        self.break_pc = None
+        if at_breakpoint and not cpu.halted and max_cycles != 0:
+            start = time.perf_counter()
+            executed, reason = self.execute()
+            if reason is not None:
+                # The instruction stepped off hit a watchpoint, or was HLT
+                return RunResult(reason, executed, time.perf_counter() - start)
+            if max_cycles is not None:
+                max_cycles -= executed
+
+        result = cpu.run(max_cycles=max_cycles)
+        return result._replace(cycles=result.cycles + executed)
+
+
+# ---------------------------------------------------------------------------
+# REPL
+# ---------------------------------------------------------------------------
+
+HELP = """\
+b ADDR [if Rn==V]   break at address (hex), optionally only when Rn == V
+b if Rn==V          break whenever Rn == V
+w START [END]       watch RAM writes to START..END (hex)
+d N                 delete break/watchpoint N
+l                   list break/watchpoints
+c                   continue
+s [N]               step N instructions (default 1)
+r                   show registers (trace line)
+x ADDR [N]          dump N bytes of RAM from ADDR (hex)
+u [ADDR] [N]        disassemble N instructions from ADDR (default PC, 8)
+q                   quit"""
+
+
+def parse_condition(text):
+    """Parse "R3==5" into a condition function."""
+
+    left, right = text.replace(" ", "").split("==")
+    if not left.upper().startswith("R"):
+        raise ValueError(f"bad condition {text}")
+    return reg_equals(int(left[1:]), int(right, 0))
+
+
+def repl(dbg, stdin = sys.stdin):
+    cpu = dbg.cpu
+    # Re-decodes only what the program has changed since the last `u`
+    dis = Disassembler(cpu.ram)
+
+    def report(result):
+        if result.reason == BREAKPOINT:
+            print(f"breakpoint {dbg.last_hit.number} at {cpu.pc & 0xFF:02X}")
+        elif result.reason == WATCHPOINT:
+            wp, address = dbg.last_hit
+            print(f"watchpoint {wp.number}: wrote {cpu.ram[address]:02X} to {address:02X}")
+        elif result.reason == HALTED:
+            print(f"halted after {cpu.cycles} instructions")
+        cpu.trace()
+
+    while True:
+        print("(ls8) ", end="", flush=True)
+        line = stdin.readline()
+        if not line:
+            break
+        words = line.split()
+        if not words:
+            continue
+        command, args = words[0], words[1:]
+
+        try:
+            if command == "q":
+                break
+            elif command == "b":
+                if args and args[0] == "if":
+                    number = dbg.break_at(None, parse_condition("".join(args[1:])))
+                else:
+                    condition = None
+                    if len(args) > 2 and args[1] == "if":
+                        condition = parse_condition("".join(args[2:]))
+                    number = dbg.break_at(int(args[0], 16), condition)
+                print(f"breakpoint {number}")
+            elif command == "w":
+                start = int(args[0], 16)
+                end = int(args[1], 16) if len(args) > 1 else None
+                print(f"watchpoint {dbg.watch(start, end)}")
+            elif command == "d":
+                dbg.delete(int(args[0]))
+            elif command == "l":
+                for bp in dbg.breakpoints.values():
+                    where = "any" if bp.pc is None else f"{bp.pc:02X}"
+                    cond = " (conditional)" if bp.condition else ""
+                    print(f"{bp.number}: break {where}{cond}, {bp.hits} hits")
+                for wp in dbg.watchpoints.values():
+                    print(f"{wp.number}: watch {wp.start:02X}-{wp.end:02X}, {wp.hits} hits")
+            elif command == "c":
+                report(dbg.cont())
+            elif command == "s":
+                executed, reason = dbg.execute(int(args[0]) if args else 1)
+                report(RunResult(reason, executed, 0.0))
+            elif command == "r":
+                cpu.trace()
+            elif command == "x":
+                start = int(args[0], 16)
+                count = int(args[1]) if len(args) > 1 else 16
+                data = cpu.ram[start:start + count]
+                print(f"{start:02X}: " + " ".join(f"{byte:02X}" for byte in data))
+            elif command == "u":
+                start = int(args[0], 16) if args else cpu.pc & 0xFF
+                count = int(args[1]) if len(args) > 1 else 8
+                dis.update()
+                for line in dis.listing(start, count):
+                    print(line)
+            else:
+                print(HELP)
+        except (ValueError, IndexError) as e:
+            print(f"error: {e}")
+        except LS8Error as e:
+            print(f"cpu error: {e}")
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("usage: debugger.py program.ls8", file=sys.stderr)
+        return 1
+
+    cpu = FastCPU()
+    try:
+        cpu.load(argv[1])
+    except LS8Error as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    repl(Debugger(cpu))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
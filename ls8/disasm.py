@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+"""Disassembler for LS-8 memory images.
+
+    python3 disasm.py program.ls8
+
+`Disassembler` turns RAM back into assembler source. Instruction sizes come
+straight from the opcode's operand-count bits, so the whole image is split
+into instructions with one `bytes.translate` through a size table and a
+walk over the result. Decoded instructions are cached, along with a copy of
+the RAM they came from; on a live CPU, `update()` compares against that copy
+and only re-decodes from the first instruction that could have operands in
+a changed region until the instruction boundaries line up with the old ones
+again.
+
+LS-8 jumps and calls go through a register, so labels are inferred by
+tracking the last `LDI` into each register: a jump or call through that
+register makes the loaded address a label, and the `LDI` is printed with the
+label name.
+
+    dis = Disassembler(cpu.ram)
+    print("\\n".join(dis.listing()))
+    cpu.run(max_cycles=1000)
+    dis.update()      # only self-modified code is decoded again
+"""
+
+import bisect
+import sys
+from collections import namedtuple
+
+import isa
+from cpu_fast import LS8Error, parse_program
+
+# Bytes each opcode byte takes up, as a translate table
+SIZES = bytes(isa.instruction_size(opcode) for opcode in range(256))
+
+# How RAM is compared against the cached copy
+BLOCK_SIZE = 16
+
+JUMPS = {instruction.opcode for instruction in isa.INSTRUCTIONS
+         if instruction.sets_pc and instruction.operands == "r"}
+# Opcodes that write their first operand register
+REGISTER_WRITES = {instruction.opcode for instruction in isa.INSTRUCTIONS
+                   if instruction.alu or instruction.mnemonic in ("LD", "POP")}
+CALL = isa.BY_MNEMONIC["CALL"].opcode
+LDI = isa.BY_MNEMONIC["LDI"].opcode
+
+Decoded = namedtuple("Decoded", ["address", "size", "text", "raw"])
+
+
+class Disassembler:
+    def __init__(self, ram, start = 0, end = None):
+        self.ram = ram
+        self.start = start
+        self.end = len(ram) if end is None else end
+        # Instruction start addresses and the decoded instructions, in order
+        self.starts = []
+        self.decoded = []
+        # Raw instruction bytes -> text, shared by every address
+        self.text_cache = {}
+        # RAM as it was when `decoded` was built
+        self.copy = None
+        # Address -> label, and LDI address -> the label it loads
+        self.labels = {}
+        self.label_ldis = {}
+        # Instructions decoded by the last update, for the curious
+        self.last_decoded = 0
+        self.update()
+
+    def decode(self, address):
+        ram = self.ram
+        size = SIZES[ram[address]]
+        if address + size <= len(ram):
+            raw = bytes(ram[address:address + size])
+        else:
+            # Operands past the end of RAM wrap around like the CPU's do
+            raw = bytes(ram[(address + i) % len(ram)] for i in range(size))
+        entry = self.text_cache.get(raw)
+        if entry is None:
+            # (text, size), size 1 if it isn't a valid instruction
+            entry = self.text_cache[raw] = isa.disassemble(raw.ljust(3, b"\0"), 0)
+        return Decoded(address, entry[1], entry[0], raw[:entry[1]])
+
+    def walk(self, sizes, address, stop):
+        """
+        Decode from `address` up to `stop`, and on past it until an old
+        instruction boundary is reached. `sizes` is the size of the
+        instruction at each address. Returns the decoded instructions and
+        the address decoding stopped at.
+        """
+
+        old_starts = self.starts
+        result = []
+        while address < self.end:
+            if address >= stop:
+                i = bisect.bisect_left(old_starts, address)
+                if i < len(old_starts) and old_starts[i] == address:
+                    break
+            decoded = self.decode(address)
+            result.append(decoded)
+            # Invalid instructions come out as a one-byte DB
+            address += sizes[address - self.start] if decoded.size > 1 else 1
+        return result, address
+
+    def update(self):
+        """
+        Bring the decoded instructions up to date with RAM. Returns the
+        number of instructions decoded.
+        """
+
+        current = bytes(self.ram[self.start:self.end])
+        if current == self.copy:
+            self.last_decoded = 0
+            return 0
+
+        sizes = current.translate(SIZES)
+        if self.copy is None:
+            self.decoded, _ = self.walk(sizes, self.start, self.end)
+            self.starts = [decoded.address for decoded in self.decoded]
+            self.last_decoded = len(self.decoded)
+        else:
+            self.last_decoded = 0
+            wraps = self.start == 0 and self.end == len(self.ram)
+            for lo, hi in self.changed(current):
+                self.redecode(sizes, lo, hi)
+                if wraps and lo < 2:
+                    # The last instructions' operands wrap around to 0x00
+                    self.redecode(sizes, self.end - 2, self.end)
+
+        self.copy = current
+        self.infer_labels()
+        return self.last_decoded
+
+    def changed(self, current):
+        """Changed address ranges (start, end), compared a block at a time."""
+
+        old = self.copy
+        ranges = []
+        for offset in range(0, len(current), BLOCK_SIZE):
+            if current[offset:offset + BLOCK_SIZE] != old[offset:offset + BLOCK_SIZE]:
+                lo = self.start + offset
+                hi = min(lo + BLOCK_SIZE, self.end)
+                if ranges and ranges[-1][1] == lo:
+                    ranges[-1] = (ranges[-1][0], hi)
+                else:
+                    ranges.append((lo, hi))
+        return ranges
+
+    def redecode(self, sizes, lo, hi):
+        # Start at the instruction covering `lo - 2`: one starting up to two
+        # bytes earlier may have had operands changed, and now decode
+        # differently (a DB for a bad register operand can become valid)
+        i = max(bisect.bisect_right(self.starts, lo - 2) - 1, 0)
+        start = self.starts[i] if self.starts else self.start
+        decoded, stop = self.walk(sizes, start, hi)
+        j = bisect.bisect_left(self.starts, stop)
+        self.decoded[i:j] = decoded
+        self.starts[i:j] = [d.address for d in decoded]
+        self.last_decoded += len(decoded)
+
+    def infer_labels(self):
+        """Label every address an LDI loads into a register later jumped through."""
+
+        calls = set()
+        jumps = set()
+        # Register -> address and target of the LDI that last loaded it
+        loaded = {}
+        for decoded in self.decoded:
+            raw = decoded.raw
+            if len(raw) < 2:
+                if raw[0] not in isa.BY_OPCODE:
+                    # Data, or at least not code we can follow
+                    loaded = {}
+                continue
+            opcode, operand = raw[0], raw[1]
+            if opcode == LDI:
+                loaded[operand] = (decoded.address, raw[2])
+            elif opcode in JUMPS and operand in loaded:
+                ldi_address, target = loaded[operand]
+                (calls if opcode == CALL else jumps).add((target, ldi_address))
+            elif opcode in REGISTER_WRITES:
+                loaded.pop(operand, None)
+
+        starts = set(self.starts)
+        self.labels = {}
+        self.label_ldis = {}
+        for kind, targets in (("SUB", calls), ("L", jumps)):
+            for target, ldi_address in sorted(targets):
+                if target in starts:
+                    self.labels.setdefault(target, f"{kind}_{target:02X}")
+                    self.label_ldis[ldi_address] = target
+
+    def instructions(self, address = None, count = None):
+        """Decoded instructions, optionally `count` of them from `address`."""
+
+        if address is None:
+            return list(self.decoded)
+        i = max(bisect.bisect_right(self.starts, address) - 1, 0)
+        return self.decoded[i:i + count] if count is not None else self.decoded[i:]
+
+    def listing(self, address = None, count = None, addresses = True):
+        """Assembler source lines, with inferred labels."""
+
+        lines = []
+        for decoded in self.instructions(address, count):
+            if decoded.address in self.labels:
+                lines.append(f"{self.labels[decoded.address]}:")
+            text = decoded.text
+            target = self.label_ldis.get(decoded.address)
+            if target is not None:
+                text = text[:text.index(",") + 1] + self.labels[target]
+            if addresses:
+                raw = " ".join(f"{byte:02X}" for byte in decoded.raw)
+                lines.append(f"    {text:<20} ; {decoded.address:02X}: {raw}")
+            else:
+                lines.append(f"    {text}")
+        return lines
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("usage: disasm.py program.ls8", file=sys.stderr)
+        return 1
+
+    try:
+        with open(argv[1]) as f:
+            image = parse_program(f, argv[1])
+    except (OSError, LS8Error) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    for line in Disassembler(image).listing():
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+
+"""Distributed batch runs: one coordinator, any number of workers over TCP.
+
+    python3 dist.py coordinator [--host HOST] [--port PORT] [options] program.ls8[:input.log] ...
+    python3 dist.py worker HOST:PORT [-j PROCESSES]
+    python3 dist.py local [-w WORKERS] [options] program.ls8[:input.log] ...
+
+The coordinator splits the programs into chunks of `--chunk` and hands them
+to workers as they ask for work. A worker runs each program of its chunk on
+a FastCPU that is `reset()` between programs, and sends the results back.
+`-j` starts that many worker processes on the node, each with its own
+connection. `local` runs a coordinator and `-w` workers as separate
+processes on localhost, which is the same code path as several machines.
+
+Options shared by `coordinator` and `local`: `--chunk N`, `--max-cycles N`,
+`--timeout SECONDS` (per program), `--watchdog`, `--output` (print what each
+program printed) and `--results FILE` (one JSON line per program).
+
+Every message is a frame: a 4-byte big-endian length, then zlib-compressed
+JSON. Programs go out as hex images and results come back with their
+output, so both compress well.
+
+Workers pull: when a worker is idle and nothing is left to hand out, the
+coordinator asks the worker with the most unrun programs to give half of
+them back (it checks between programs), and passes those to the idle one.
+Workers send a heartbeat every `HEARTBEAT` seconds from a thread of their
+own, so one running a long program, or waiting for work, still shows it is
+alive. A worker that disconnects, or says nothing for `--worker-timeout`
+seconds, is treated as lost and whatever it hadn't finished goes back on the
+queue; the worker connects again if it can. A result that turns up twice is
+only counted once. `local` gives up if every worker process has exited with
+programs still unfinished.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+
+from cpu_fast import FastCPU, LS8Error
+from batch import parse_job
+import runcache
+
+HOST = "127.0.0.1"
+PORT = 8809
+
+# Programs per chunk
+CHUNK_SIZE = 16
+
+# Wall-clock limit per program
+TIMEOUT = 10.0
+
+# Seconds a worker may go without a message before it is dropped; workers
+# send a heartbeat every `HEARTBEAT` seconds whatever they're doing
+WORKER_TIMEOUT = 60.0
+HEARTBEAT = 0.5
+
+# How often a busy worker sends the results it has so far
+RESULTS_INTERVAL = 5.0
+
+# How long a worker keeps trying to reach the coordinator
+CONNECT_TIMEOUT = 30.0
+
+HEADER = struct.Struct(">I")
+MAX_FRAME = 256 << 20
+
+
+def encode(message):
+    return zlib.compress(json.dumps(message).encode(), 1)
+
+
+def frame(message):
+    data = encode(message)
+    return HEADER.pack(len(data)) + data
+
+
+def decode(data):
+    try:
+        return json.loads(zlib.decompress(data))
+    except (zlib.error, ValueError) as e:
+        raise ConnectionError(f"bad frame: {e}") from None
+
+
+async def read_message(reader):
+    """The next message from an asyncio stream, and its size on the wire."""
+
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size > MAX_FRAME:
+        raise ConnectionError(f"frame of {size} bytes")
+    return decode(await reader.readexactly(size)), HEADER.size + size
+
+
+class Connection:
+    """Blocking framed connection, for workers."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        # The heartbeat thread sends too
+        self.send_lock = threading.Lock()
+
+    def send(self, message):
+        data = frame(message)
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def poll(self):
+        """Whether a message can be read without blocking for long."""
+
+        if len(self.buffer) >= HEADER.size:
+            return True
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+    def fill(self, count):
+        while len(self.buffer) < count:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("coordinator closed the connection")
+            self.buffer += data
+
+    def receive(self):
+        self.fill(HEADER.size)
+        size, = HEADER.unpack_from(self.buffer)
+        if size > MAX_FRAME:
+            raise ConnectionError(f"frame of {size} bytes")
+        self.fill(HEADER.size + size)
+        data = bytes(self.buffer[HEADER.size:HEADER.size + size])
+        del self.buffer[:HEADER.size + size]
+        return decode(data)
+
+
+def connect(host, port, timeout = CONNECT_TIMEOUT):
+    """Connect to the coordinator, retrying while it starts up."""
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection((host, port))
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def run_job(cpu, job, limits):
+    """Result of one program as a dict."""
+
+    cpu.reset()
+    try:
+        image = bytes.fromhex(job["image"])
+        cpu.load_image(image)
+        events = [tuple(event) for event in job["events"]]
+        result = runcache.run_uncached(image, events, limits["max_cycles"], limits["watchdog"],
+                                       cpu, limits["timeout"])
+    except LS8Error as e:
+        return {"error": str(e)}
+    return {"reason": result.reason, "cycles": result.cycles, "output": result.output,
+            "loop": result.loop}
+
+
+def send_heartbeats(conn, stopped):
+    while not stopped.wait(HEARTBEAT):
+        try:
+            conn.send({"type": "heartbeat"})
+        except OSError:
+            return
+
+
+def work(host, port):
+    """
+    Worker loop: ask for chunks and run them until told to stop. If the
+    coordinator drops us, connect again and carry on.
+    """
+
+    cpu = FastCPU()
+    sock = connect(host, port)
+    while True:
+        conn = Connection(sock)
+        stopped = threading.Event()
+        threading.Thread(target=send_heartbeats, args=(conn, stopped), daemon=True).start()
+        try:
+            work_on(conn, cpu)
+            return
+        except OSError:
+            pass
+        finally:
+            stopped.set()
+            sock.close()
+        try:
+            sock = connect(host, port)
+        except OSError:
+            # The coordinator has gone
+            return
+
+
+def work_on(conn, cpu):
+    """Run chunks from `conn` until told to stop."""
+
+    conn.send({"type": "ready"})
+    while True:
+        message = conn.receive()
+        if message["type"] == "stop":
+            break
+        if message["type"] != "chunk":
+            # A steal request for a chunk already finished
+            continue
+
+        chunk = message["chunk"]
+        limits = message["limits"]
+        jobs = deque(message["jobs"])
+        results = {}
+        last_sent = time.monotonic()
+        while jobs:
+            if conn.poll():
+                message = conn.receive()
+                if message["type"] == "stop":
+                    return
+                if message["type"] == "steal" and message["chunk"] == chunk:
+                    # Give back the second half of what's left
+                    returned = [jobs.pop()["index"] for _ in range(len(jobs) // 2)]
+                    conn.send({"type": "results", "chunk": chunk, "results": results,
+                               "returned": returned, "steal": True})
+                    results = {}
+                    last_sent = time.monotonic()
+                    continue
+            job = jobs.popleft()
+            results[job["index"]] = run_job(cpu, job, limits)
+            if time.monotonic() - last_sent > RESULTS_INTERVAL:
+                # Send what's done so far
+                conn.send({"type": "results", "chunk": chunk, "results": results,
+                           "returned": []})
+                results = {}
+                last_sent = time.monotonic()
+        conn.send({"type": "results", "chunk": chunk, "results": results, "returned": [],
+                   "final": True})
+        conn.send({"type": "ready"})
+
+
+def work_processes(host, port, count):
+    """Run `count` worker loops in parallel processes."""
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=work, args=(host, port)) for _ in range(count - 1)]
+    for process in processes:
+        process.start()
+    try:
+        work(host, port)
+    finally:
+        for process in processes:
+            process.join()
+
+
+class Assignment:
+    """A chunk handed to a worker, and which of its programs are still to come."""
+
+    def __init__(self, chunk, worker, indices):
+        self.chunk = chunk
+        self.worker = worker
+        self.remaining = set(indices)
+        self.stealing = False
+
+
+class Coordinator:
+    def __init__(self, jobs, chunk_size = CHUNK_SIZE, limits = None,
+                 worker_timeout = WORKER_TIMEOUT):
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.limits = limits or {"max_cycles": None, "timeout": TIMEOUT, "watchdog": False}
+        self.worker_timeout = worker_timeout
+        self.results = [None] * len(jobs)
+        self.left = len(jobs)
+        # Program indices not yet handed out, a chunk at a time
+        self.pending = deque(list(range(i, min(i + chunk_size, len(jobs))))
+                             for i in range(0, len(jobs), chunk_size))
+        # Chunk id -> Assignment
+        self.assigned = {}
+        self.next_chunk = 0
+        # Idle workers with nothing to do yet, and every connected worker
+        self.waiting = deque()
+        self.workers = set()
+        self.handlers = set()
+        self.done = asyncio.Event()
+        if not jobs:
+            self.done.set()
+        # Why the run was given up, if it was
+        self.error = None
+        self.stats = {
+            "workers": 0,
+            "lost": 0,
+            "retried": 0,
+            "stolen": 0,
+            "duplicates": 0,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+        }
+
+    def send(self, writer, message):
+        data = frame(message)
+        self.stats["bytes_sent"] += len(data)
+        writer.write(data)
+
+    def give(self, writer, indices):
+        chunk = self.next_chunk
+        self.next_chunk += 1
+        self.assigned[chunk] = Assignment(chunk, writer, indices)
+        jobs = [dict(self.jobs[i], index=i) for i in indices]
+        self.send(writer, {"type": "chunk", "chunk": chunk, "limits": self.limits, "jobs": jobs})
+
+    def dispatch(self):
+        """Hand out pending work to waiting workers, or steal some for them."""
+
+        while self.waiting and self.pending:
+            self.give(self.waiting.popleft(), self.pending.popleft())
+
+        if self.waiting and not self.done.is_set():
+            stealing = sum(assignment.stealing for assignment in self.assigned.values())
+            candidates = sorted((assignment for assignment in self.assigned.values()
+                                 if not assignment.stealing and len(assignment.remaining) > 1),
+                                key=lambda assignment: len(assignment.remaining), reverse=True)
+            for assignment in candidates[:len(self.waiting) - stealing]:
+                assignment.stealing = True
+                self.send(assignment.worker, {"type": "steal", "chunk": assignment.chunk})
+
+    def record(self, message):
+        assignment = self.assigned.get(message["chunk"])
+        for index, result in message["results"].items():
+            index = int(index)
+            if self.results[index] is None:
+                self.results[index] = result
+                self.left -= 1
+            else:
+                self.stats["duplicates"] += 1
+            if assignment is not None:
+                assignment.remaining.discard(index)
+
+        if assignment is not None:
+            returned = message["returned"]
+            if returned:
+                assignment.remaining.difference_update(returned)
+                self.pending.append(returned)
+                self.stats["stolen"] += len(returned)
+            if message.get("steal"):
+                assignment.stealing = False
+            if message.get("final") or not assignment.remaining:
+                del self.assigned[assignment.chunk]
+
+        if self.left == 0:
+            self.finish()
+        else:
+            self.dispatch()
+
+    def lose(self, writer):
+        """Put the unfinished programs of a lost worker back on the queue."""
+
+        self.stats["lost"] += 1
+        for chunk, assignment in list(self.assigned.items()):
+            if assignment.worker is writer:
+                del self.assigned[chunk]
+                unfinished = sorted(i for i in assignment.remaining if self.results[i] is None)
+                if unfinished:
+                    self.pending.appendleft(unfinished)
+                    self.stats["retried"] += len(unfinished)
+        self.dispatch()
+
+    def abort(self, error):
+        """Give up with programs unfinished."""
+
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        self.done.set()
+        for writer in self.workers:
+            self.send(writer, {"type": "stop"})
+            # Flushes the stop message, then ends the handler's read with EOF
+            writer.close()
+        self.waiting.clear()
+
+    async def handle_worker(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        self.workers.add(writer)
+        self.stats["workers"] += 1
+        lost = False
+        try:
+            while not self.done.is_set():
+                message, size = await asyncio.wait_for(read_message(reader), self.worker_timeout)
+                self.stats["bytes_received"] += size
+                if message["type"] == "ready":
+                    self.waiting.append(writer)
+                    self.dispatch()
+                elif message["type"] == "results":
+                    self.record(message)
+                await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError,
+                KeyError, ValueError):
+            lost = not self.done.is_set()
+        finally:
+            self.workers.discard(writer)
+            if writer in self.waiting:
+                self.waiting.remove(writer)
+            if lost:
+                self.lose(writer)
+            writer.close()
+            self.handlers.discard(asyncio.current_task())
+
+    async def serve(self, host, port, started = None):
+        """
+        Accept workers until every program has a result. `started` is called
+        with the port once the coordinator is listening.
+        """
+
+        server = await asyncio.start_server(self.handle_worker, host, port)
+        async with server:
+            if started is not None:
+                started(server.sockets[0].getsockname()[1])
+            await self.done.wait()
+            if self.handlers:
+                await asyncio.wait(self.handlers)
+
+
+def load_jobs(args):
+    """(program name, job) for each `program.ls8[:input.log]` argument."""
+
+    jobs = []
+    for arg in args:
+        program, image, events = parse_job(arg)
+        jobs.append((program, {"image": bytes(image).hex(), "events": [list(e) for e in events]}))
+    return jobs
+
+
+def report(names, coordinator, args, elapsed):
+    """Print one line per program as batch.py does. Returns the number of failures."""
+
+    failures = 0
+    results_file = open(args.results, "w") if args.results else None
+    try:
+        for name, result in zip(names, coordinator.results):
+            if results_file is not None:
+                results_file.write(json.dumps(dict(result, program=name)) + "\n")
+            if "error" in result:
+                print(f"{name}: {result['error']}")
+                failures += 1
+                continue
+            loop = f" in {result['loop'][0]:02X}-{result['loop'][1]:02X}" if result["loop"] else ""
+            print(f"{name}: {result['reason']}{loop} after {result['cycles']} instructions")
+            if args.output:
+                print(result["output"], end="")
+    finally:
+        if results_file is not None:
+            results_file.close()
+
+    stats = coordinator.stats
+    print(f"{len(names)} programs in {elapsed:.2f}s on {stats['workers']} workers: "
+          f"{stats['lost']} lost, {stats['retried']} retried, {stats['stolen']} stolen, "
+          f"{stats['duplicates']} duplicate results, {stats['bytes_sent']} bytes sent, "
+          f"{stats['bytes_received']} received", file=sys.stderr)
+    return failures
+
+
+async def coordinate(coordinator, host, port, workers = 0):
+    """Run `coordinator`, starting `workers` local worker processes once it listens."""
+
+    processes = []
+
+    def started(port):
+        print(f"coordinator listening on {host}:{port}", file=sys.stderr)
+        for _ in range(workers):
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "worker", f"{host}:{port}"]))
+
+    async def watch():
+        # Nobody else will connect to a local run
+        while not coordinator.done.is_set():
+            await asyncio.sleep(HEARTBEAT)
+            if processes and all(process.poll() is not None for process in processes):
+                coordinator.abort("every worker process has exited")
+
+    watcher = asyncio.create_task(watch()) if workers else None
+    try:
+        await coordinator.serve(host, port, started)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        for process in processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def run_coordinator(args, jobs, limits):
+    coordinator = Coordinator(jobs, args.chunk, limits, args.worker_timeout)
+    if args.command == "local":
+        await coordinate(coordinator, HOST, 0, args.workers)
+    else:
+        await coordinate(coordinator, args.host, args.port)
+    return coordinator
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Distributed batch runs of LS-8 programs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker = commands.add_parser("worker", help="run programs for a coordinator")
+    worker.add_argument("address", help="coordinator HOST:PORT")
+    worker.add_argument("-j", "--processes", type=int, default=1,
+                        help="worker processes to run on this node")
+
+    for name in ("coordinator", "local"):
+        command = commands.add_parser(name)
+        command.add_argument("programs", nargs="+", help="program.ls8[:input.log]")
+        command.add_argument("--chunk", type=int, default=CHUNK_SIZE, help="programs per chunk")
+        command.add_argument("--max-cycles", type=int, default=None)
+        command.add_argument("--timeout", type=float, default=TIMEOUT,
+                             help="wall-clock seconds per program")
+        command.add_argument("--watchdog", action="store_true",
+                             help="stop programs that are stuck in a loop")
+        command.add_argument("--worker-timeout", type=float, default=WORKER_TIMEOUT,
+                             help="seconds of silence before a worker counts as lost")
+        command.add_argument("--output", action="store_true", help="print each program's output")
+        command.add_argument("--results", help="write results as JSON lines to this file")
+        if name == "coordinator":
+            command.add_argument("--host", default=HOST)
+            command.add_argument("--port", type=int, default=PORT)
+        else:
+            command.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 2,
+                                 help="local worker processes")
+    args = parser.parse_args(argv[1:])
+
+    if args.command != "worker" and args.worker_timeout <= 2 * HEARTBEAT:
+        parser.error(f"--worker-timeout must be more than {2 * HEARTBEAT}s, "
+                     f"twice the {HEARTBEAT}s heartbeat interval")
+
+    if args.command == "worker":
+        host, _, port = args.address.rpartition(":")
+        try:
+            work_processes(host, int(port), args.processes)
+        except (OSError, ValueError) as e:
+            print(f"worker: {e}", file=sys.stderr)
+            return 1
+        return 0
+
+    try:
+        jobs = load_jobs(args.programs)
+    except (OSError, LS8Error) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    names = [name for name, job in jobs]
+    limits = {"max_cycles": args.max_cycles, "timeout": args.timeout, "watchdog": args.watchdog}
+    start = time.perf_counter()
+    try:
+        coordinator = asyncio.run(run_coordinator(args, [job for name, job in jobs], limits))
+    except OSError as e:
+        print(f"coordinator: {e}", file=sys.stderr)
+        return 1
+    if coordinator.error is not None:
+        print(f"coordinator: {coordinator.error}, {coordinator.left} programs unfinished",
+              file=sys.stderr)
+        return 1
+    return 1 if report(names, coordinator, args, time.perf_counter() - start) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""Explore every path a program can take through a sweep of key presses.
+
+    python3 explore.py program.ls8 [--depth N] [--keys TEXT | --range LO-HI]
+                       [--bfs] [--max-states N] [--max-cycles N] [--compare]
+
+Input arrives as in `scheduler.py`: whenever the program parks in a
+`JMP`-to-self loop with the keyboard interrupt enabled and unmasked, the
+next of up to `--depth` keys is pressed. Which key it is stays open until
+something reads 0xF4. Only then does the run fork, one child per candidate
+key, each carrying on from a snapshot of the machine at that read. The
+instructions before the first read run once for the whole sweep, those
+between two reads once per distinct path so far, and a key that is never
+read doesn't fork at all. The work is proportional to the distinct paths
+rather than to keys^depth times the program's length.
+
+Every path ends in a `Leaf`: the keys it read (None for one pressed but
+never read), what it printed, and why it stopped, which is one of
+
+* halted
+* waiting for key, with all `--depth` keys pressed
+* idle, parked with the keyboard masked
+* max_cycles, after `--max-cycles` instructions on that path
+* faulted, with the error
+
+Paths are explored depth-first by default, or breadth-first with `--bfs`.
+A fork waiting to hand out its children counts as one live state. A
+depth-first path keeps one fork per key press it is below, so it needs up
+to `--depth` + 1 live states. Breadth-first exploration takes the newest
+state instead of the oldest whenever fewer than that are left below
+`--max-states`, so live states never exceed `--max-states`, or
+`--depth` + 1 if that is more.
+
+`--compare` also runs every key sequence from the start, one by one, checks
+both sweeps found the same leaves and reports the instructions each took.
+"""
+
+import argparse
+import io
+import itertools
+import sys
+from collections import deque, namedtuple
+
+import cpu_fast
+from cpu_fast import (FastCPU, LS8Error, Trap, KEY_PRESSED, KEYBOARD_INTERRUPT, IM, IS,
+                      MAX_CYCLES)
+from isa import JMP
+from preval import RAM_READS, INPUT
+from scheduler import WAITING_FOR_KEY, IDLE, FAULTED
+
+# Instructions each path may run, counted from power on
+BUDGET = 100_000
+
+# Live states before breadth-first exploration goes depth-first
+MAX_STATES = 10_000
+
+# Keys tried at each press by default: printable ASCII
+FIRST_KEY = 0x20
+LAST_KEY = 0x7E
+
+# Where a path has got to: the machine, the keys pressed so far and whether
+# the last of them is still unread
+State = namedtuple("State", ["snapshot", "keys", "pending", "output"])
+
+Leaf = namedtuple("Leaf", ["keys", "output", "reason", "cycles", "error"], defaults=[None])
+
+
+class Explorer:
+    def __init__(self, image, depth = 1, keys = range(FIRST_KEY, LAST_KEY + 1),
+                 max_cycles = BUDGET, extensions = False):
+        self.depth = depth
+        self.keys = [key & 0xFF for key in keys]
+        self.max_cycles = max_cycles
+        self.cpu = FastCPU(extensions)
+        self.cpu.load_image(image)
+        self.cpu.out = self.out = io.StringIO()
+        self.cpu.dispatch = self.guard_table(self.cpu.dispatch)
+        self.root = State(self.cpu.snapshot(), (), False, "")
+        # Whether the key byte holds a key nobody has picked yet
+        self.pending = False
+        self.stats = {"instructions": 0, "forks": 0, "leaves": 0, "peak_states": 0}
+
+    def guard_table(self, table):
+        guarded = list(table)
+        for opcode, reads in RAM_READS.items():
+            guarded[opcode] = self.make_read_guard(reads, table[opcode])
+        guarded[JMP] = self.make_idle_guard(table[JMP])
+        return guarded
+
+    def make_read_guard(self, reads, original):
+        def guard(cpu, operand_a, operand_b):
+            if self.pending and KEY_PRESSED in reads(cpu, operand_a, operand_b):
+                raise Trap(INPUT)
+            original(cpu, operand_a, operand_b)
+
+        return guard
+
+    def make_idle_guard(self, original):
+        def guard(cpu, reg_num, unused_operand):
+            if cpu.reg[reg_num] == cpu.pc & 0xFF:
+                raise Trap(IDLE)
+            original(cpu, reg_num, unused_operand)
+
+        return guard
+
+    def advance(self, state):
+        """
+        Run `state` until it reads an unpicked key or stops. Returns the
+        State at the read, with the PC on the reading instruction, or a Leaf.
+        """
+
+        cpu = self.cpu
+        cpu.restore(state.snapshot)
+        keys = list(state.keys)
+        self.pending = state.pending
+        self.out.seek(0)
+        self.out.truncate()
+
+        def leaf(reason, error = None):
+            self.stats["leaves"] += 1
+            return Leaf(tuple(keys), state.output + self.out.getvalue(), reason, cpu.cycles, error)
+
+        while True:
+            limit = self.max_cycles - cpu.cycles
+            if limit <= 0:
+                return leaf(MAX_CYCLES)
+            try:
+                executed, reason = cpu.execute(limit)
+            except LS8Error as e:
+                return leaf(FAULTED, str(e))
+            self.stats["instructions"] += executed
+
+            if reason == INPUT:
+                return State(cpu.snapshot(), tuple(keys), True, state.output + self.out.getvalue())
+            if reason != IDLE:
+                return leaf(reason or MAX_CYCLES)
+
+            if not (cpu.interrupts_enabled and cpu.reg[IM] & (1 << KEYBOARD_INTERRUPT)):
+                return leaf(IDLE)
+            if len(keys) == self.depth:
+                return leaf(WAITING_FOR_KEY)
+            # Press a key without saying which; a key still unread is lost
+            keys.append(None)
+            self.pending = True
+            cpu.reg[IS] |= 1 << KEYBOARD_INTERRUPT
+
+    def resolve(self, state, key):
+        """`state`, stopped at a read of 0xF4, with the pending key picked as `key`."""
+
+        snapshot = bytearray(state.snapshot)
+        snapshot[KEY_PRESSED] = key
+        return State(bytes(snapshot), state.keys[:-1] + (key,), False, state.output)
+
+    def explore(self, breadth_first = False, max_states = MAX_STATES):
+        """Yield a Leaf for every distinct path."""
+
+        # Entries are (state, None) to run, or (state, i) for a fork whose
+        # next child gets self.keys[i]
+        frontier = deque([(self.root, None)])
+        stats = self.stats
+        keys = self.keys
+        while frontier:
+            stats["peak_states"] = max(stats["peak_states"], len(frontier))
+            # Leave room for a depth-first path below whatever is taken
+            if breadth_first and len(frontier) + self.depth < max_states:
+                state, i = frontier.popleft()
+                put_back = frontier.appendleft
+            else:
+                state, i = frontier.pop()
+                put_back = frontier.append
+
+            if i is not None:
+                # A fork handing out its last child is done with
+                if i + 1 < len(keys):
+                    put_back((state, i + 1))
+                frontier.append((self.resolve(state, keys[i]), None))
+                continue
+
+            result = self.advance(state)
+            if isinstance(result, Leaf):
+                yield result
+            else:
+                stats["forks"] += 1
+                if keys:
+                    frontier.append((result, 0))
+
+    def run_sequence(self, keys):
+        """Run one key sequence from power on, without forking. Returns its Leaf."""
+
+        state = self.root
+        while True:
+            result = self.advance(state)
+            if isinstance(result, Leaf):
+                return result
+            state = self.resolve(result, keys[len(result.keys) - 1])
+
+
+def describe_keys(keys):
+    return " ".join("*" if key is None else repr(chr(key)) if 0x20 <= key < 0x7F else f"0x{key:02X}"
+                    for key in keys) or "-"
+
+
+def parse_range(text):
+    low, _, high = text.partition("-")
+    return range(int(low, 0), int(high or low, 0) + 1)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Explore an LS-8 program over every key sequence")
+    parser.add_argument("program", help=".ls8 file")
+    parser.add_argument("--depth", type=int, default=1, help="key presses per path")
+    parser.add_argument("--keys", help="keys to try at each press, as text")
+    parser.add_argument("--range", type=parse_range, dest="key_range",
+                        help=f"key values to try, as LO-HI (default 0x{FIRST_KEY:02X}-0x{LAST_KEY:02X})")
+    parser.add_argument("--bfs", action="store_true", help="breadth-first instead of depth-first")
+    parser.add_argument("--max-states", type=int, default=MAX_STATES,
+                        help="live states before breadth-first goes depth-first")
+    parser.add_argument("--max-cycles", type=int, default=BUDGET, help="instructions per path")
+    parser.add_argument("--ext", action="store_true", help="allow the isa.EXTENSIONS instructions")
+    parser.add_argument("--compare", action="store_true",
+                        help="also run every sequence separately and check the results agree")
+    args = parser.parse_args(argv[1:])
+
+    if args.keys is not None:
+        keys = args.keys.encode("latin-1")
+    else:
+        keys = args.key_range or range(FIRST_KEY, LAST_KEY + 1)
+
+    try:
+        with open(args.program) as f:
+            image = cpu_fast.parse_program(f, args.program)
+    except (OSError, LS8Error) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    explorer = Explorer(image, args.depth, keys, args.max_cycles, args.ext)
+    leaves = []
+    for leaf in explorer.explore(args.bfs, args.max_states):
+        leaves.append(leaf)
+        print(f"{describe_keys(leaf.keys):<16} {leaf.reason:<16} {leaf.output!r}"
+              + (f" {leaf.error}" if leaf.error else ""))
+
+    stats = explorer.stats
+    print(f"{len(leaves)} paths, {stats['forks']} forks, {stats['instructions']} instructions, "
+          f"peak {stats['peak_states']} live states", file=sys.stderr)
+
+    if args.compare:
+        single = Explorer(image, args.depth, keys, args.max_cycles, args.ext)
+        found = set()
+        for sequence in itertools.product(explorer.keys, repeat=args.depth):
+            found.add(single.run_sequence(sequence))
+        print(f"{len(explorer.keys) ** args.depth} sequences run separately: "
+              f"{single.stats['instructions']} instructions", file=sys.stderr)
+        if found != set(leaves):
+            print("explored and separate runs disagree", file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
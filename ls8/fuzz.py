@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+
+"""Differential fuzzer for the LS-8 engines.
+
+    python3 fuzz.py [-n programs] [-s first_seed] [-j processes]
+                    [-e engine,engine,...] [--ops MNEMONIC,...]
+                    [--budget instructions] [--loops] [-o failures_dir]
+
+Random but well-formed programs are generated from the `OPCODES` table in
+`asm/asm.py`, run to completion under every engine, and the final state
+(registers, FL, PC, RAM and printed output) is compared. Any program that
+makes the engines disagree is shrunk to a small reproducer and written out as
+an `.ls8` file that `ls8.py` can load.
+
+`cpu.py` and `cpu_table.py` keep registers as unbounded Python ints (NOT
+goes negative, MUL past 255); the fuzzer gives them 8-bit registers so that
+known difference doesn't drown out everything else. Generated programs
+never write IM or IS, which only FastCPU acts on.
+
+Programs only ever jump forward (or into a subroutine that RETs), so every
+correct engine halts; the instruction budget catches the ones that don't.
+With `--loops` each program is instead a counted loop (see `generate_loop`),
+which is what `loops.py` accelerates: `-e table,loops` checks it against
+`cpu_table.CPU`.
+"""
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'asm'))
+
+from asm import OPCODES
+
+import cpu
+import cpu_table
+import cpu_fast
+import loops
+
+# Programs stay below this address so the stack (which starts at F4) never
+# runs into code.
+MAX_PROGRAM_SIZE = 0xC0
+MAX_STACK_DEPTH = 16
+
+CONDITIONAL_JUMPS = ("JEQ", "JNE", "JGT", "JLT", "JGE", "JLE")
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class ByteRegisters(list):
+    """A register file that wraps values to 8 bits as they are stored."""
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value & 0xFF)
+
+
+def p8(v):
+    return "{:08b}".format(v)
+
+
+# ---------------------------------------------------------------------------
+# Engines
+#
+# Each engine runs a list of program bytes for at most `budget` instructions
+# and returns the raw final state. Engines only claim the mnemonics they
+# actually implement; the generator sticks to the intersection.
+# ---------------------------------------------------------------------------
+
+def run_cpu(program, budget):
+    machine = cpu.CPU()
+    machine.reg = ByteRegisters(machine.reg)
+    for address, value in enumerate(program):
+        machine.ram[address] = value
+
+    # cpu.py has no step function, so count instructions by its `ram_read`
+    # calls: one for the first opcode, then three per pass of its run loop.
+    calls = 0
+    ram_read_code = cpu.CPU.ram_read.__code__
+
+    def profiler(frame, event, arg):
+        nonlocal calls
+        if event == 'call' and frame.f_code is ram_read_code:
+            calls += 1
+            if calls > 3 * budget + 1:
+                raise BudgetExceeded()
+
+    sys.setprofile(profiler)
+    try:
+        machine.run()
+    finally:
+        sys.setprofile(None)
+
+    return machine
+
+
+def run_table(program, budget):
+    machine = cpu_table.CPU()
+    machine.reg = ByteRegisters(machine.reg)
+    for address, value in enumerate(program):
+        machine.ram[address] = value
+
+    steps = 0
+    ir = machine.ram_read(machine.pc)
+    while ir != cpu_table.HLT:
+        steps += 1
+        if steps > budget:
+            raise BudgetExceeded()
+        operand_a = machine.ram_read(machine.pc + 1)
+        operand_b = machine.ram_read(machine.pc + 2)
+        machine.dispach_table[ir](operand_a, operand_b)
+        machine.pc += cpu_table.ADVANCE[ir]
+        ir = machine.ram_read(machine.pc)
+
+    return machine
+
+
+def run_fast(program, budget):
+    machine = cpu_fast.FastCPU()
+    machine.load_image(program)
+
+    result = machine.run(max_cycles=budget)
+    # Out of budget unless the next instruction is the HLT
+    if result.reason != cpu_fast.HALTED and machine.step() != 0:
+        raise BudgetExceeded()
+
+    return machine
+
+
+def run_loops(program, budget):
+    machine = cpu_fast.FastCPU()
+    # Accelerate on the first trip round, so even short loops are checked
+    loops.LoopAccelerator(machine, threshold=1)
+    machine.load_image(program)
+
+    result = machine.run(max_cycles=budget)
+    if result.reason != cpu_fast.HALTED and machine.step() != 0:
+        raise BudgetExceeded()
+
+    return machine
+
+
+ENGINES = {
+    "cpu": (run_cpu, {"LDI", "PRN", "PUSH", "POP", "MUL", "ADD", "CALL", "RET"}),
+    "table": (run_table, {"LDI", "PRN", "PUSH", "POP", "MUL", "ADD", "CALL", "RET",
+                          "CMP", "JMP", "JEQ", "JNE", "JGT", "JLT", "JGE", "JLE",
+                          "AND", "OR", "XOR", "NOT"}),
+    "fast": (run_fast, {"LDI", "PRN", "PUSH", "POP", "MUL", "ADD", "CALL", "RET",
+                        "CMP", "JMP", "JEQ", "JNE", "JGT", "JLT", "JGE", "JLE",
+                        "AND", "OR", "XOR", "NOT", "SHL", "SHR", "MOD",
+                        "SUB", "INC", "DEC"}),
+    "loops": (run_loops, {"LDI", "PRN", "PUSH", "POP", "MUL", "ADD", "CALL", "RET",
+                          "CMP", "JMP", "JEQ", "JNE", "JGT", "JLT", "JGE", "JLE",
+                          "AND", "OR", "XOR", "NOT", "SHL", "SHR", "MOD",
+                          "SUB", "INC", "DEC"}),
+}
+
+
+def normalize_state(machine):
+    """
+    Reduce an engine's final state to a comparable dict. Registers are 8 bits
+    wide on real hardware, so values are compared modulo 256. cpu.py and
+    cpu_table.py only have 255 bytes of RAM; the last one reads as 0.
+    """
+
+    ram = []
+    for address in range(256):
+        value = machine.ram[address] if address < len(machine.ram) else 0
+        ram.append(value & 0xFF)
+
+    fl = machine.fl if isinstance(machine.fl, int) else 0
+
+    return {
+        "reg": [r & 0xFF for r in machine.reg],
+        "fl": fl,
+        "pc": machine.pc & 0xFF,
+        "ram": ram,
+    }
+
+
+def run_engine(name, program, budget):
+    """Run one engine, returning (state, output). Errors are part of the state."""
+
+    runner = ENGINES[name][0]
+    output = io.StringIO()
+
+    try:
+        with contextlib.redirect_stdout(output):
+            machine = runner(program, budget)
+    except BudgetExceeded:
+        return {"error": "budget exceeded"}, output.getvalue()
+    except Exception as e:
+        return {"error": type(e).__name__}, output.getvalue()
+
+    return normalize_state(machine), output.getvalue()
+
+
+def compare(program, engines, budget):
+    """
+    Run every engine on `program`. Returns None if they all agree, otherwise
+    the sorted list of state fields that differ.
+    """
+
+    results = [run_engine(name, program, budget) for name in engines]
+    first_state, first_output = results[0]
+
+    differing = set()
+    for state, output in results[1:]:
+        if output != first_output:
+            differing.add("output")
+        if "error" in state or "error" in first_state:
+            if state.get("error") != first_state.get("error"):
+                differing.add("error")
+            continue
+        for field in first_state:
+            if state[field] != first_state[field]:
+                differing.add(field)
+
+    return sorted(differing) or None
+
+
+# ---------------------------------------------------------------------------
+# Program generation
+#
+# A program is {"main": [...], "subs": [[...], ...]}. Each item is a tuple
+# (mnemonic, operand_a, operand_b, target). Jumps and CALLs name their target
+# (an index into "main", or a subroutine number) and are expanded to an LDI of
+# the target address plus the jump when the program is laid out.
+# ---------------------------------------------------------------------------
+
+def generate(rng, mnemonics, length):
+    can_call = "CALL" in mnemonics and "RET" in mnemonics
+    mnemonics = sorted(m for m in mnemonics if m in OPCODES and m not in ("HLT", "RET"))
+    plain = [m for m in mnemonics if m not in ("CALL", "PUSH", "POP")]
+
+    def random_item(depth):
+        """Pick an instruction that keeps the stack depth sane."""
+        while True:
+            mnemonic = rng.choice(mnemonics)
+            if mnemonic == "PUSH" and depth >= MAX_STACK_DEPTH:
+                continue
+            if mnemonic == "POP" and depth == 0:
+                continue
+            if mnemonic == "CALL" and not can_call:
+                continue
+            return mnemonic
+
+    def operands(mnemonic):
+        # Never write IM, IS or the stack pointer, but allow reading them:
+        # FastCPU services interrupts that the legacy engines ignore
+        if mnemonic == "LDI":
+            return rng.randrange(5), rng.randrange(256)
+        op_type = OPCODES[mnemonic]["type"]
+        reg_a = rng.randrange(5)
+        reg_b = rng.randrange(8) if op_type == 2 else 0
+        return reg_a, reg_b
+
+    subs = []
+    if can_call:
+        for _ in range(rng.randrange(1, 3)):
+            body = []
+            for _ in range(rng.randrange(1, 4)):
+                mnemonic = rng.choice([m for m in plain if m not in ("JMP",) + CONDITIONAL_JUMPS] or ["LDI"])
+                reg_a, reg_b = operands(mnemonic)
+                body.append((mnemonic, reg_a, reg_b, None))
+            body.append(("RET", 0, 0, None))
+            subs.append(body)
+
+    main = []
+    depth = 0
+    for i in range(length):
+        mnemonic = random_item(depth)
+        if mnemonic == "PUSH":
+            depth += 1
+        elif mnemonic == "POP":
+            depth -= 1
+
+        reg_a, reg_b = operands(mnemonic)
+        target = None
+        if mnemonic == "JMP" or mnemonic in CONDITIONAL_JUMPS:
+            # Strictly forward, possibly straight to the final HLT
+            target = rng.randrange(i + 1, length + 1)
+        elif mnemonic == "CALL":
+            target = rng.randrange(len(subs))
+        main.append((mnemonic, reg_a, reg_b, target))
+
+    return {"main": main, "subs": subs}
+
+
+def generate_loop(rng, mnemonics):
+    """
+    A counted loop: set up a counter, a limit, a step and some other
+    registers, then a body of register arithmetic ending in CMP and a
+    conditional jump back to the top. The counter never wraps, so engines
+    without 8-bit arithmetic agree on the CMP; other registers may wrap
+    freely but are never printed. Now and then the body gets an instruction
+    that keeps it from being accelerated, or a step that isn't fixed.
+    """
+
+    counter, limit, step, jump, free = rng.sample(range(5), 5)
+    n = rng.randrange(1, 40)
+    d = rng.randrange(1, 6)
+
+    down = "SUB" in mnemonics and rng.random() < 0.3
+    if down:
+        # Counting down towards the limit, never below zero
+        end = rng.randrange(d, 256 - n * d)
+        start = end + n * d
+        condition = rng.choice(["JNE", "JGT", "JGE"])
+        count_op = "DEC" if d == 1 and "DEC" in mnemonics else "SUB"
+    else:
+        start = rng.randrange(0, 256 - n * d)
+        end = start + n * d
+        condition = rng.choice(["JNE", "JLT", "JLE"])
+        end -= d if condition == "JLE" else 0
+        count_op = "INC" if d == 1 and "INC" in mnemonics else "ADD"
+
+    main = [
+        ("LDI", counter, start, None),
+        ("LDI", limit, end, None),
+        ("LDI", step, d, None),
+        ("LDI", free, rng.randrange(256), None),
+    ]
+    head = len(main)
+
+    affine = [m for m in ("LDI", "ADD", "SUB", "INC", "DEC") if m in mnemonics]
+    other = [m for m in ("MUL", "AND", "OR", "XOR", "NOT") if m in mnemonics]
+    for _ in range(rng.randrange(4)):
+        if other and rng.random() < 0.15:
+            main.append((rng.choice(other), free, step, None))
+            continue
+        mnemonic = rng.choice(affine)
+        if mnemonic == "LDI":
+            main.append(("LDI", free, rng.randrange(256), None))
+        else:
+            # Usually adds the step, sometimes the counter itself
+            source = counter if rng.random() < 0.1 else step
+            main.append((mnemonic, free, source, None))
+
+    if count_op in ("INC", "DEC"):
+        main.append((count_op, counter, 0, None))
+    else:
+        main.append((count_op, counter, step, None))
+    main.append(("CMP", counter, limit, None))
+    main.append((condition, jump, 0, head))
+    main.append(("PRN", counter, 0, None))
+
+    return {"main": main, "subs": []}
+
+
+def layout(program_desc):
+    """
+    Lay out a program description as (bytes, lines) where lines are the
+    commented `.ls8` text.
+    """
+
+    def size(item):
+        mnemonic = item[0]
+        op_type = OPCODES[mnemonic]["type"]
+        n = {0: 1, 1: 2, 2: 3, 8: 3}[op_type]
+        if item[3] is not None:
+            # LDI of the target address first
+            n += 3
+        return n
+
+    main = program_desc["main"]
+    subs = program_desc["subs"]
+
+    main_addresses = []
+    addr = 0
+    for item in main:
+        main_addresses.append(addr)
+        addr += size(item)
+    # Address of the HLT after the main block
+    main_addresses.append(addr)
+    addr += 1
+
+    sub_addresses = []
+    for body in subs:
+        sub_addresses.append(addr)
+        addr += sum(size(item) for item in body)
+
+    program = []
+    lines = []
+
+    def emit(mnemonic, reg_a, reg_b, text):
+        code = OPCODES[mnemonic]["code"]
+        op_type = OPCODES[mnemonic]["type"]
+        lines.append(f"{code} # {text}")
+        program.append(int(code, 2))
+        if op_type in (1, 2, 8):
+            lines.append(p8(reg_a))
+            program.append(reg_a)
+        if op_type in (2, 8):
+            lines.append(p8(reg_b))
+            program.append(reg_b)
+
+    def emit_item(item, addresses):
+        mnemonic, reg_a, reg_b, target = item
+        op_type = OPCODES[mnemonic]["type"]
+        if target is not None:
+            if mnemonic == "CALL":
+                address = sub_addresses[target]
+            else:
+                address = addresses[target]
+            emit("LDI", reg_a, address, f"LDI R{reg_a},{address}")
+            emit(mnemonic, reg_a, 0, f"{mnemonic} R{reg_a}")
+        elif op_type == 8:
+            emit(mnemonic, reg_a, reg_b, f"{mnemonic} R{reg_a},{reg_b}")
+        elif op_type == 2:
+            emit(mnemonic, reg_a, reg_b, f"{mnemonic} R{reg_a},R{reg_b}")
+        elif op_type == 1:
+            emit(mnemonic, reg_a, 0, f"{mnemonic} R{reg_a}")
+        else:
+            emit(mnemonic, 0, 0, mnemonic)
+
+    for item in main:
+        emit_item(item, main_addresses)
+    emit("HLT", 0, 0, "HLT")
+    for number, body in enumerate(subs):
+        lines.append(f"# SUB{number} (address {sub_addresses[number]}):")
+        for item in body:
+            emit_item(item, None)
+
+    return program, lines
+
+
+# Filled in per process by `init_worker`
+ENGINES_COMMON_OPS = set()
+
+
+def common_ops(engines, ops=None):
+    common = set.intersection(*(ENGINES[name][1] for name in engines))
+    if ops:
+        common &= set(ops)
+    return common
+
+
+# ---------------------------------------------------------------------------
+# Minimization
+# ---------------------------------------------------------------------------
+
+def remove_item(program_desc, block, index):
+    """Copy of the program with one item removed, retargeting jumps."""
+
+    main = list(program_desc["main"])
+    subs = [list(body) for body in program_desc["subs"]]
+
+    if block == "main":
+        del main[index]
+        fixed = []
+        for mnemonic, reg_a, reg_b, target in main:
+            if target is not None and mnemonic != "CALL" and target > index:
+                target -= 1
+            fixed.append((mnemonic, reg_a, reg_b, target))
+        main = fixed
+    else:
+        del subs[block][index]
+
+    return {"main": main, "subs": subs}
+
+
+def minimize(program_desc, engines, budget, differing):
+    """
+    Greedily delete instructions while the engines still disagree on the
+    same fields. Repeats until no single deletion keeps the divergence.
+    """
+
+    def still_diverges(candidate):
+        program, _ = layout(candidate)
+        return compare(program, engines, budget) == differing
+
+    progress = True
+    while progress:
+        progress = False
+        positions = [("main", i) for i in range(len(program_desc["main"]))]
+        for number, body in enumerate(program_desc["subs"]):
+            # Keep the RET at the end of each subroutine
+            positions += [(number, i) for i in range(len(body) - 1)]
+
+        for block, index in reversed(positions):
+            candidate = remove_item(program_desc, block, index)
+            if still_diverges(candidate):
+                program_desc = candidate
+                progress = True
+                break
+
+    return program_desc
+
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+
+def init_worker(engines, ops):
+    global ENGINES_COMMON_OPS
+    ENGINES_COMMON_OPS = common_ops(engines, ops)
+
+
+def fuzz_one(job):
+    seed, engines, budget, length, counted_loops = job
+    rng = random.Random(seed)
+    if counted_loops:
+        program_desc = generate_loop(rng, ENGINES_COMMON_OPS)
+    else:
+        program_desc = generate(rng, ENGINES_COMMON_OPS, rng.randrange(1, length + 1))
+    program, _ = layout(program_desc)
+
+    if len(program) > MAX_PROGRAM_SIZE:
+        return seed, None, None
+
+    differing = compare(program, engines, budget)
+    if differing is None:
+        return seed, None, None
+
+    reduced = minimize(program_desc, engines, budget, differing)
+    return seed, differing, layout(reduced)[1]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Differential fuzzer for the LS-8 engines")
+    parser.add_argument("-n", "--programs", type=int, default=1000)
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("-e", "--engines", default="cpu,table,fast")
+    parser.add_argument("--ops", default=None,
+                        help="restrict to these mnemonics (comma separated)")
+    parser.add_argument("--budget", type=int, default=10000,
+                        help="instruction budget per run")
+    parser.add_argument("--length", type=int, default=24,
+                        help="maximum instructions per generated program")
+    parser.add_argument("--loops", action="store_true",
+                        help="generate counted loops instead of forward-only programs")
+    parser.add_argument("-o", "--output", default=None,
+                        help="directory to write reproducers to")
+    args = parser.parse_args(argv[1:])
+
+    engines = args.engines.split(",")
+    for name in engines:
+        if name not in ENGINES:
+            print(f"unknown engine {name}", file=sys.stderr)
+            return 2
+    ops = args.ops.split(",") if args.ops else None
+
+    print(f"engines: {', '.join(engines)}")
+    print(f"opcodes: {', '.join(sorted(common_ops(engines, ops)))}")
+
+    jobs = [(seed, engines, args.budget, args.length, args.loops)
+            for seed in range(args.seed, args.seed + args.programs)]
+
+    failures = 0
+    with multiprocessing.Pool(args.jobs, initializer=init_worker,
+                              initargs=(engines, ops)) as pool:
+        for seed, differing, lines in pool.imap_unordered(fuzz_one, jobs, chunksize=16):
+            if differing is None:
+                continue
+            failures += 1
+            print(f"\nseed {seed}: engines disagree on {', '.join(differing)}")
+            for line in lines:
+                print(f"    {line}")
+            if args.output:
+                os.makedirs(args.output, exist_ok=True)
+                with open(os.path.join(args.output, f"seed-{seed}.ls8"), "w") as f:
+                    f.write("\n".join(lines) + "\n")
+
+    print(f"\n{args.programs} programs, {failures} divergent")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
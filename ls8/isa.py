@@ -0,0 +1,228 @@
+"""The LS-8 instruction set, described once.
+
+Everything else that needs to know about opcodes is generated from
+`INSTRUCTIONS` when this module is imported: the opcode constants (`isa.LDI`
+and so on), the assembler's `OPCODES` table, the CPUs' 256-entry dispatch
+tables and the disassembler.
+
+Opcode bytes are laid out `AABCDDDD` (see LS8-spec.md):
+
+* `AA` is the number of operands
+* `B` is set for ALU operations
+* `C` is set if the instruction sets the PC itself
+* `DDDD` tells instructions with the same `AABC` apart
+
+so how far the PC moves after an instruction follows from the opcode alone.
+Each entry's fields are checked against its opcode bits at import time.
+
+`EXTENSIONS` are optional block-memory instructions outside the spec. They
+only assemble with `asm.py -x` and only run on `FastCPU(extensions=True)`;
+everywhere else their opcodes stay invalid. Each takes a register pair
+`rA`, `rA+1` holding an address and a byte count (addresses wrap at 0xFF):
+
+* `COPY rA,rB`  copy R(A+1) bytes from the address in rB to the one in rA,
+  as if through a buffer, so the two ranges may overlap
+* `FILL rA,rB`  set R(A+1) bytes from the address in rA to the value in rB
+* `PRS rA`      print R(A+1) bytes from the address in rA as characters
+"""
+
+from collections import namedtuple
+
+# `operands` is one letter per operand: "r" a register, "i" an immediate
+Instruction = namedtuple("Instruction", ["mnemonic", "opcode", "operands", "sets_pc", "alu"])
+
+INSTRUCTIONS = [
+    Instruction("ADD",  0b10100000, "rr", False, True),
+    Instruction("AND",  0b10101000, "rr", False, True),
+    Instruction("CALL", 0b01010000, "r",  True,  False),
+    Instruction("CMP",  0b10100111, "rr", False, True),
+    Instruction("DEC",  0b01100110, "r",  False, True),
+    Instruction("DIV",  0b10100011, "rr", False, True),
+    Instruction("HLT",  0b00000001, "",   False, False),
+    Instruction("INC",  0b01100101, "r",  False, True),
+    Instruction("INT",  0b01010010, "r",  True,  False),
+    Instruction("IRET", 0b00010011, "",   True,  False),
+    Instruction("JEQ",  0b01010101, "r",  True,  False),
+    Instruction("JGE",  0b01011010, "r",  True,  False),
+    Instruction("JGT",  0b01010111, "r",  True,  False),
+    Instruction("JLE",  0b01011001, "r",  True,  False),
+    Instruction("JLT",  0b01011000, "r",  True,  False),
+    Instruction("JMP",  0b01010100, "r",  True,  False),
+    Instruction("JNE",  0b01010110, "r",  True,  False),
+    Instruction("LD",   0b10000011, "rr", False, False),
+    Instruction("LDI",  0b10000010, "ri", False, False),
+    Instruction("MOD",  0b10100100, "rr", False, True),
+    Instruction("MUL",  0b10100010, "rr", False, True),
+    Instruction("NOP",  0b00000000, "",   False, False),
+    Instruction("NOT",  0b01101001, "r",  False, True),
+    Instruction("OR",   0b10101010, "rr", False, True),
+    Instruction("POP",  0b01000110, "r",  False, False),
+    Instruction("PRA",  0b01001000, "r",  False, False),
+    Instruction("PRN",  0b01000111, "r",  False, False),
+    Instruction("PUSH", 0b01000101, "r",  False, False),
+    Instruction("RET",  0b00010001, "",   True,  False),
+    Instruction("SHL",  0b10101100, "rr", False, True),
+    Instruction("SHR",  0b10101101, "rr", False, True),
+    Instruction("ST",   0b10000100, "rr", False, False),
+    Instruction("SUB",  0b10100001, "rr", False, True),
+    Instruction("XOR",  0b10101011, "rr", False, True),
+]
+
+EXTENSIONS = [
+    Instruction("COPY", 0b10000101, "rr", False, False),
+    Instruction("FILL", 0b10000110, "rr", False, False),
+    Instruction("PRS",  0b01001001, "r",  False, False),
+]
+
+# Registers each instruction reads and writes, for asm.py's peephole
+# optimizer and memo.py: "a" and "b" are the operands, "s" is the stack
+# pointer R7, "n" is the register after "a" (the byte count of the block
+# instructions)
+REG_USE = {
+    "ADD":  ("ab", "a"),
+    "AND":  ("ab", "a"),
+    "CALL": ("as", "s"),
+    "CMP":  ("ab", ""),
+    "DEC":  ("a", "a"),
+    "DIV":  ("ab", "a"),
+    "HLT":  ("", ""),
+    "INC":  ("a", "a"),
+    "INT":  ("as", "s"),
+    "IRET": ("s", "s"),
+    "JEQ":  ("a", ""),
+    "JGE":  ("a", ""),
+    "JGT":  ("a", ""),
+    "JLE":  ("a", ""),
+    "JLT":  ("a", ""),
+    "JMP":  ("a", ""),
+    "JNE":  ("a", ""),
+    "LD":   ("b", "a"),
+    "LDI":  ("", "a"),
+    "MOD":  ("ab", "a"),
+    "MUL":  ("ab", "a"),
+    "NOP":  ("", ""),
+    "NOT":  ("a", "a"),
+    "OR":   ("ab", "a"),
+    "POP":  ("s", "as"),
+    "PRA":  ("a", ""),
+    "PRN":  ("a", ""),
+    "PUSH": ("as", "s"),
+    "RET":  ("s", "s"),
+    "SHL":  ("ab", "a"),
+    "SHR":  ("ab", "a"),
+    "ST":   ("ab", ""),
+    "SUB":  ("ab", "a"),
+    "XOR":  ("ab", "a"),
+    # EXTENSIONS
+    "COPY": ("anb", ""),
+    "FILL": ("anb", ""),
+    "PRS":  ("an", ""),
+}
+
+# Conditional jumps: fall through with registers untouched
+COND_JUMPS = {"JEQ", "JGE", "JGT", "JLE", "JLT", "JNE"}
+
+# Opcode bits
+OPERANDS_SHIFT = 6
+ALU_BIT = 0b00100000
+SETS_PC_BIT = 0b00010000
+
+
+def operand_count(opcode):
+    return opcode >> OPERANDS_SHIFT
+
+
+def instruction_size(opcode):
+    return 1 + (opcode >> OPERANDS_SHIFT)
+
+
+def check(instruction):
+    """Make sure an entry agrees with the bits of its own opcode."""
+
+    opcode = instruction.opcode
+    if (operand_count(opcode) != len(instruction.operands) or
+            bool(opcode & SETS_PC_BIT) != instruction.sets_pc or
+            bool(opcode & ALU_BIT) != instruction.alu):
+        raise ValueError(f"{instruction.mnemonic}: fields don't match opcode {opcode:08b}")
+
+
+for instruction in INSTRUCTIONS + EXTENSIONS:
+    check(instruction)
+    if instruction.mnemonic not in REG_USE:
+        raise ValueError(f"{instruction.mnemonic}: no REG_USE entry")
+
+# Standard instructions only, so disassembly doesn't depend on the flag
+BY_MNEMONIC = {instruction.mnemonic: instruction for instruction in INSTRUCTIONS}
+BY_OPCODE = {instruction.opcode: instruction for instruction in INSTRUCTIONS}
+
+EXTENSION_BY_MNEMONIC = {instruction.mnemonic: instruction for instruction in EXTENSIONS}
+
+if len({instruction.opcode for instruction in INSTRUCTIONS + EXTENSIONS}) != \
+        len(INSTRUCTIONS) + len(EXTENSIONS):
+    raise ValueError("two instructions share an opcode")
+
+# Opcode constants: isa.HLT, isa.LDI, ..., isa.COPY
+globals().update({instruction.mnemonic: instruction.opcode
+                  for instruction in INSTRUCTIONS + EXTENSIONS})
+
+# How far the PC moves after each opcode byte: past its operands, or not at
+# all if the instruction sets the PC itself
+ADVANCE = tuple(0 if opcode & SETS_PC_BIT else instruction_size(opcode)
+                for opcode in range(256))
+
+
+def dispatch_table(handlers, default):
+    """
+    A 256-entry list indexed by opcode byte, from a dict of mnemonic ->
+    handler. Opcodes without a handler get `default`.
+    """
+
+    table = [default] * 256
+    for mnemonic, handler in handlers.items():
+        instruction = BY_MNEMONIC.get(mnemonic) or EXTENSION_BY_MNEMONIC[mnemonic]
+        table[instruction.opcode] = handler
+    return table
+
+
+def asm_opcodes(extensions = False):
+    """
+    The assembler's OPCODES table: mnemonic -> {"type", "code"}, with the
+    EXTENSIONS too if `extensions` is set.
+    """
+
+    opcodes = {}
+    for instruction in INSTRUCTIONS + (EXTENSIONS if extensions else []):
+        if "i" in instruction.operands:
+            # LDI r,i or LDI r,label
+            op_type = 8
+        else:
+            op_type = len(instruction.operands)
+        opcodes[instruction.mnemonic] = {"type": op_type, "code": f"{instruction.opcode:08b}"}
+    return opcodes
+
+
+def disassemble(ram, address):
+    """
+    Disassemble the instruction at `address`. Returns its text in assembler
+    syntax and its size in bytes. Bytes that aren't a valid instruction come
+    out as a one-byte `DB`.
+    """
+
+    opcode = ram[address & 0xFF]
+    instruction = BY_OPCODE.get(opcode)
+    if instruction is None:
+        return f"DB 0x{opcode:02X}", 1
+
+    operands = []
+    for i, kind in enumerate(instruction.operands, 1):
+        value = ram[(address + i) & 0xFF]
+        if kind == "r":
+            if value > 7:
+                return f"DB 0x{opcode:02X}", 1
+            operands.append(f"R{value}")
+        else:
+            operands.append(f"0x{value:02X}")
+
+    if operands:
+        return f"{instruction.mnemonic} {','.join(operands)}", instruction_size(opcode)
+    return instruction.mnemonic, 1
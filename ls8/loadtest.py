@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""Load test for `serve.py`.
+
+    python3 loadtest.py [--host HOST --port PORT] [-c CONNECTIONS] [-n REQUESTS]
+                        [--max-cycles N] [program.ls8 | program.asm]
+
+Opens `-c` connections, each sending one request at a time until `-n`
+requests have completed between them, and reports requests per second and
+the p50/p99 latency from sending a request to its final message. Without
+`--port` a server is started on a free localhost port for the duration of
+the test and stopped afterwards, so the whole thing runs on one machine.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from cpu_fast import LS8Error, parse_program
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, p):
+    """The `p`th percentile of sorted `values`, by nearest rank."""
+
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def make_request(path, max_cycles):
+    """The request line for running `path`."""
+
+    with open(path) as f:
+        if path.endswith(".asm"):
+            request = {"asm": f.read()}
+        else:
+            request = {"image": bytes(parse_program(f, path)).hex()}
+    if max_cycles is not None:
+        request["max_cycles"] = max_cycles
+    return request
+
+
+async def client(host, port, request, remaining, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("server closed the connection")
+                message = json.loads(line)
+                if "output" not in message:
+                    break
+            latencies.append(time.perf_counter() - start)
+            if "error" in message:
+                errors.append(message["error"])
+    finally:
+        writer.close()
+
+
+async def load(host, port, request, connections, count):
+    remaining = [count]
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, request, remaining, latencies, errors)
+                           for _ in range(connections)))
+    return time.perf_counter() - start, sorted(latencies), errors
+
+
+def start_server(workers):
+    """A serve.py on a free localhost port, and the port."""
+
+    command = [sys.executable, os.path.join(HERE, "serve.py"), "--port", "0"]
+    if workers is not None:
+        command += ["--workers", str(workers)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line.startswith("listening on "):
+        server.kill()
+        raise OSError("serve.py did not start")
+    return server, int(line.rsplit(":", 1)[1])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load test an LS-8 TCP service")
+    parser.add_argument("program", nargs="?", default=os.path.join(HERE, "examples", "mult.ls8"),
+                        help=".ls8 image or .asm source to send")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None,
+                        help="server to test (default: start one)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes for the server started here")
+    parser.add_argument("-c", "--connections", type=int, default=16)
+    parser.add_argument("-n", "--requests", type=int, default=2000)
+    parser.add_argument("--max-cycles", type=int, default=None)
+    args = parser.parse_args(argv[1:])
+
+    try:
+        request = make_request(args.program, args.max_cycles)
+    except (OSError, LS8Error) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    server = None
+    port = args.port
+    try:
+        if port is None:
+            server, port = start_server(args.workers)
+        elapsed, latencies, errors = asyncio.run(
+            load(args.host, port, request, args.connections, args.requests))
+    except OSError as e:
+        print(f"loadtest: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    done = len(latencies)
+    print(f"{done} requests over {args.connections} connections in {elapsed:.2f}s: "
+          f"{done / elapsed:.1f} req/s")
+    print(f"latency p50 {percentile(latencies, 50) * 1000:.2f}ms  "
+          f"p99 {percentile(latencies, 99) * 1000:.2f}ms  "
+          f"max {latencies[-1] * 1000 if latencies else 0:.2f}ms")
+    if errors:
+        print(f"{len(errors)} errors, first: {errors[0]}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
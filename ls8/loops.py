@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+"""Closed-form acceleration of simple counted loops.
+
+    python3 loops.py program.ls8 [--threshold N] [--max-cycles N]
+
+Attach a `LoopAccelerator` to a FastCPU and it watches conditional jumps
+that go backwards. Once one has been taken `threshold` times, the code from
+its target up to the jump is checked for the shape
+
+    Loop:
+        LDI / INC / DEC / ADD / SUB / CMP / NOP ...
+        J<cond> R<n>                ; R<n> holds Loop
+
+with no memory access, I/O, calls or other jumps, where every register the
+body writes is either set to a constant or moved by a fixed amount each time
+round (`ADD R0,R1` with R1 constant over the loop, `INC`, `LDI`, ...). For
+such a loop the values the CMP sees are affine in the iteration number, so
+the number of iterations left falls out of a linear congruence (JNE) or a
+scan of at most 256 comparisons (the rest), and the final registers and FL
+are computed directly. Anything else, including a loop that never exits,
+is left to the interpreter. Whether a loop fits is cached per jump and only
+looked at again if the loop's code changes.
+
+Skipped instructions are added to `cpu.cycles`, so `run(max_cycles=...)`
+can overshoot its limit by up to one loop. Nothing is accelerated while
+interrupts are enabled in IM.
+
+`fuzz.py --loops -e table,loops` checks the results against `cpu_table.CPU`
+on generated loops.
+"""
+
+import argparse
+import math
+import sys
+
+import isa
+from cpu_fast import FastCPU, LS8Error, JUMP_CONDITIONS, FL_E, IM
+from isa import LDI, INC, DEC, ADD, SUB, CMP, NOP
+
+# Back edges taken before a loop is looked at
+HOT_THRESHOLD = 16
+
+# Instructions allowed in a loop body
+BODY_OPS = {LDI, INC, DEC, ADD, SUB, CMP, NOP}
+
+# Registers a loop body may not write: IM, IS and SP
+RESERVED_REGS = {5, 6, 7}
+
+
+def flags(a, b):
+    return (a < b) << 2 | (a > b) << 1 | (a == b)
+
+
+def first_zero(a, b):
+    """Smallest k >= 1 with a + k*b == 0 (mod 256), or None."""
+
+    g = math.gcd(b % 256, 256)
+    if a % g:
+        return None
+    m = 256 // g
+    k = (-a // g) * pow(b // g, -1, m) % m if m > 1 else 0
+    return k or m
+
+
+class Loop:
+    """One iteration of a loop body, reduced to its effect on the registers."""
+
+    def __init__(self, length, end, cmp, jump_reg, mask, when_set):
+        # Instructions per iteration, jump included
+        self.length = length
+        # Register -> ("const", value) or ("add", amount) after one iteration
+        self.end = end
+        # What the CMP compares, in the same form, as of the CMP
+        self.cmp = cmp
+        self.jump_reg = jump_reg
+        self.taken = tuple(bool(fl & mask) == when_set for fl in range(8))
+        self.mask = mask
+        self.when_set = when_set
+
+
+def decode_body(ram, head, jump_pc):
+    """
+    The instructions from `head` up to the jump at `jump_pc` as (opcode,
+    operand a, operand b), or None if that isn't straight-line code made of
+    BODY_OPS.
+    """
+
+    body = []
+    address = head
+    while address < jump_pc:
+        opcode = ram[address]
+        if opcode not in BODY_OPS:
+            return None
+        size = isa.instruction_size(opcode)
+        operand_a = ram[(address + 1) & 0xFF] if size > 1 else 0
+        operand_b = ram[(address + 2) & 0xFF] if size > 2 else 0
+        if operand_a > 7 or (opcode in (ADD, SUB, CMP) and operand_b > 7):
+            return None
+        body.append((opcode, operand_a, operand_b))
+        address += size
+    if address != jump_pc:
+        return None
+    return body
+
+
+def analyze(body, reg, jump_opcode, jump_reg):
+    """
+    Symbolically run one iteration of `body` starting from `reg`. Returns a
+    Loop, or None if some register doesn't change by a fixed amount.
+    """
+
+    written = set()
+    for opcode, operand_a, operand_b in body:
+        if opcode not in (CMP, NOP):
+            written.add(operand_a)
+    if written & RESERVED_REGS:
+        return None
+
+    state = {r: ("add", 0) for r in range(8)}
+    cmp = None
+
+    def amount(r):
+        kind, value = state[r]
+        if kind == "const":
+            return value
+        if r not in written:
+            # Not touched by the loop, so the same every time round
+            return reg[r]
+        return None
+
+    for opcode, operand_a, operand_b in body:
+        if opcode == LDI:
+            state[operand_a] = ("const", operand_b)
+        elif opcode in (INC, DEC, ADD, SUB):
+            if opcode == INC:
+                delta = 1
+            elif opcode == DEC:
+                delta = -1
+            else:
+                delta = amount(operand_b)
+                if delta is None:
+                    return None
+                if opcode == SUB:
+                    delta = -delta
+            kind, value = state[operand_a]
+            state[operand_a] = (kind, (value + delta) & 0xFF)
+        elif opcode == CMP:
+            cmp = (state[operand_a], operand_a, state[operand_b], operand_b)
+
+    if cmp is None:
+        return None
+    # The jump has to go back to the same place every time
+    kind, value = state[jump_reg]
+    if kind == "add" and value != 0:
+        return None
+
+    mask, when_set = JUMP_CONDITIONS[jump_opcode]
+    return Loop(len(body) + 1, state, cmp, jump_reg, mask, when_set)
+
+
+class LoopAccelerator:
+    def __init__(self, cpu, threshold = HOT_THRESHOLD):
+        self.cpu = cpu
+        # The table we replace, put back by `uninstall`
+        self.base = cpu.dispatch
+        self.threshold = threshold
+        # Jump address -> times taken backwards
+        self.counts = {}
+        # (jump address, loop head) -> (body bytes, decoded body or None)
+        self.bodies = {}
+        self.stats = {
+            "accelerated": 0,
+            "iterations": 0,
+            "instructions": 0,
+            "rejected": 0,
+        }
+        self.install()
+
+    def install(self):
+        self.cpu.dispatch = list(self.base)
+        for opcode in JUMP_CONDITIONS:
+            self.cpu.dispatch[opcode] = self.make_back_edge(opcode, self.base[opcode])
+
+    def uninstall(self):
+        self.cpu.dispatch = self.base
+
+    def make_back_edge(self, opcode, original):
+        mask, when_set = JUMP_CONDITIONS[opcode]
+        taken = tuple(bool(fl & mask) == when_set for fl in range(8))
+        counts = self.counts
+        threshold = self.threshold
+
+        def back_edge(cpu, reg_num, operand_b):
+            pc = cpu.pc & 0xFF
+            if taken[cpu.fl] and cpu.reg[reg_num] <= pc:
+                count = counts.get(pc, 0) + 1
+                counts[pc] = count
+                if count >= threshold and self.accelerate(opcode, reg_num):
+                    return
+            original(cpu, reg_num, operand_b)
+
+        return back_edge
+
+    def body(self, head, jump_pc):
+        """Decoded body between `head` and `jump_pc`, cached until its code changes."""
+
+        code = bytes(self.cpu.ram[head:jump_pc])
+        cached = self.bodies.get((jump_pc, head))
+        if cached is None or cached[0] != code:
+            body = decode_body(self.cpu.ram, head, jump_pc)
+            cached = self.bodies[(jump_pc, head)] = (code, body)
+            if body is None:
+                self.stats["rejected"] += 1
+        return cached[1]
+
+    def reject(self, head, jump_pc):
+        """Don't look at this loop again until its code changes."""
+
+        key = (jump_pc, head)
+        self.bodies[key] = (self.bodies[key][0], None)
+        self.stats["rejected"] += 1
+
+    def accelerate(self, opcode, reg_num):
+        """
+        Finish the loop whose back edge is about to be taken in one step.
+        Returns False, leaving the CPU untouched, if it can't be done.
+        """
+
+        cpu = self.cpu
+        reg = cpu.reg
+        jump_pc = cpu.pc & 0xFF
+        head = reg[reg_num]
+        if reg[IM]:
+            return False
+
+        body = self.body(head, jump_pc)
+        if body is None:
+            return False
+        loop = analyze(body, reg, opcode, reg_num)
+        if loop is None:
+            # Whether a body fits doesn't depend on the register values
+            self.reject(head, jump_pc)
+            return False
+
+        n = self.iterations(loop, reg)
+        if n is None:
+            # It never exits, and won't from any later trip round either
+            self.reject(head, jump_pc)
+            return False
+
+        x, y = self.compared(loop, reg, n)
+        for r, (kind, value) in loop.end.items():
+            if kind == "const":
+                reg[r] = value
+            elif value:
+                reg[r] = (reg[r] + n * value) & 0xFF
+        cpu.fl = flags(x, y)
+        cpu.pc = jump_pc + 2
+        cpu.cycles += n * loop.length
+
+        self.stats["accelerated"] += 1
+        self.stats["iterations"] += n
+        self.stats["instructions"] += n * loop.length
+        return True
+
+    def compared(self, loop, reg, k):
+        """The two values the CMP sees in iteration `k`, counting from 1."""
+
+        values = []
+        for (kind, value), r in (loop.cmp[0:2], loop.cmp[2:4]):
+            if kind == "const":
+                values.append(value)
+            else:
+                step = loop.end[r][1] if loop.end[r][0] == "add" else 0
+                values.append((reg[r] + (k - 1) * step + value) & 0xFF)
+        return values
+
+    def iterations(self, loop, reg):
+        """Iterations until the jump falls through, or None if it never does."""
+
+        if loop.mask == FL_E and not loop.when_set:
+            # JNE falls through once the difference between the compared
+            # values, which moves by a fixed step, comes round to zero
+            x1, y1 = self.compared(loop, reg, 1)
+            x2, y2 = self.compared(loop, reg, 2)
+            step = (x2 - y2) - (x1 - y1)
+            return first_zero((x1 - y1) - step, step)
+
+        # Everything the CMP sees repeats within 256 iterations
+        for k in range(1, 257):
+            if not loop.taken[flags(*self.compared(loop, reg, k))]:
+                return k
+        return None
+
+    def print_stats(self, out = sys.stdout):
+        stats = self.stats
+        print(f"loops: {stats['accelerated']} accelerated, {stats['rejected']} rejected, "
+              f"{stats['iterations']} iterations / {stats['instructions']} instructions skipped",
+              file=out)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run an LS-8 program with counted loops accelerated")
+    parser.add_argument("program", help=".ls8 file")
+    parser.add_argument("--threshold", type=int, default=HOT_THRESHOLD,
+                        help="back edges taken before a loop is accelerated")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    args = parser.parse_args(argv[1:])
+
+    cpu = FastCPU()
+    accelerator = LoopAccelerator(cpu, args.threshold)
+    try:
+        cpu.load(args.program)
+        result = cpu.run(max_cycles=args.max_cycles)
+    except LS8Error as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    print(f"{result.reason} after {cpu.cycles} instructions", file=sys.stderr)
+    accelerator.print_stats(sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -5,9 +5,61 @@
 import sys
 from cpu_table import *
 
+args = sys.argv[1:]
+cache_dir = None
+extensions = False
+while args[:1] in (["--cache"], ["--ext"]):
+    if args[0] == "--ext":
+        # Run on FastCPU with the block instructions from isa.EXTENSIONS
+        extensions = True
+        args = args[1:]
+    elif len(args) > 1:
+        # Serve repeat runs of the same image from the result cache
+        cache_dir = args[1]
+        args = args[2:]
+    else:
+        break
+
+if len(args) < 1:
+    print("Please pass in a second filename: python3 ls8.py [--ext] [--cache DIR] second_filename.ls8")
+    sys.exit()
+
+file_name = args[0]
+
+if cache_dir is not None or extensions:
+    import cpu_fast
+    import runcache
+
+    try:
+        with open(file_name) as f:
+            image = cpu_fast.parse_program(f, file_name)
+    except FileNotFoundError:
+        print(f'{sys.argv[0]}: {file_name} file was not found')
+        sys.exit()
+
+    cpu = cpu_fast.FastCPU(extensions)
+    cache = runcache.ResultCache(cache_dir) if cache_dir is not None else None
+    try:
+        cpu.load_image(image)
+        if cache is not None:
+            result = cache.run(image, cpu=cpu)
+        else:
+            result = runcache.run_uncached(image, cpu=cpu)
+    except cpu_fast.LS8Error as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        if cache is not None:
+            cache.close()
+    print(result.output, end='')
+    sys.exit()
+
 cpu = CPU()
 
-file_name = sys.argv[1]
+try:
+    cpu.load(file_name)
+except FileNotFoundError:
+    print(f'{sys.argv[0]}: {file_name} file was not found')
+    sys.exit()
 
-cpu.load(file_name)
-cpu.run()
\ No newline at end of file
+cpu.run()
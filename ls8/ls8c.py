@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+"""Thin client for the LS-8 worker.
+
+    python3 ls8c.py [--max-cycles N] [--watchdog] program.ls8 ...
+
+Runs programs on a long-lived `worker.py` instead of starting an emulator
+each time, printing what each one prints, in order. If no worker is
+listening on the socket one is started in the background; it exits again
+after `IDLE_TIMEOUT` seconds without a connection. Several programs on one
+command line are sent ahead of their results, which are read back as they
+finish.
+
+This module imports as little as it can get away with, so running it costs
+little more than starting Python: `_socket` and `_json` rather than `socket`
+and `json`, which pull in `enum` and `re` and would cost more than the rest
+of a run, and `subprocess` only when a worker has to be started. Per
+program, starting Python is still most of the cost; the big win is sending
+many programs from one process. `Client` can also be used from other code:
+
+    with Client() as client:
+        for result in client.run_many(["a.ls8", "b.ls8"]):
+            print(result["output"], end="")
+
+The protocol is one JSON object per line each way. A request is
+
+    {"id": any, "program": "/abs/path.ls8"}   or   {"id": any, "image": "hex bytes"}
+
+plus optional "max_cycles", "timeout" (seconds), "watchdog" (bool) and
+"events" ([[cycle, kind, value], ...], as in `replay.py`). Each gets one
+response, in the order the requests were sent, of either
+
+    {"id": ..., "reason": ..., "cycles": ..., "output": ..., "loop": ...}
+    {"id": ..., "error": "message"}
+"""
+
+import _json
+import _socket
+import os
+import sys
+import time
+
+# How long an auto-started worker waits for a connection before exiting
+IDLE_TIMEOUT = 600
+
+# How long to wait for an auto-started worker to start listening
+START_TIMEOUT = 5.0
+
+# Requests `run_many` sends ahead of the responses it has read
+WINDOW = 64
+
+
+class JSONContext:
+    # What `_json.make_scanner` reads off a `json.JSONDecoder`
+    strict = True
+    object_hook = None
+    object_pairs_hook = None
+    parse_float = float
+    parse_int = int
+    parse_constant = float
+
+
+scan_json = _json.make_scanner(JSONContext())
+encode_json = _json.make_encoder(None, None, _json.encode_basestring_ascii, None,
+                                 ": ", ", ", False, False, True)
+
+
+def socket_path():
+    """Where the worker listens: $LS8_WORKER, or a per-user socket in the temp dir."""
+
+    path = os.environ.get("LS8_WORKER")
+    if path:
+        return path
+    # Not tempfile.gettempdir(), which costs more to import than the rest
+    return os.path.join(os.environ.get("TMPDIR", "/tmp"), f"ls8-worker-{os.getuid()}.sock")
+
+
+def start_worker(path):
+    """Start a worker in the background listening on `path`."""
+
+    import subprocess
+
+    worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+    subprocess.Popen([sys.executable, worker, "--socket", path,
+                      "--idle-timeout", str(IDLE_TIMEOUT)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def connect(path = None, spawn = True):
+    """A socket connected to the worker, starting one if needed."""
+
+    path = path or socket_path()
+    deadline = None
+    while True:
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if not spawn:
+                raise
+        if deadline is None:
+            start_worker(path)
+            deadline = time.monotonic() + START_TIMEOUT
+        elif time.monotonic() > deadline:
+            raise ConnectionRefusedError(f"worker did not start listening on {path}")
+        time.sleep(0.01)
+
+
+class Client:
+    def __init__(self, path = None, spawn = True):
+        self.sock = connect(path, spawn)
+        # Requests not sent yet, and what has been received past the last
+        # complete response
+        self.outgoing = []
+        self.incoming = bytearray()
+
+    def send(self, request):
+        self.outgoing.extend(encode_json(request, 0))
+        self.outgoing.append("\n")
+
+    def flush(self):
+        if self.outgoing:
+            self.sock.sendall("".join(self.outgoing).encode())
+            self.outgoing = []
+
+    def receive(self):
+        incoming = self.incoming
+        searched = 0
+        while True:
+            end = incoming.find(b"\n", searched)
+            if end >= 0:
+                break
+            searched = len(incoming)
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("worker closed the connection")
+            incoming += data
+        line = incoming[:end].decode()
+        del incoming[:end + 1]
+        return scan_json(line, 0)[0]
+
+    def request(self, program = None, image = None, **limits):
+        """A request for `program` (a path) or `image` (bytes) with `limits`."""
+
+        request = {key: value for key, value in limits.items() if value is not None}
+        if program is not None:
+            request["program"] = os.path.abspath(program)
+        else:
+            request["image"] = bytes(image).hex()
+        return request
+
+    def run(self, program = None, image = None, **limits):
+        """Run one program and return its response."""
+
+        self.send(self.request(program, image, **limits))
+        self.flush()
+        return self.receive()
+
+    def run_many(self, programs, **limits):
+        """
+        Send the programs in `programs` and yield the responses as they come
+        back, in the same order. Up to `WINDOW` requests are kept in flight:
+        sending everything before reading anything would leave both sides
+        blocked on full socket buffers once the batch is big enough.
+        """
+
+        in_flight = 0
+        for i, program in enumerate(programs):
+            if in_flight == WINDOW:
+                self.flush()
+                yield self.receive()
+                in_flight -= 1
+            request = self.request(program, **limits)
+            request["id"] = i
+            self.send(request)
+            in_flight += 1
+        self.flush()
+        for _ in range(in_flight):
+            yield self.receive()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv):
+    args = argv[1:]
+    limits = {}
+    while args and args[0].startswith("--"):
+        if args[0] == "--watchdog":
+            limits["watchdog"] = True
+            args = args[1:]
+        elif args[0] == "--max-cycles" and len(args) > 1:
+            limits["max_cycles"] = int(args[1])
+            args = args[2:]
+        else:
+            break
+    if not args:
+        print("usage: ls8c.py [--max-cycles N] [--watchdog] program.ls8 ...", file=sys.stderr)
+        return 1
+
+    failures = 0
+    try:
+        with Client() as client:
+            for program, result in zip(args, client.run_many(args, **limits)):
+                if "error" in result:
+                    print(result["error"], file=sys.stderr)
+                    failures += 1
+                    continue
+                sys.stdout.write(result["output"])
+                if result["reason"] != "halted":
+                    print(f"{program}: {result['reason']} after {result['cycles']} instructions",
+                          file=sys.stderr)
+    except OSError as e:
+        print(f"ls8c: {e}", file=sys.stderr)
+        return 1
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
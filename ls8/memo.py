@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+"""Memoization of subroutines called with CALL.
+
+    python3 memo.py program.ls8 [--size N] [--max-cycles N]
+
+Opt in by attaching a `Memoizer` to a FastCPU. It swaps CALL in the CPU's
+dispatch table for one that looks the call up before making it. On a miss
+the call is made and the body is recorded until the matching RET:
+
+* the registers (and FL) it reads before writing them, with their values
+* every RAM byte it reads before writing it, its own code included
+* the final value of every register and RAM byte it writes
+* what it prints, and how many instructions it took
+
+A later CALL to the same address with the same values in those registers
+doesn't run the body: the CALL's push is done, the recorded writes and
+output are replayed and execution carries on after the CALL.
+
+An entry is dropped as soon as an instruction writes a RAM byte it read
+(code or data). Writes from the host (`ram_write`, `post_key`, loading a new
+image) aren't seen, so call `clear()` after those. Bodies that read the
+keyboard byte, raise or return from interrupts, enable interrupts, write
+their own inputs or run longer than `max_body` instructions aren't cached,
+and nothing is looked up while interrupts are enabled in IM. Hits add the
+skipped instructions to `cpu.cycles`, so `run(max_cycles=...)` can overshoot
+its limit by up to one body.
+
+    memo = Memoizer(cpu, max_entries=256)
+    cpu.run()
+    memo.print_stats()
+"""
+
+import argparse
+import sys
+from collections import OrderedDict, namedtuple
+
+import isa
+from cpu_fast import FastCPU, LS8Error, RAM_WRITES, IM, SP, KEY_PRESSED
+from isa import CALL, RET, LD, POP, PRN, PRA, INT, IRET, CMP, REG_USE, COND_JUMPS
+
+# FL is tracked as a ninth register
+FL = 8
+
+# Per opcode: register reads and writes in REG_USE's letters ("a", "b" the
+# operands, "s" the SP, "f" FL), or None for opcodes that can't be recorded
+REGISTER_USE = [None] * 256
+for instruction in isa.INSTRUCTIONS:
+    reads, writes = REG_USE[instruction.mnemonic]
+    if instruction.mnemonic in COND_JUMPS:
+        reads += "f"
+    if instruction.opcode == CMP:
+        writes += "f"
+    REGISTER_USE[instruction.opcode] = (reads, writes)
+
+# What a recorded call did: RAM it read as (address, value) pairs, RAM it
+# wrote as address -> final value, registers it wrote as (register, final
+# value) pairs, output text and the number of instructions from the CALL's
+# target through the RET
+Entry = namedtuple("Entry", ["reads", "writes", "reg", "output", "cycles"])
+
+
+class Recording:
+    """A call whose body is being run and watched."""
+
+    __slots__ = ('target', 'return_address', 'reg_reads', 'reg_writes',
+                 'reads', 'writes', 'output', 'cycles', 'depth')
+
+    def __init__(self, target, return_address):
+        self.target = target
+        self.return_address = return_address
+        # Register -> value for registers read before being written
+        self.reg_reads = {}
+        self.reg_writes = set()
+        # Address -> value read, and address -> value written
+        self.reads = {}
+        self.writes = {}
+        self.output = []
+        self.cycles = 0
+        # CALLs inside the body not yet returned from
+        self.depth = 0
+
+
+class Abort(Exception):
+    """The call being recorded can't be cached."""
+
+
+def register_value(cpu, r):
+    return cpu.fl if r == FL else cpu.reg[r]
+
+
+class Memoizer:
+    def __init__(self, cpu, max_entries = 256, max_body = 10000):
+        self.cpu = cpu
+        # The table we replace, put back by `uninstall`
+        self.base = cpu.dispatch
+        self.max_entries = max_entries
+        self.max_body = max_body
+        # (target, registers read, their values) -> Entry, least recently
+        # used first
+        self.cache = OrderedDict()
+        # Target -> the sets of registers its entries were keyed on
+        self.shapes = {}
+        # Address -> keys of entries that read it
+        self.watched = {}
+        self.recording = None
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "uncachable": 0,
+            "aborted": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+        self.install()
+
+    # --- dispatch tables -----------------------------------------------
+
+    def install(self):
+        base = self.base
+
+        # Normal running: CALL is looked up, writes invalidate
+        self.normal = list(base)
+        for opcode, write_addresses in RAM_WRITES.items():
+            self.normal[opcode] = self.make_invalidating(base[opcode], write_addresses)
+        self.plain_call = self.normal[CALL]
+        self.normal[CALL] = self.memo_call
+
+        # While recording a body: every instruction is watched, and calls
+        # inside it are plain calls
+        self.recording_table = [self.make_recorder(opcode, self.normal[opcode])
+                                for opcode in range(256)]
+        self.recording_table[CALL] = self.make_recorder(CALL, self.plain_call)
+
+        # The run loop holds on to the list it started with, so switching
+        # between the two happens by copying into this one
+        self.table = list(self.normal)
+        self.cpu.dispatch = self.table
+
+    def uninstall(self):
+        self.recording = None
+        self.cpu.dispatch = self.base
+
+    def make_invalidating(self, original, write_addresses):
+        watched = self.watched
+
+        def invalidating(cpu, operand_a, operand_b):
+            for address in write_addresses(cpu, operand_a, operand_b):
+                if address in watched:
+                    self.invalidate(address)
+            original(cpu, operand_a, operand_b)
+
+        return invalidating
+
+    def make_recorder(self, opcode, original):
+        size = isa.instruction_size(opcode)
+        register_use = REGISTER_USE[opcode]
+        write_addresses = RAM_WRITES.get(opcode)
+
+        def recorder(cpu, operand_a, operand_b):
+            recording = self.recording
+            reg = cpu.reg
+            try:
+                if register_use is None or opcode == INT or opcode == IRET:
+                    raise Abort()
+                names = {"a": operand_a, "b": operand_b, "s": SP, "f": FL}
+                writes = [names[r] for r in register_use[1]]
+                for r in register_use[0]:
+                    r = names[r]
+                    if r not in recording.reg_writes and r not in recording.reg_reads:
+                        recording.reg_reads[r] = register_value(cpu, r)
+
+                pc = cpu.pc & 0xFF
+                for i in range(size):
+                    self.note_read(recording, (pc + i) & 0xFF)
+                if opcode == LD:
+                    self.note_read(recording, reg[operand_b])
+                elif opcode == POP or (opcode == RET and recording.depth):
+                    self.note_read(recording, reg[SP])
+                # The outermost RET reads the CALL's own return address
+
+                if opcode == PRN:
+                    recording.output.append(f"{reg[operand_a]}\n")
+                elif opcode == PRA:
+                    recording.output.append(chr(reg[operand_a]))
+
+                addresses = ()
+                if write_addresses is not None:
+                    addresses = write_addresses(cpu, operand_a, operand_b)
+                    for address in addresses:
+                        if address in recording.reads:
+                            # The body changes its own inputs
+                            raise Abort()
+            except (Abort, IndexError):
+                # IndexError is a bad register operand, which the handler
+                # reports itself
+                self.stop_recording(aborted=True)
+                original(cpu, operand_a, operand_b)
+                return
+
+            try:
+                original(cpu, operand_a, operand_b)
+            except BaseException:
+                # A trap from a tool stacked on top
+                self.stop_recording(aborted=True)
+                raise
+
+            ram = cpu.ram
+            for address in addresses:
+                recording.writes[address] = ram[address]
+            recording.reg_writes.update(writes)
+            recording.cycles += 1
+
+            if opcode == CALL:
+                recording.depth += 1
+            elif opcode == RET:
+                if recording.depth == 0:
+                    if cpu.pc == recording.return_address:
+                        self.finish()
+                    else:
+                        # The body changed where it returns to
+                        self.stop_recording(aborted=True)
+                    return
+                recording.depth -= 1
+
+            if reg[IM] or recording.cycles >= self.max_body:
+                self.stop_recording(aborted=True)
+
+        return recorder
+
+    def note_read(self, recording, address):
+        if address == KEY_PRESSED:
+            raise Abort()
+        # Bytes the body wrote first aren't inputs
+        if address not in recording.writes and address not in recording.reads:
+            recording.reads[address] = self.cpu.ram[address]
+
+    # --- calls ---------------------------------------------------------
+
+    def memo_call(self, cpu, reg_num, operand_b):
+        reg = cpu.reg
+        # The CALL's own push may overwrite something an entry read
+        push_address = (reg[SP] - 1) & 0xFF
+        if push_address in self.watched:
+            self.invalidate(push_address)
+
+        if reg[IM]:
+            # Interrupts could run in the middle of the body
+            self.stats["uncachable"] += 1
+            self.plain_call(cpu, reg_num, operand_b)
+            return
+
+        target = reg[reg_num]
+        entry = None
+        # Registers as the body will see them, after the push
+        values = reg[:SP] + [push_address, cpu.fl]
+        for shape in self.shapes.get(target, ()):
+            key = (target, shape, tuple(values[r] for r in shape))
+            entry = self.cache.get(key)
+            if entry is not None:
+                break
+
+        if entry is None:
+            self.stats["misses"] += 1
+            self.recording = Recording(target, (cpu.pc + 2) & 0xFF)
+            self.table[:] = self.recording_table
+            self.plain_call(cpu, reg_num, operand_b)
+            return
+
+        self.stats["hits"] += 1
+        self.cache.move_to_end(key)
+        self.replay(cpu, entry, push_address)
+
+    def replay(self, cpu, entry, push_address):
+        ram = cpu.ram
+        watched = self.watched
+        return_address = (cpu.pc + 2) & 0xFF
+        ram[push_address] = return_address
+        for address, value in entry.writes.items():
+            if address in watched:
+                self.invalidate(address)
+            ram[address] = value
+        reg = cpu.reg
+        for r, value in entry.reg:
+            if r == FL:
+                cpu.fl = value
+            else:
+                reg[r] = value
+        if entry.output:
+            print(entry.output, end='', file=cpu.out)
+        cpu.pc = return_address
+        cpu.cycles += entry.cycles
+
+    def finish(self):
+        """The outermost RET just ran: store what the body did."""
+
+        cpu = self.cpu
+        recording = self.recording
+        self.stop_recording()
+
+        shape = tuple(sorted(recording.reg_reads))
+        key = (recording.target, shape, tuple(recording.reg_reads[r] for r in shape))
+        entry = Entry(tuple(recording.reads.items()), recording.writes,
+                      tuple((r, register_value(cpu, r)) for r in sorted(recording.reg_writes)),
+                      "".join(recording.output), recording.cycles)
+
+        self.cache[key] = entry
+        self.shapes.setdefault(recording.target, set()).add(shape)
+        for address, value in entry.reads:
+            self.watched.setdefault(address, set()).add(key)
+
+        while len(self.cache) > self.max_entries:
+            old_key, old = self.cache.popitem(last=False)
+            self.forget(old_key, old)
+            self.stats["evictions"] += 1
+
+    def stop_recording(self, aborted = False):
+        self.recording = None
+        self.table[:] = self.normal
+        if aborted:
+            self.stats["aborted"] += 1
+
+    # --- invalidation --------------------------------------------------
+
+    def forget(self, key, entry):
+        for address, value in entry.reads:
+            keys = self.watched.get(address)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.watched[address]
+
+    def invalidate(self, address):
+        """Drop every entry that read `address`."""
+
+        for key in list(self.watched.get(address, ())):
+            entry = self.cache.pop(key, None)
+            if entry is not None:
+                self.forget(key, entry)
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        """Drop everything, e.g. after the host changed RAM."""
+
+        self.cache.clear()
+        self.shapes.clear()
+        self.watched.clear()
+        if self.recording is not None:
+            self.stop_recording(aborted=True)
+
+    # --- reporting -----------------------------------------------------
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def print_stats(self, out = sys.stdout):
+        stats = self.stats
+        print(f"memo: {stats['hits']} hits, {stats['misses']} misses "
+              f"({self.hit_rate():.1%} hit rate), {len(self.cache)} entries", file=out)
+        print(f"      {stats['uncachable']} uncachable, {stats['aborted']} aborted, "
+              f"{stats['evictions']} evicted, {stats['invalidations']} invalidated", file=out)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run an LS-8 program with CALL memoization")
+    parser.add_argument("program", help=".ls8 file")
+    parser.add_argument("--size", type=int, default=256, help="most entries to keep")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    args = parser.parse_args(argv[1:])
+
+    cpu = FastCPU()
+    memo = Memoizer(cpu, max_entries=args.size)
+    try:
+        cpu.load(args.program)
+        result = cpu.run(max_cycles=args.max_cycles)
+    except LS8Error as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    print(f"{result.reason} after {cpu.cycles} instructions", file=sys.stderr)
+    memo.print_stats(sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
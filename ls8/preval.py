@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+"""Partial evaluation of LS-8 images that take no input.
+
+    python3 preval.py program.ls8 [-o reduced.ls8] [--max-cycles N] [--ext]
+
+`asm.py -P` runs it on the image it has just assembled.
+
+The image is run on a FastCPU whose dispatch table is wrapped so that the
+run stops at the first thing that could make it depend on the outside
+world:
+
+* reading the key address 0xF4 (LD, POP/RET/IRET off an empty stack,
+  COPY/PRS over it), or fetching an instruction that covers it
+* unmasking any interrupt in IM, after which a key or timer can change
+  what happens next
+
+If the program halts before either, its output is all it does, and the
+reduced image is just straight-line `LDI`/`PRN`/`PRA` that prints the same
+text and halts. Only PRN and PRA are used, so an image whose output came
+from PRN alone also runs on engines without PRA.
+
+If it stops at one of those points, or runs out of `max_cycles`, what ran
+so far is an input-free prefix. The reduced image is then the machine's
+RAM at that point, with a stub that prints the prefix's output, puts back
+the five bytes at address 0 it used to get control, and restores R0-R7, FL
+and the PC with an IRET from a frame placed just below the stack pointer.
+The stub and frame go just below SP, which has to leave room for them past
+the end of the original image. Like anything below SP, whatever was there,
+pushed and popped by the prefix or not, is not preserved.
+
+The original image is kept, with the reason, when the program fails, the
+reduced image wouldn't fit in RAM or there is no room below SP for the
+stub, interrupts are disabled because the prefix stopped inside a handler,
+or the reduced image wouldn't execute fewer instructions than the original.
+Only output and, for a prefix, the machine state are reproduced: a halted
+program's final registers and RAM are not.
+"""
+
+import argparse
+import sys
+from collections import namedtuple
+
+import cpu_fast
+import isa
+from cpu_fast import FastCPU, LS8Error, Trap, KEY_PRESSED, IM, SP, HALTED
+from isa import LD, POP, RET, IRET, PRN, PRA, COPY, PRS
+
+# Instructions run before giving up on reaching HLT
+BUDGET = 1_000_000
+
+# Why the evaluation stopped short of HLT
+INPUT = "input"
+INTERRUPTS = "interrupts"
+
+# IRET pops R6-R0, FL and PC
+FRAME_SIZE = 9
+
+# Registers the printing code may load values into
+PRINT_REGS = range(7)
+
+Reduction = namedtuple("Reduction", ["image", "reduced", "reason", "output", "cycles",
+                                     "reduced_cycles", "listing"])
+
+
+def block(start, count):
+    return tuple((start + i) & 0xFF for i in range(count))
+
+
+# Addresses each opcode reads from RAM, besides its own instruction bytes
+RAM_READS = {
+    LD: lambda cpu, a, b: (cpu.reg[b],),
+    POP: lambda cpu, a, b: (cpu.reg[SP],),
+    RET: lambda cpu, a, b: (cpu.reg[SP],),
+    IRET: lambda cpu, a, b: block(cpu.reg[SP], FRAME_SIZE),
+    COPY: lambda cpu, a, b: block(cpu.reg[b], cpu.reg[a + 1]) if a < 7 else (),
+    PRS: lambda cpu, a, b: block(cpu.reg[a], cpu.reg[a + 1]) if a < 7 else (),
+}
+
+
+class Evaluator:
+    """Runs an image until it halts or does something input-dependent."""
+
+    def __init__(self, image, extensions = False):
+        self.cpu = FastCPU(extensions)
+        self.cpu.load_image(image)
+        # Output as (PRN or PRA opcode, value)
+        self.output = []
+        self.cpu.dispatch = self.guard_table(self.cpu.dispatch)
+
+    def guard_table(self, table):
+        guarded = list(table)
+        for opcode in range(256):
+            guarded[opcode] = self.make_guard(opcode, table[opcode])
+        guarded[PRN] = self.make_guard(PRN, self.make_capture(PRN))
+        guarded[PRA] = self.make_guard(PRA, self.make_capture(PRA))
+        if table[PRS] is cpu_fast.print_block:
+            guarded[PRS] = self.make_guard(PRS, self.capture_block)
+        return guarded
+
+    def make_capture(self, opcode):
+        def capture(cpu, reg_num, unused_operand):
+            self.output.append((opcode, cpu.reg[reg_num]))
+
+        return capture
+
+    def capture_block(self, cpu, reg_a, unused_operand):
+        # PRS comes out the same as a PRA per byte
+        reg = cpu.reg
+        for value in cpu_fast.read_block(cpu.ram, reg[reg_a], reg[reg_a + 1]):
+            self.output.append((PRA, value))
+
+    def make_guard(self, opcode, original):
+        size = isa.instruction_size(opcode)
+        reads = RAM_READS.get(opcode)
+
+        def guard(cpu, operand_a, operand_b):
+            if KEY_PRESSED in block(cpu.pc & 0xFF, size):
+                raise Trap(INPUT)
+            if reads is not None and KEY_PRESSED in reads(cpu, operand_a, operand_b):
+                raise Trap(INPUT)
+            original(cpu, operand_a, operand_b)
+            if cpu.reg[IM]:
+                raise Trap(INTERRUPTS, executed=True)
+
+        return guard
+
+    def run(self, max_cycles = BUDGET):
+        return self.cpu.run(max_cycles=max_cycles)
+
+
+class Emitter:
+    """Builds straight-line code a byte at a time, with a listing."""
+
+    def __init__(self, origin = 0):
+        self.origin = origin
+        self.code = []
+        self.listing = []
+        self.instructions = 0
+
+    def emit(self, mnemonic, *operands):
+        address = self.origin + len(self.code)
+        self.code.append(isa.BY_MNEMONIC[mnemonic].opcode)
+        self.code.extend(operands)
+        self.listing.append((address, isa.disassemble(self.code[-1 - len(operands):] + [0, 0], 0)[0]))
+        self.instructions += 1
+
+    def print_output(self, output):
+        """Code that prints `output`, keeping recent values in registers."""
+
+        held = {}
+        recent = list(PRINT_REGS)
+        for opcode, value in output:
+            reg = held.get(value)
+            if reg is None:
+                reg = recent[0]
+                held = {v: r for v, r in held.items() if r != reg}
+                held[value] = reg
+                self.emit("LDI", reg, value)
+            recent.remove(reg)
+            recent.append(reg)
+            self.emit("PRN" if opcode == PRN else "PRA", reg)
+
+
+def halted_image(output):
+    emitter = Emitter()
+    emitter.print_output(output)
+    emitter.emit("HLT")
+    return emitter
+
+
+def prefix_image(evaluator, original_size):
+    """
+    The machine state after the prefix, with a stub that prints its output
+    and resumes. Returns (image, emitter) or raises ValueError saying why
+    it can't be done.
+    """
+
+    cpu = evaluator.cpu
+    if not cpu.interrupts_enabled:
+        raise ValueError("stopped inside an interrupt handler")
+
+    ram = bytearray(cpu.ram)
+    sp = cpu.reg[SP]
+    frame = sp - FRAME_SIZE
+
+    # The stub is assembled twice: once to find its size, once where it goes
+    def stub(origin):
+        emitter = Emitter(origin)
+        emitter.print_output(evaluator.output)
+        # Put back what the jump at 0 overwrote
+        for address in range(5):
+            emitter.emit("LDI", 0, address)
+            emitter.emit("LDI", 1, ram[address])
+            emitter.emit("ST", 0, 1)
+        emitter.emit("LDI", SP, frame)
+        emitter.emit("IRET")
+        return emitter
+
+    start = frame - len(stub(0).code)
+    if sp > KEY_PRESSED or start < max(original_size, 5):
+        raise ValueError("no room below the stack for the resume stub")
+
+    emitter = stub(start)
+    ram[start:frame] = bytes(emitter.code)
+    ram[frame:sp] = bytes(cpu.reg[6::-1]) + bytes((cpu.fl, cpu.pc & 0xFF))
+    ram[0:5] = bytes((isa.LDI, 0, start, isa.JMP, 0))
+    emitter.listing.insert(0, (0, f"LDI R0,0x{start:02X}"))
+    emitter.listing.insert(1, (3, "JMP R0"))
+    emitter.instructions += 2
+
+    # Nothing past the last non-zero byte needs loading
+    end = len(ram)
+    while end > 0 and ram[end - 1] == 0:
+        end -= 1
+    return list(ram[:end]), emitter
+
+
+def reduce(image, max_cycles = BUDGET, extensions = False):
+    """Partially evaluate `image`. Returns a Reduction."""
+
+    image = list(image)
+
+    def keep(reason, output = (), cycles = 0):
+        return Reduction(image, False, reason, list(output), cycles, cycles, [])
+
+    try:
+        evaluator = Evaluator(image, extensions)
+        result = evaluator.run(max_cycles)
+    except LS8Error as e:
+        return keep(f"evaluation failed: {e}")
+
+    cycles = evaluator.cpu.cycles
+    if result.reason == HALTED:
+        emitter = halted_image(evaluator.output)
+        reason = f"halted after {cycles} instructions"
+        if len(emitter.code) > len(evaluator.cpu.ram):
+            return keep(f"{reason}, but its output doesn't fit in RAM", evaluator.output, cycles)
+        reduced_image = emitter.code
+    else:
+        what = {cpu_fast.MAX_CYCLES: f"still running after {cycles} instructions",
+                INPUT: f"reads input after {cycles} instructions",
+                INTERRUPTS: f"enables interrupts after {cycles} instructions"}[result.reason]
+        try:
+            reduced_image, emitter = prefix_image(evaluator, len(image))
+        except ValueError as e:
+            return keep(f"{what}, {e}", evaluator.output, cycles)
+        reason = f"{what}, resuming from there"
+
+    if emitter.instructions >= cycles:
+        return keep(f"{reason}, nothing to gain", evaluator.output, cycles)
+    return Reduction(reduced_image, True, reason, evaluator.output, cycles,
+                     emitter.instructions, emitter.listing)
+
+
+def write_image(outputfile, reduction):
+    """Write the reduced (or kept) image as `.ls8` text."""
+
+    if reduction.reduced:
+        outputfile.write(f"# preval: {reduction.reason}\n")
+    comments = dict(reduction.listing)
+    for address, byte in enumerate(reduction.image):
+        comment = comments.get(address)
+        outputfile.write(f"{byte:08b}" + (f" # {comment}" if comment else "") + "\n")
+
+
+def describe(name, reduction):
+    if reduction.reduced:
+        return (f"{name}: {reduction.reason}; {reduction.cycles} -> "
+                f"{reduction.reduced_cycles} instructions")
+    return f"{name}: kept, {reduction.reason}"
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Partially evaluate an input-free LS-8 image")
+    parser.add_argument("program", help=".ls8 file")
+    parser.add_argument("-o", "--output", help="write the image here instead of stdout")
+    parser.add_argument("--max-cycles", type=int, default=BUDGET,
+                        help="instructions to run before settling for a prefix")
+    parser.add_argument("--ext", action="store_true", help="allow the isa.EXTENSIONS instructions")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        with open(args.program) as f:
+            image = cpu_fast.parse_program(f, args.program)
+    except (OSError, LS8Error) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    reduction = reduce(image, args.max_cycles, args.ext)
+    print(describe(args.program, reduction), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            write_image(f, reduction)
+    else:
+        write_image(sys.stdout, reduction)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""Sampling profiler for LS-8 programs.
+
+    python3 profiler.py program.asm [-n every] [--wall ms] [--max-cycles N]
+                        [--chrome trace.json] [--speedscope profile.json]
+
+The program is assembled with `asm/asm.py` so PCs can be named after the
+labels in its symbol table. It then runs on a FastCPU in slices of `every`
+instructions (or, with --wall, under a profiling timer signal) and after each
+slice records the PC and the call stack. The call stack is a shadow stack
+kept by trap handlers on CALL and RET only, so the interpreter loop itself
+runs untouched between samples.
+
+Output is a flat table of the hottest labels, plus optionally a Chrome trace
+(chrome://tracing, Perfetto) and a speedscope profile.
+"""
+
+import argparse
+import bisect
+import json
+import os
+import signal
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'asm'))
+
+import asm
+
+from cpu_fast import FastCPU, LS8Error, parse_program
+from isa import CALL, RET
+
+# Deepest shadow stack we keep; runaway recursion just loses the oldest frames
+MAX_DEPTH = 256
+
+# Frame at the bottom of every stack, which unlabeled code before the first
+# label also counts as
+ROOT = "main"
+
+
+class Symbols:
+    """Maps addresses to the nearest label at or below them."""
+
+    def __init__(self, sym):
+        pairs = sorted((address, label) for label, address in sym.items())
+        self.addresses = [address for address, label in pairs]
+        self.labels = [label for address, label in pairs]
+        self.exact = {address: label for address, label in pairs}
+
+    def name(self, address):
+        """Label at `address` exactly, or its hex address."""
+
+        return self.exact.get(address, f"0x{address:02X}")
+
+    def containing(self, address):
+        """Label `address` falls under, e.g. a loop label inside a subroutine."""
+
+        i = bisect.bisect_right(self.addresses, address) - 1
+        if i < 0:
+            return ROOT
+        return self.labels[i]
+
+
+class Profiler:
+    """
+    Attach to a FastCPU and sample it.
+
+        profiler = Profiler(cpu, symbols)
+        profiler.run(every=1000)
+        profiler.write_speedscope("out.json")
+    """
+
+    def __init__(self, cpu, symbols):
+        self.cpu = cpu
+        # The table we replace, put back by `uninstall`
+        self.base = cpu.dispatch
+        self.symbols = symbols
+        # Return addresses and targets of the calls we're inside
+        self.stack = []
+        # (cycle, stack tuple) per sample; each covers the instructions
+        # since the previous sample (or since `start_cycle`)
+        self.samples = []
+        self.start_cycle = cpu.cycles
+        self.install()
+
+    def install(self):
+        table = list(self.base)
+        original_call = table[CALL]
+        original_ret = table[RET]
+        stack = self.stack
+
+        def call_trap(cpu, reg_num, operand_b):
+            original_call(cpu, reg_num, operand_b)
+            if len(stack) >= MAX_DEPTH:
+                del stack[0]
+            stack.append(cpu.pc)
+
+        def ret_trap(cpu, operand_a, operand_b):
+            original_ret(cpu, operand_a, operand_b)
+            if stack:
+                stack.pop()
+
+        table[CALL] = call_trap
+        table[RET] = ret_trap
+        self.cpu.dispatch = table
+
+    def uninstall(self):
+        self.cpu.dispatch = self.base
+
+    def sample(self):
+        """Record where the CPU is right now."""
+
+        symbols = self.symbols
+        frames = [ROOT] + [symbols.name(target) for target in self.stack]
+        leaf = symbols.containing(self.cpu.pc & 0xFF)
+        if leaf != frames[-1]:
+            frames.append(leaf)
+        self.samples.append((self.cpu.cycles, tuple(frames)))
+
+    def run(self, every = 1000, max_cycles = None):
+        """Run to HLT (or `max_cycles`), sampling every `every` instructions."""
+
+        cpu = self.cpu
+        start = cpu.cycles
+        while not cpu.halted:
+            limit = every
+            if max_cycles is not None:
+                limit = min(limit, start + max_cycles - cpu.cycles)
+                if limit <= 0:
+                    break
+            executed, reason = cpu.execute(limit)
+            if reason is None:
+                self.sample()
+        self.sample()
+
+    def run_wall(self, interval = 0.001, max_cycles = None):
+        """Run to HLT, sampling on a profiling timer every `interval` seconds."""
+
+        def on_timer(signum, frame):
+            self.sample()
+
+        previous = signal.signal(signal.SIGPROF, on_timer)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        try:
+            self.cpu.run(max_cycles=max_cycles)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, previous)
+        self.sample()
+
+    # --- reports -------------------------------------------------------
+
+    def flat(self):
+        """(label, self samples, total samples), hottest first."""
+
+        self_counts = {}
+        total_counts = {}
+        for cycle, frames in self.samples:
+            self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + 1
+            for name in set(frames):
+                total_counts[name] = total_counts.get(name, 0) + 1
+        rows = [(name, self_counts.get(name, 0), total)
+                for name, total in total_counts.items()]
+        rows.sort(key=lambda row: (-row[1], -row[2]))
+        return rows
+
+    def print_flat(self, out = sys.stdout):
+        count = len(self.samples) or 1
+        print(f"{len(self.samples)} samples over {self.cpu.cycles} instructions", file=out)
+        print(f"{'self':>7} {'total':>7}  label", file=out)
+        for name, self_samples, total in self.flat():
+            print(f"{self_samples / count:>6.1%} {total / count:>6.1%}  {name}", file=out)
+
+    def chrome_trace(self):
+        """
+        Chrome trace events: a B/E pair for each stretch of samples that
+        share a frame. Timestamps are instruction counts.
+        """
+
+        events = []
+        current = ()
+        previous_cycle = self.start_cycle
+        for cycle, frames in self.samples:
+            common = 0
+            while (common < len(current) and common < len(frames) and
+                   current[common] == frames[common]):
+                common += 1
+            for name in reversed(current[common:]):
+                events.append({"name": name, "ph": "E", "ts": previous_cycle, "pid": 1, "tid": 1})
+            for name in frames[common:]:
+                events.append({"name": name, "ph": "B", "ts": previous_cycle, "pid": 1, "tid": 1})
+            current = frames
+            previous_cycle = cycle
+        for name in reversed(current):
+            events.append({"name": name, "ph": "E", "ts": previous_cycle, "pid": 1, "tid": 1})
+        return {"traceEvents": events, "displayTimeUnit": "ns"}
+
+    def speedscope(self, name = "ls8"):
+        """A speedscope "sampled" profile weighted by instructions."""
+
+        frame_index = {}
+        frames = []
+        samples = []
+        weights = []
+        previous_cycle = self.start_cycle
+        for cycle, stack in self.samples:
+            indexes = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    frames.append({"name": frame})
+                indexes.append(frame_index[frame])
+            samples.append(indexes)
+            weights.append(cycle - previous_cycle)
+            previous_cycle = cycle
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "none",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "name": name,
+        }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Sampling profiler for LS-8 programs")
+    parser.add_argument("program", help=".asm source file")
+    parser.add_argument("-n", "--every", type=int, default=1000,
+                        help="sample every N instructions")
+    parser.add_argument("--wall", type=float, default=None,
+                        help="sample on a wall-clock timer every N milliseconds instead")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    parser.add_argument("--chrome", help="write a Chrome trace event JSON file")
+    parser.add_argument("--speedscope", help="write a speedscope JSON file")
+    args = parser.parse_args(argv[1:])
+
+    with open(args.program) as source:
+        text, sym = asm.assemble(source, filename=args.program)
+
+    cpu = FastCPU()
+    profiler = Profiler(cpu, Symbols(sym))
+    try:
+        cpu.load_image(parse_program(text.splitlines(), args.program))
+        if args.wall is not None:
+            profiler.run_wall(args.wall / 1000, args.max_cycles)
+        else:
+            profiler.run(args.every, args.max_cycles)
+    except LS8Error as e:
+        print(f"\n{e}", file=sys.stderr)
+
+    profiler.print_flat(sys.stderr)
+
+    if args.chrome:
+        with open(args.chrome, "w") as f:
+            json.dump(profiler.chrome_trace(), f)
+    if args.speedscope:
+        with open(args.speedscope, "w") as f:
+            json.dump(profiler.speedscope(os.path.basename(args.program)), f)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
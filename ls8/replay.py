@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+"""Record and replay the nondeterministic inputs of a FastCPU run.
+
+    python3 replay.py info run.log
+    python3 replay.py play program.ls8 run.log [from_cycle]
+    python3 replay.py check program.ls8 [runs]
+
+The only things that make two runs of the same image differ are key presses
+and interrupts raised by the host. `Recorder` logs those, with the cycle
+count they arrived at, and takes a full snapshot every `snapshot_interval`
+cycles. `Replayer` restores the nearest snapshot at or before the cycle you
+ask for and feeds the remaining events back at the same instruction counts.
+
+`check` records runs with key presses and interrupts at random points, cut
+into randomly sized `run` calls, and replays each from every snapshot. Each
+replay should end in the same state, and the replay from cycle 0 should
+print the same output.
+
+Log format (all integers after the header are unsigned LEB128 varints):
+
+    b"LS8R" version
+    cycle the recording ended at
+    snapshot count, then each snapshot (`cpu_fast.SNAPSHOT_SIZE` bytes)
+    events until EOF: kind byte, cycles since previous event, value byte
+"""
+
+import io
+import random
+import sys
+
+from cpu_fast import FastCPU, LS8Error, MAX_CYCLES, SNAPSHOT_SIZE, parse_program
+
+MAGIC = b"LS8R"
+VERSION = 1
+
+# Event kinds
+KEY = 0
+INTERRUPT = 1
+
+
+def write_varint(out, n):
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.write(bytes((byte | 0x80,)))
+        else:
+            out.write(bytes((byte,)))
+            return
+
+
+def read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
+def snapshot_cycles(snapshot):
+    return int.from_bytes(snapshot[SNAPSHOT_SIZE - 8:SNAPSHOT_SIZE], 'little')
+
+
+def machine_state(snapshot):
+    """
+    A snapshot without its halted flag. That only says whether a run has
+    stopped on the HLT yet, which depends on where the caller's last `run`
+    ended rather than on anything the program did.
+    """
+
+    return snapshot[:SNAPSHOT_SIZE - 9] + snapshot[SNAPSHOT_SIZE - 8:]
+
+
+class Recording:
+    """Events as (cycle, kind, value) plus snapshots, in cycle order."""
+
+    def __init__(self, events = None, snapshots = None, end_cycle = 0):
+        self.events = events if events is not None else []
+        self.snapshots = snapshots if snapshots is not None else []
+        self.end_cycle = end_cycle
+
+    def to_bytes(self):
+        out = io.BytesIO()
+        out.write(MAGIC + bytes((VERSION,)))
+        write_varint(out, self.end_cycle)
+        write_varint(out, len(self.snapshots))
+        for snapshot in self.snapshots:
+            out.write(snapshot)
+        previous = 0
+        for cycle, kind, value in self.events:
+            out.write(bytes((kind,)))
+            write_varint(out, cycle - previous)
+            out.write(bytes((value,)))
+            previous = cycle
+        return out.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != MAGIC or data[4] != VERSION:
+            raise LS8Error("not an LS-8 replay log")
+
+        end_cycle, pos = read_varint(data, 5)
+        count, pos = read_varint(data, pos)
+        snapshots = []
+        for _ in range(count):
+            snapshots.append(bytes(data[pos:pos + SNAPSHOT_SIZE]))
+            pos += SNAPSHOT_SIZE
+
+        events = []
+        cycle = 0
+        while pos < len(data):
+            kind = data[pos]
+            delta, pos = read_varint(data, pos + 1)
+            cycle += delta
+            events.append((cycle, kind, data[pos]))
+            pos += 1
+
+        return cls(events, snapshots, end_cycle)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+class Recorder:
+    """
+    Wraps a loaded FastCPU. Deliver input through `post_key` and
+    `post_interrupt` instead of calling the CPU directly, and run it through
+    `run` so snapshots get taken on schedule.
+    """
+
+    def __init__(self, cpu, snapshot_interval = 100000):
+        self.cpu = cpu
+        self.snapshot_interval = snapshot_interval
+        self.recording = Recording()
+        # Always have a snapshot to replay from
+        self.take_snapshot()
+
+    def take_snapshot(self):
+        self.recording.snapshots.append(self.cpu.snapshot())
+        self.next_snapshot = self.cpu.cycles + self.snapshot_interval
+
+    def post_key(self, key):
+        self.recording.events.append((self.cpu.cycles, KEY, key & 0xFF))
+        self.cpu.post_key(key)
+
+    def post_interrupt(self, n):
+        self.recording.events.append((self.cpu.cycles, INTERRUPT, n))
+        self.cpu.post_interrupt(n)
+
+    def run(self, max_cycles = None, timeout = None):
+        """Like `FastCPU.run`, but stopping at each snapshot point on the way."""
+
+        cpu = self.cpu
+        target = cpu.cycles + max_cycles if max_cycles is not None else None
+        while True:
+            limit = self.next_snapshot - cpu.cycles
+            if target is not None:
+                limit = min(limit, target - cpu.cycles)
+            result = cpu.run(max_cycles=limit, timeout=timeout)
+            self.recording.end_cycle = cpu.cycles
+            if cpu.cycles >= self.next_snapshot:
+                self.take_snapshot()
+            if result.reason != MAX_CYCLES:
+                return result
+            if target is not None and cpu.cycles >= target:
+                return result
+
+
+class Replayer:
+    """Replays a `Recording` onto a CPU, starting from any cycle."""
+
+    def __init__(self, recording, cpu = None):
+        self.recording = recording
+        self.cpu = cpu if cpu is not None else FastCPU()
+        # Index of the next event to inject
+        self.next_event = 0
+
+    def seek(self, cycle = 0):
+        """
+        Restore the latest snapshot at or before `cycle`, then run forward to
+        exactly `cycle`, applying any events on the way.
+        """
+
+        best = self.recording.snapshots[0]
+        for snapshot in self.recording.snapshots:
+            if snapshot_cycles(snapshot) <= cycle:
+                best = snapshot
+        self.cpu.restore(best)
+
+        events = self.recording.events
+        self.next_event = 0
+        while (self.next_event < len(events) and
+               events[self.next_event][0] < self.cpu.cycles):
+            self.next_event += 1
+
+        return self.run(until_cycle=cycle)
+
+    def run(self, until_cycle = None):
+        """
+        Run from the current cycle, injecting each recorded event at the
+        cycle it originally arrived at. Stops at HLT or at `until_cycle`,
+        which defaults to where the recording ended.
+        """
+
+        if until_cycle is None:
+            until_cycle = self.recording.end_cycle
+
+        cpu = self.cpu
+        events = self.recording.events
+        result = None
+        while self.next_event < len(events):
+            cycle, kind, value = events[self.next_event]
+            if cycle > until_cycle:
+                break
+            if cycle > cpu.cycles:
+                result = cpu.run(max_cycles=cycle - cpu.cycles)
+                if result.reason != MAX_CYCLES:
+                    return result
+            self.next_event += 1
+            if kind == KEY:
+                cpu.post_key(value)
+            else:
+                cpu.post_interrupt(value)
+
+        if until_cycle > cpu.cycles:
+            result = cpu.run(max_cycles=until_cycle - cpu.cycles)
+        return result
+
+
+def check(image, seed, events = 20, max_cycles = 2000, snapshot_interval = 97):
+    """
+    Record a run of `image` with random input, then replay it from every
+    snapshot. Returns a description of the first replay that differs from
+    the recording, or None if they all match.
+    """
+
+    rng = random.Random(seed)
+    cpu = FastCPU()
+    cpu.out = io.StringIO()
+    cpu.load_image(image)
+    recorder = Recorder(cpu, snapshot_interval)
+    for _ in range(events):
+        # Input can arrive before the program has unmasked it, too
+        if rng.random() < 0.8:
+            recorder.post_key(rng.randrange(0x20, 0x7F))
+        else:
+            recorder.post_interrupt(rng.randrange(8))
+        recorder.run(max_cycles=rng.randrange(1, max_cycles // events + 1))
+
+    expected = machine_state(cpu.snapshot())
+    recording = recorder.recording
+    for snapshot in recording.snapshots:
+        start = snapshot_cycles(snapshot)
+        replay_cpu = FastCPU()
+        replay_cpu.out = io.StringIO()
+        replayer = Replayer(recording, replay_cpu)
+        replayer.seek(start)
+        replayer.run()
+        if machine_state(replay_cpu.snapshot()) != expected:
+            return f"seed {seed}: replay from cycle {start} ended in a different state"
+        if start == 0 and replay_cpu.out.getvalue() != cpu.out.getvalue():
+            return f"seed {seed}: replay from cycle 0 printed different output"
+    return None
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] not in ("info", "play", "check"):
+        print("usage: replay.py info run.log\n"
+              "       replay.py play program.ls8 run.log [from_cycle]\n"
+              "       replay.py check program.ls8 [runs]", file=sys.stderr)
+        return 1
+
+    try:
+        if argv[1] == "check":
+            with open(argv[2]) as f:
+                image = parse_program(f, argv[2])
+            runs = int(argv[3]) if len(argv) > 3 else 100
+            for seed in range(runs):
+                problem = check(image, seed)
+                if problem is not None:
+                    print(problem)
+                    return 1
+            print(f"{runs} recordings replayed identically")
+            return 0
+
+        if argv[1] == "info":
+            recording = Recording.load(argv[2])
+            print(f"ends at cycle {recording.end_cycle}")
+            print(f"{len(recording.snapshots)} snapshots at cycles "
+                  f"{[snapshot_cycles(s) for s in recording.snapshots]}")
+            print(f"{len(recording.events)} events")
+            for cycle, kind, value in recording.events:
+                print(f"  {cycle:>10}  {'key' if kind == KEY else 'interrupt'} {value}")
+            return 0
+
+        if len(argv) < 4:
+            print("play needs a program and a log", file=sys.stderr)
+            return 1
+        recording = Recording.load(argv[3])
+        cpu = FastCPU()
+        cpu.load(argv[2])
+        replayer = Replayer(recording, cpu)
+        replayer.seek(int(argv[4]) if len(argv) > 4 else 0)
+        print(replayer.run())
+    except (OSError, LS8Error) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
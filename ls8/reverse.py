@@ -0,0 +1,339 @@
+"""Reverse execution for FastCPU.
+
+`TimeTravel` drives a CPU forwards one instruction at a time and keeps, for
+every instruction, a compact undo record: PC, FL and the interrupt/halt
+flags, followed by (address, old value) pairs for each RAM byte and register
+the instruction changed. Registers use addresses 0x100-0x107.
+
+History is split into segments of `checkpoint_interval` instructions, each
+starting with a full `FastCPU.snapshot()`. When the undo records outgrow
+`memory_budget` bytes, the oldest segments lose their records but keep their
+checkpoint. Stepping back into such a segment restores its checkpoint and
+re-executes it forward to rebuild the records, so a reverse step never costs
+more than one checkpoint interval of work. If even the checkpoints don't fit,
+the oldest ones are dropped and history starts later. While reversing, the
+segment being rebuilt is kept even if that goes over budget.
+
+Keys and interrupts have to go through `post_key`/`post_interrupt` here, so
+they are replayed at the same cycle when a segment is re-executed.
+
+    tt = TimeTravel(cpu)
+    tt.run()                               # forwards to HLT
+    tt.reverse_continue(watch=(0x00, 0x3F))  # back to the write that hit code
+"""
+
+import sys
+import time
+
+from cpu_fast import (LS8Error, RunResult, RAM_WRITES, SNAPSHOT_SIZE, IM, IS,
+                      KEY_PRESSED, HALTED, MAX_CYCLES, UNTIL_PC,
+                      interrupt_frame_addresses)
+from isa import HLT as HLT_OPCODE
+
+# Registers appear in the undo log at these addresses
+REGISTER_BASE = 0x100
+
+# Stop reasons for going backwards
+BEGINNING = "beginning of history"
+BREAKPOINT = "breakpoint"
+WATCHPOINT = "watchpoint"
+
+# Event kinds, as in replay.py
+KEY = 0
+INTERRUPT = 1
+
+# Rough per-record cost of a bytes object on top of its contents
+RECORD_OVERHEAD = sys.getsizeof(b"")
+
+
+class Segment:
+    """A checkpoint plus the undo records for the instructions after it."""
+
+    __slots__ = ('start_cycle', 'checkpoint', 'undo', 'undo_bytes')
+
+    def __init__(self, start_cycle, checkpoint):
+        self.start_cycle = start_cycle
+        self.checkpoint = checkpoint
+        # None once the records have been dropped to save memory
+        self.undo = []
+        self.undo_bytes = 0
+
+
+class TimeTravel:
+    def __init__(self, cpu, checkpoint_interval = 1000, memory_budget = 1 << 20):
+        self.cpu = cpu
+        self.checkpoint_interval = checkpoint_interval
+        self.memory_budget = memory_budget
+        self.segments = [Segment(cpu.cycles, cpu.snapshot())]
+        self.memory_used = SNAPSHOT_SIZE
+        # (cycle, kind, value) in cycle order
+        self.events = []
+
+    # --- input ---------------------------------------------------------
+
+    def post_key(self, key):
+        self.add_event(KEY, key & 0xFF)
+
+    def post_interrupt(self, n):
+        self.add_event(INTERRUPT, n)
+
+    def add_event(self, kind, value):
+        # Events are applied at the start of the next step, inside its undo
+        # record. Posting while in the past discards the old future.
+        self.truncate_future()
+        self.events.append((self.cpu.cycles, kind, value))
+
+    def truncate_future(self):
+        cycle = self.cpu.cycles
+        self.events = [event for event in self.events if event[0] < cycle]
+
+    # --- forwards ------------------------------------------------------
+
+    def step_forward(self, segment):
+        """
+        Execute one instruction, appending its undo record to `segment`.
+        Returns 0 without recording anything if the CPU is sitting on HLT.
+        """
+
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+        events = self.events_at(cpu.cycles)
+        interrupt_pending = reg[IM] & reg[IS] and cpu.interrupts_enabled
+
+        if ram[cpu.pc & 0xFF] == HLT_OPCODE and not events and not interrupt_pending:
+            cpu.halted = True
+            return 0
+
+        regs_before = bytes(reg)
+        header = bytes((cpu.pc & 0xFF, cpu.fl,
+                        cpu.interrupts_enabled | cpu.halted << 1))
+        writes = []
+
+        for cycle, kind, value in events:
+            if kind == KEY:
+                writes.append((KEY_PRESSED, ram[KEY_PRESSED]))
+                cpu.post_key(value)
+            else:
+                cpu.post_interrupt(value)
+
+        if reg[IM] & reg[IS] and cpu.interrupts_enabled:
+            # A pending interrupt pushes its frame before the instruction
+            for address in interrupt_frame_addresses(cpu, 0, 0):
+                writes.append((address, ram[address]))
+            cpu.check_interrupts()
+
+        pc = cpu.pc & 0xFF
+        write_addresses = RAM_WRITES.get(ram[pc])
+        if write_addresses is not None:
+            for address in write_addresses(cpu, ram[(pc + 1) & 0xFF], ram[(pc + 2) & 0xFF]):
+                writes.append((address, ram[address]))
+
+        if not cpu.step(1):
+            # An event or interrupt landed us on a HLT. Count the event
+            # handling as the step so it can still be undone.
+            cpu.cycles += 1
+
+        for r in range(8):
+            if reg[r] != regs_before[r]:
+                writes.append((REGISTER_BASE + r, regs_before[r]))
+
+        record = bytearray(header)
+        for address, old in writes:
+            record += bytes((address & 0xFF, address >> 8, old))
+        record = bytes(record)
+
+        segment.undo.append(record)
+        size = len(record) + RECORD_OVERHEAD
+        segment.undo_bytes += size
+        self.memory_used += size
+        return 1
+
+    def events_at(self, cycle):
+        return [event for event in self.events if event[0] == cycle]
+
+    def current_segment(self):
+        segment = self.segments[-1]
+        cycles = self.cpu.cycles
+        if cycles - segment.start_cycle >= self.checkpoint_interval:
+            segment = Segment(cycles, self.cpu.snapshot())
+            self.segments.append(segment)
+            self.memory_used += SNAPSHOT_SIZE
+            self.trim()
+        return segment
+
+    def step(self, n = 1):
+        """Execute up to `n` instructions forwards, recording history."""
+
+        self.discard_future()
+        executed = 0
+        while executed < n and not self.cpu.halted:
+            if not self.step_forward(self.current_segment()):
+                break
+            executed += 1
+        return executed
+
+    def run(self, max_cycles = None, until_pc = None):
+        """Run forwards to HLT, `until_pc` or `max_cycles`, recording history."""
+
+        cpu = self.cpu
+        start = time.perf_counter()
+        executed = 0
+        reason = MAX_CYCLES
+        self.discard_future()
+        while max_cycles is None or executed < max_cycles:
+            if cpu.halted or not self.step_forward(self.current_segment()):
+                reason = HALTED
+                break
+            executed += 1
+            if cpu.pc == until_pc:
+                reason = UNTIL_PC
+                break
+        return RunResult(reason, executed, time.perf_counter() - start)
+
+    def discard_future(self):
+        """
+        Drop checkpoints and records ahead of the CPU, left over from
+        reversing. Re-executing from here is deterministic, so they would
+        only be rebuilt identically anyway.
+        """
+
+        cycles = self.cpu.cycles
+        while len(self.segments) > 1 and self.segments[-1].start_cycle > cycles:
+            segment = self.segments.pop()
+            self.memory_used -= SNAPSHOT_SIZE + segment.undo_bytes
+        segment = self.segments[-1]
+        if segment.undo is None:
+            # Only possible at the very start of a trimmed segment
+            segment.undo = []
+        keep = cycles - segment.start_cycle
+        for record in segment.undo[keep:]:
+            size = len(record) + RECORD_OVERHEAD
+            segment.undo_bytes -= size
+            self.memory_used -= size
+        del segment.undo[keep:]
+
+    # --- memory budget -------------------------------------------------
+
+    def trim(self):
+        """Drop undo records, then whole checkpoints, oldest first."""
+
+        for segment in self.segments[:-1]:
+            if self.memory_used <= self.memory_budget:
+                return
+            if segment.undo is not None:
+                self.memory_used -= segment.undo_bytes
+                segment.undo = None
+                segment.undo_bytes = 0
+
+        while self.memory_used > self.memory_budget and len(self.segments) > 2:
+            self.segments.pop(0)
+            self.memory_used -= SNAPSHOT_SIZE
+
+    # --- backwards -----------------------------------------------------
+
+    def rebuild(self, index):
+        """
+        Re-execute segment `index` from its checkpoint to regenerate its
+        undo records. Leaves the CPU at the end of the segment.
+        """
+
+        segment = self.segments[index]
+        end_cycle = self.cpu.cycles
+        self.cpu.restore(segment.checkpoint)
+        segment.undo = []
+        segment.undo_bytes = 0
+        while self.cpu.cycles < end_cycle:
+            if not self.step_forward(segment):
+                raise LS8Error("replay diverged while rebuilding history")
+
+    def undo_one(self, record):
+        """
+        Apply an undo record. Returns the RAM addresses whose value the
+        instruction had actually changed.
+        """
+
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.reg
+        cpu.pc = record[0]
+        cpu.fl = record[1]
+        cpu.interrupts_enabled = bool(record[2] & 1)
+        cpu.halted = bool(record[2] & 2)
+        changed = []
+        # Later entries first, so the oldest value for an address wins
+        for i in range(len(record) - 3, 2, -3):
+            address = record[i] | record[i + 1] << 8
+            old = record[i + 2]
+            if address >= REGISTER_BASE:
+                reg[address - REGISTER_BASE] = old
+            else:
+                if ram[address] != old:
+                    changed.append(address)
+                ram[address] = old
+        cpu.cycles -= 1
+        return changed
+
+    def reverse_step_one(self):
+        """
+        Undo the most recent instruction. Returns the RAM addresses it had
+        changed, or None at the beginning of history.
+        """
+
+        cpu = self.cpu
+        # Halting changes nothing but the flag
+        cpu.halted = False
+
+        for index in range(len(self.segments) - 1, -1, -1):
+            segment = self.segments[index]
+            if segment.start_cycle < cpu.cycles:
+                break
+        else:
+            return None
+
+        if segment.undo is None:
+            self.rebuild(index)
+            self.trim_except(index)
+
+        position = cpu.cycles - segment.start_cycle
+        return self.undo_one(segment.undo[position - 1])
+
+    def trim_except(self, keep):
+        """Keep within budget after a rebuild without dropping segment `keep`."""
+
+        for index, segment in enumerate(self.segments):
+            if self.memory_used <= self.memory_budget:
+                return
+            if index != keep and segment.undo is not None:
+                self.memory_used -= segment.undo_bytes
+                segment.undo = None
+                segment.undo_bytes = 0
+
+    def reverse_step(self, n = 1):
+        """Step back up to `n` instructions. Returns how many were undone."""
+
+        undone = 0
+        while undone < n and self.reverse_step_one() is not None:
+            undone += 1
+        return undone
+
+    def reverse_continue(self, breakpoints = (), watch = None):
+        """
+        Run backwards until the PC is at one of `breakpoints`, or until just
+        before an instruction that changed RAM in the inclusive range `watch`
+        (start, end). Returns (reason, instructions undone).
+        """
+
+        undone = 0
+        while True:
+            changed = self.reverse_step_one()
+            if changed is None:
+                return BEGINNING, undone
+            undone += 1
+            if self.cpu.pc in breakpoints:
+                return BREAKPOINT, undone
+            if watch is not None:
+                start, end = watch
+                for address in changed:
+                    if start <= address <= end:
+                        return WATCHPOINT, undone
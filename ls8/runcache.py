@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+"""On-disk cache of whole-program results.
+
+    python3 runcache.py stats CACHE_DIR
+    python3 runcache.py clear CACHE_DIR
+
+A run is fully determined by the machine state it starts from, the input
+it gets (key presses and interrupts at given cycles, as recorded by
+`replay.py`), the limits it runs under, whether the `isa.EXTENSIONS`
+instructions are enabled and the engine that runs it. The
+cache key is a SHA-256 over all of those, the engine being identified by a
+hash of the source of `cpu_fast.py` and `isa.py`, so editing the engine
+invalidates everything it produced.
+
+Each entry is a small JSON file holding the stop reason, instructions
+executed, printed output and final snapshot. Hits bump the file's mtime, and
+once the directory grows past `max_bytes` the least recently used entries
+are deleted. Several processes can share a directory: entries are written
+to a temporary file and renamed into place.
+
+Counts of hits, misses, instructions not executed and bytes served from
+the cache accumulate in `stats.json` in the directory, written by
+`close()`.
+
+    cache = ResultCache("~/.ls8-cache", max_bytes=64 << 20)
+    result = cache.run(image, max_cycles=1000000)
+    print(result.output, end="")
+    cache.close()
+"""
+
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import cpu_fast
+import isa
+from cpu_fast import FastCPU, MAX_CYCLES, TIMEOUT
+from replay import KEY
+
+# Default size limit for a cache directory
+MAX_BYTES = 64 << 20
+
+ENTRY_SUFFIX = ".json"
+STATS_FILE = "stats.json"
+
+STATS = ("hits", "misses", "instructions_saved", "bytes_served", "evictions")
+
+CachedResult = namedtuple("CachedResult", ["reason", "cycles", "output", "snapshot", "loop", "hit"])
+
+
+def engine_version():
+    """Hash of the source the results depend on."""
+
+    digest = hashlib.sha256()
+    for module in (cpu_fast, isa):
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+ENGINE_VERSION = engine_version()
+
+
+def run_key(snapshot, events = (), max_cycles = None, watchdog = False, extensions = False):
+    """Cache key for running from `snapshot` with `events` as input."""
+
+    digest = hashlib.sha256()
+    digest.update(ENGINE_VERSION.encode())
+    digest.update(snapshot)
+    for cycle, kind, value in events:
+        digest.update(b"%d %d %d;" % (cycle, kind, value))
+    digest.update(f"|{max_cycles}|{bool(watchdog)}|{bool(extensions)}".encode())
+    return digest.hexdigest()
+
+
+def execute(cpu, events = (), max_cycles = None, watchdog = False, timeout = None):
+    """
+    Run `cpu`, delivering each (cycle, kind, value) event when its cycle
+    comes round. Returns the RunResult of the last stretch, with `cycles`
+    covering the whole run. The watchdog only starts once every event has
+    been delivered, since a loop waiting for input isn't stuck.
+    """
+
+    start = cpu.cycles
+    end = start + max_cycles if max_cycles is not None else None
+    deadline = time.perf_counter() + timeout if timeout is not None else None
+
+    def left():
+        return max(deadline - time.perf_counter(), 0) if deadline is not None else None
+
+    result = None
+    pending = False
+    for cycle, kind, value in events:
+        if end is not None and cycle > end:
+            pending = True
+            break
+        if cycle > cpu.cycles:
+            result = cpu.run(max_cycles=cycle - cpu.cycles, timeout=left())
+            if result.reason != MAX_CYCLES:
+                return result._replace(cycles=cpu.cycles - start)
+        if kind == KEY:
+            cpu.post_key(value)
+        else:
+            cpu.post_interrupt(value)
+
+    remaining = end - cpu.cycles if end is not None else None
+    if remaining is None or remaining > 0:
+        result = cpu.run(max_cycles=remaining, timeout=left(),
+                         watchdog=watchdog and not pending)
+    elif result is None:
+        result = cpu_fast.RunResult(MAX_CYCLES, 0, 0.0)
+    return result._replace(cycles=cpu.cycles - start)
+
+
+def run_uncached(image, events = (), max_cycles = None, watchdog = False, cpu = None,
+                 timeout = None):
+    """Like `ResultCache.run`, but always running the program."""
+
+    if cpu is None:
+        cpu = FastCPU()
+        cpu.load_image(image)
+
+    out = cpu.out
+    cpu.out = io.StringIO()
+    try:
+        result = execute(cpu, events, max_cycles, watchdog, timeout)
+        output = cpu.out.getvalue()
+    finally:
+        cpu.out = out
+
+    return CachedResult(result.reason, result.cycles, output, cpu.snapshot(), result.loop, False)
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes = MAX_BYTES):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.stats = dict.fromkeys(STATS, 0)
+        # Bytes on disk, found by `scan` and kept up to date by `store`
+        self.size = sum(size for _, size, _ in self.scan())
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def scan(self):
+        """Entries on disk as (mtime, size, path)."""
+
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(ENTRY_SUFFIX) and entry.name != STATS_FILE:
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        # Evicted by another process
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def lookup(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.stats["misses"] += 1
+            return None
+
+        entry = json.loads(data)
+        self.stats["hits"] += 1
+        self.stats["instructions_saved"] += entry["cycles"]
+        self.stats["bytes_served"] += len(data)
+        loop = tuple(entry["loop"]) if entry["loop"] is not None else None
+        return CachedResult(entry["reason"], entry["cycles"], entry["output"],
+                            bytes.fromhex(entry["snapshot"]), loop, True)
+
+    def store(self, key, result):
+        data = json.dumps({
+            "reason": result.reason,
+            "cycles": result.cycles,
+            "output": result.output,
+            "snapshot": result.snapshot.hex(),
+            "loop": result.loop,
+        }).encode()
+
+        path = self.path(key)
+        # Unique per thread too: worker.py stores from several at once
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until under `max_bytes`."""
+
+        entries = sorted(self.scan())
+        self.size = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.stats["evictions"] += 1
+
+    def run(self, image, events = (), max_cycles = None, watchdog = False, cpu = None,
+            timeout = None):
+        """
+        Result of loading `image` into a fresh CPU (or `cpu`, as it is) and
+        running it with `events` as input, from the cache if possible. Runs
+        cut short by `timeout` depend on the machine's speed and aren't
+        stored.
+        """
+
+        if cpu is None:
+            cpu = FastCPU()
+            cpu.load_image(image)
+
+        extensions = cpu.dispatch is cpu_fast.extended_dispatch_table
+        key = run_key(cpu.snapshot(), events, max_cycles, watchdog, extensions)
+        cached = self.lookup(key)
+        if cached is not None:
+            cpu.restore(cached.snapshot)
+            return cached
+
+        result = run_uncached(image, events, max_cycles, watchdog, cpu, timeout)
+        if result.reason != TIMEOUT:
+            self.store(key, result)
+        return result
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def close(self):
+        """Add this process's counts to the totals in the directory."""
+
+        path = os.path.join(self.directory, STATS_FILE)
+        totals = read_stats(self.directory)
+        for name in STATS:
+            totals[name] = totals.get(name, 0) + self.stats[name]
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, "w") as f:
+            json.dump(totals, f)
+        os.replace(temp, path)
+        self.stats = dict.fromkeys(STATS, 0)
+
+
+def read_stats(directory):
+    try:
+        with open(os.path.join(directory, STATS_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return dict.fromkeys(STATS, 0)
+
+
+def format_stats(stats, size = None, max_bytes = None):
+    lookups = stats["hits"] + stats["misses"]
+    rate = stats["hits"] / lookups if lookups else 0.0
+    text = (f"cache: {stats['hits']} hits, {stats['misses']} misses ({rate:.1%} hit rate), "
+            f"{stats['instructions_saved']} instructions and {stats['bytes_served']} bytes "
+            f"served without running, {stats['evictions']} evicted")
+    if size is not None:
+        text += f", {size} of {max_bytes} bytes used"
+    return text
+
+
+def main(argv):
+    if len(argv) != 3 or argv[1] not in ("stats", "clear"):
+        print("usage: runcache.py stats|clear CACHE_DIR", file=sys.stderr)
+        return 1
+
+    directory = os.path.expanduser(argv[2])
+    if not os.path.isdir(directory):
+        print(f"{directory}: no such cache", file=sys.stderr)
+        return 1
+
+    cache = ResultCache(directory)
+    if argv[1] == "stats":
+        print(format_stats(read_stats(directory), cache.size, cache.max_bytes))
+    else:
+        for mtime, size, path in cache.scan():
+            os.remove(path)
+        stats_path = os.path.join(directory, STATS_FILE)
+        if os.path.exists(stats_path):
+            os.remove(stats_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,179 @@
+"""Cooperative scheduler for many LS-8 guests in one process.
+
+Each guest is a `FastCPU` that gets a quantum of instructions at a time,
+either round-robin or highest-priority-first. Guests spinning in a
+`JMP`-to-self loop are parked instead of burning quanta: a guest with the
+keyboard interrupt unmasked waits for `send_key`, anything else waits for
+`send_interrupt`.
+"""
+
+import heapq
+import io
+import time
+from collections import deque
+
+from cpu_fast import FastCPU, LS8Error, HALTED, IM, KEYBOARD_INTERRUPT
+from isa import JMP
+
+ROUND_ROBIN = "round_robin"
+PRIORITY = "priority"
+
+# Guest states
+RUNNABLE = "runnable"
+WAITING_FOR_KEY = "waiting for key"
+IDLE = "idle"
+DONE = "halted"
+FAULTED = "faulted"
+
+
+class Guest:
+    """One CPU plus its bookkeeping."""
+
+    __slots__ = ('cpu', 'name', 'priority', 'state', 'cycles', 'elapsed',
+                 'error', 'seq')
+
+    def __init__(self, cpu, name, priority):
+        self.cpu = cpu
+        self.name = name
+        self.priority = priority
+        self.state = RUNNABLE
+        self.cycles = 0
+        self.elapsed = 0.0
+        self.error = None
+        # Tie-breaker so equal priorities take turns
+        self.seq = 0
+
+    def __lt__(self, other):
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+    def __repr__(self):
+        return f"<Guest {self.name} {self.state} {self.cycles} cycles>"
+
+
+def is_idle_loop(cpu):
+    """True if the next instruction is a JMP back to itself."""
+
+    pc = cpu.pc & 0xFF
+    ram = cpu.ram
+    return ram[pc] == JMP and cpu.reg[ram[(pc + 1) & 0xFF] & 7] == pc
+
+
+class Scheduler:
+    """
+    Holds any number of guests and time-slices them cooperatively.
+
+        scheduler = Scheduler(quantum=1000)
+        guest = scheduler.add(cpu, "prog")
+        scheduler.run()
+        for name, state, cycles, share in scheduler.report(): ...
+    """
+
+    def __init__(self, quantum = 1000, policy = ROUND_ROBIN):
+        if policy not in (ROUND_ROBIN, PRIORITY):
+            raise ValueError(f"unknown scheduling policy {policy}")
+
+        self.quantum = quantum
+        self.policy = policy
+        self.guests = []
+        # Runnable guests: a deque for round-robin, a heap for priority
+        self.ready = deque() if policy == ROUND_ROBIN else []
+        self.seq = 0
+        self.switches = 0
+
+    def add(self, cpu = None, name = None, priority = 0, image = None):
+        """
+        Add a guest. Pass a prepared `FastCPU`, or an `image` of program
+        bytes to load into a fresh one. Output defaults to an in-memory buffer.
+        """
+
+        if cpu is None:
+            cpu = FastCPU()
+        if image is not None:
+            cpu.load_image(image)
+        if cpu.out is None:
+            cpu.out = io.StringIO()
+
+        guest = Guest(cpu, name if name is not None else f"guest{len(self.guests)}", priority)
+        self.guests.append(guest)
+        self.make_ready(guest)
+        return guest
+
+    def make_ready(self, guest):
+        guest.state = RUNNABLE
+        if self.policy == ROUND_ROBIN:
+            self.ready.append(guest)
+        else:
+            self.seq += 1
+            guest.seq = self.seq
+            heapq.heappush(self.ready, guest)
+
+    def next_guest(self):
+        if self.policy == ROUND_ROBIN:
+            return self.ready.popleft()
+        return heapq.heappop(self.ready)
+
+    def send_key(self, guest, key):
+        """Deliver a key press, waking the guest if it was parked."""
+
+        guest.cpu.post_key(key)
+        if guest.state in (WAITING_FOR_KEY, IDLE):
+            self.make_ready(guest)
+
+    def send_interrupt(self, guest, n):
+        """Raise interrupt `n` on a guest, waking it if it was parked."""
+
+        guest.cpu.post_interrupt(n)
+        if guest.state in (WAITING_FOR_KEY, IDLE):
+            self.make_ready(guest)
+
+    def run_quantum(self, guest):
+        """Give one guest one quantum and work out its next state."""
+
+        cpu = guest.cpu
+        start = time.perf_counter()
+        try:
+            executed, reason = cpu.execute(self.quantum)
+        except LS8Error as e:
+            executed = 0
+            reason = None
+            guest.state = FAULTED
+            guest.error = e
+        guest.elapsed += time.perf_counter() - start
+        guest.cycles += executed
+        self.switches += 1
+
+        if guest.state == FAULTED:
+            return
+        if reason == HALTED:
+            guest.state = DONE
+        elif is_idle_loop(cpu):
+            if cpu.interrupts_enabled and cpu.reg[IM] & (1 << KEYBOARD_INTERRUPT):
+                guest.state = WAITING_FOR_KEY
+            else:
+                guest.state = IDLE
+        else:
+            self.make_ready(guest)
+
+    def run(self, max_quanta = None):
+        """
+        Run until every guest is halted, faulted or parked, or until
+        `max_quanta` quanta have been handed out. Returns quanta used.
+        """
+
+        quanta = 0
+        while self.ready and (max_quanta is None or quanta < max_quanta):
+            self.run_quantum(self.next_guest())
+            quanta += 1
+        return quanta
+
+    def report(self):
+        """(name, state, cycles, share of all cycles) for every guest."""
+
+        total = sum(guest.cycles for guest in self.guests) or 1
+        return [(guest.name, guest.state, guest.cycles, guest.cycles / total)
+                for guest in self.guests]
+
+    def print_report(self):
+        print(f"{'guest':<12} {'state':<16} {'cycles':>10} {'share':>7}")
+        for name, state, cycles, share in self.report():
+            print(f"{name:<12} {state:<16} {cycles:>10} {share:>6.1%}")
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+"""Asyncio TCP service that runs LS-8 programs on a pool of processes.
+
+    python3 serve.py [--host HOST] [--port PORT] [--workers N] [--queue N]
+                     [--max-cycles N] [--timeout SECONDS]
+
+The protocol is newline-delimited JSON, as for `worker.py`. A request is
+
+    {"id": any, "image": "hex bytes"}   or   {"id": any, "asm": "source text"}
+
+plus optional "max_cycles", "timeout" (seconds), "watchdog" (bool) and
+"events" ([[cycle, kind, value], ...], as in `replay.py`). Source is
+assembled with `asm.py` in a worker process; `.include` is refused, since it
+would read files on the server. While a program runs, what it prints comes
+back in pieces as
+
+    {"id": ..., "output": "text"}
+
+and then exactly one of
+
+    {"id": ..., "reason": ..., "cycles": ..., "loop": ...}
+    {"id": ..., "error": "message"}
+
+A connection may send several requests without waiting; they run
+concurrently and their messages interleave, told apart by "id".
+
+Programs run in `--workers` child processes, each reusing one FastCPU.
+Every run is limited to the server's `--max-cycles` and `--timeout`; a
+request can ask for less but not more. A worker that hasn't finished a job,
+assembling included, `TIMEOUT_MARGIN` seconds after its timeout is killed
+and replaced. Once `--workers` + `--queue`
+requests are in flight the server stops reading from its connections until
+one finishes, so a client that sends faster than the pool can run is held
+back by TCP rather than queued without bound. A client that goes away
+mid-run has its worker process killed and replaced.
+
+`loadtest.py` drives a server on localhost and reports latency and
+throughput.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'asm'))
+
+import asm
+from cpu_fast import FastCPU, LS8Error, ProgramLoadError, parse_program
+import runcache
+
+HOST = "127.0.0.1"
+PORT = 8808
+
+# Requests waiting for a worker before connections stop being read
+QUEUE_LIMIT = 64
+
+# Upper limits on a single run
+MAX_CYCLES = 10_000_000
+TIMEOUT = 10.0
+
+# Seconds past a job's timeout before its worker is given up on, to cover
+# assembling it and sending back the result
+TIMEOUT_MARGIN = 1.0
+
+# Output is sent on once this much has built up, and at least this often
+# while a program runs
+CHUNK_SIZE = 4096
+FLUSH_INTERVAL = 0.05
+
+
+def assemble_source(source, name = "<request>"):
+    """
+    Assemble `source` with asm.py into an image. `.include` is refused, so
+    nothing on the server can be read. Errors raise ProgramLoadError.
+    """
+
+    errors = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(errors):
+            text, sym = asm.assemble(io.StringIO(source), filename=name, allow_include=False)
+    except SystemExit:
+        # asm.py reports errors and exits
+        raise ProgramLoadError(errors.getvalue().strip() or f"{name}: assembly failed") from None
+    return parse_program(text.splitlines(), name)
+
+
+class PipeOutput:
+    """
+    `cpu.out` for a worker process: sends what is printed up the pipe in
+    pieces. A background thread flushes every `FLUSH_INTERVAL`, so output
+    printed just before a long stretch of computing isn't held back until
+    the program stops.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pieces = []
+        self.size = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.flush_periodically, daemon=True).start()
+
+    def write(self, text):
+        with self.lock:
+            self.pieces.append(text)
+            self.size += len(text)
+            if self.size >= CHUNK_SIZE:
+                self.send()
+
+    def flush(self):
+        with self.lock:
+            self.send()
+
+    def send(self):
+        # Called with the lock held
+        if self.pieces:
+            self.conn.send(("output", "".join(self.pieces)))
+            self.pieces = []
+            self.size = 0
+
+    def flush_periodically(self):
+        # Only finds anything to send while a program is running: the
+        # worker flushes before each "done" or "error"
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+
+def exit_with_parent(parent):
+    # A worker busy with a job isn't reading `conn`, so wouldn't notice the
+    # server going away
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(1)
+
+
+def work(conn):
+    """Worker process: run jobs from `conn` until it is closed."""
+
+    threading.Thread(target=exit_with_parent, args=(os.getppid(),), daemon=True).start()
+    cpu = FastCPU()
+    out = cpu.out = PipeOutput(conn)
+    conn.send(("ready",))
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        cpu.reset()
+        try:
+            if "asm" in job:
+                image = assemble_source(job["asm"])
+            else:
+                image = job["image"]
+            cpu.load_image(image)
+            result = runcache.execute(cpu, job["events"], job["max_cycles"],
+                                      job["watchdog"], job["timeout"])
+        except LS8Error as e:
+            out.flush()
+            conn.send(("error", str(e)))
+        else:
+            out.flush()
+            conn.send(("done", result.reason, result.cycles, result.loop))
+
+
+class Fleet:
+    """A fixed number of worker processes, handed out one job at a time."""
+
+    def __init__(self, size):
+        self.size = size
+        self.context = multiprocessing.get_context("spawn")
+        self.idle = asyncio.Queue()
+        self.processes = set()
+        # Replacements still starting up
+        self.starting = set()
+
+    async def start(self):
+        await asyncio.gather(*(self.add() for _ in range(self.size)))
+
+    async def add(self):
+        """Start a process and put it in the idle queue once it is ready for jobs."""
+
+        process = self.spawn()
+        if (await self.receive(process))[0] == "ready":
+            self.idle.put_nowait(process)
+
+    def spawn(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=work, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        process.conn = conn
+        self.processes.add(process)
+        return process
+
+    def replace(self, process):
+        process.kill()
+        process.join()
+        process.conn.close()
+        self.processes.discard(process)
+        task = asyncio.get_running_loop().create_task(self.add())
+        self.starting.add(task)
+        task.add_done_callback(self.starting.discard)
+
+    async def receive(self, process):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = process.conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+        try:
+            return process.conn.recv()
+        except (EOFError, OSError):
+            return ("error", "worker process died")
+
+    async def run(self, job):
+        """Run `job` on the next free process, yielding its messages."""
+
+        process = await self.idle.get()
+        finished = False
+        loop = asyncio.get_running_loop()
+        limit = job["timeout"] + TIMEOUT_MARGIN
+        deadline = loop.time() + limit
+        try:
+            process.conn.send(job)
+            while True:
+                try:
+                    message = await asyncio.wait_for(self.receive(process),
+                                                     deadline - loop.time())
+                except asyncio.TimeoutError:
+                    # Replaced below, like an abandoned one
+                    yield ("error", f"no result after {limit:g} seconds")
+                    return
+                if message[0] != "output" and process.is_alive():
+                    finished = True
+                yield message
+                if message[0] != "output":
+                    return
+        finally:
+            if finished:
+                self.idle.put_nowait(process)
+            else:
+                # Abandoned mid-run, or dead: start a clean one
+                self.replace(process)
+
+    def close(self):
+        for process in self.processes:
+            process.kill()
+            process.join()
+
+
+def make_job(request, max_cycles, timeout):
+    """Check a request and turn it into a job for `work`. Raises ValueError."""
+
+    job = {}
+    if "image" in request:
+        job["image"] = bytes.fromhex(request["image"])
+    elif "asm" in request:
+        if not isinstance(request["asm"], str):
+            raise ValueError("asm must be a string")
+        job["asm"] = request["asm"]
+    else:
+        raise ValueError("request has neither an image nor asm")
+
+    job["max_cycles"] = min(int(request.get("max_cycles", max_cycles)), max_cycles)
+    job["timeout"] = min(float(request.get("timeout", timeout)), timeout)
+    job["watchdog"] = bool(request.get("watchdog", False))
+    job["events"] = [(int(cycle), int(kind), int(value))
+                     for cycle, kind, value in request.get("events", ())]
+    return job
+
+
+class Service:
+    def __init__(self, workers, queue_limit = QUEUE_LIMIT, max_cycles = MAX_CYCLES,
+                 timeout = TIMEOUT):
+        self.fleet = Fleet(workers)
+        self.admission = asyncio.Semaphore(workers + queue_limit)
+        self.max_cycles = max_cycles
+        self.timeout = timeout
+        self.served = 0
+
+    async def handle_connection(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def send(message):
+            async with lock:
+                writer.write(json.dumps(message).encode() + b"\n")
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                # Don't read any further while the fleet is saturated
+                await self.admission.acquire()
+                task = asyncio.create_task(self.handle_request(line, send))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Shutting down with the client still connected
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def handle_request(self, line, send):
+        request_id = None
+        try:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("not an object")
+                request_id = request.get("id")
+                job = make_job(request, self.max_cycles, self.timeout)
+            except (TypeError, ValueError) as e:
+                await send({"id": request_id, "error": f"bad request: {e}"})
+                return
+
+            messages = self.fleet.run(job)
+            try:
+                async for message in messages:
+                    if message[0] == "output":
+                        await send({"id": request_id, "output": message[1]})
+                    elif message[0] == "error":
+                        await send({"id": request_id, "error": message[1]})
+                    else:
+                        reason, cycles, loop = message[1:]
+                        await send({"id": request_id, "reason": reason, "cycles": cycles,
+                                    "loop": loop})
+            finally:
+                await messages.aclose()
+            self.served += 1
+        except ConnectionError:
+            pass
+        finally:
+            self.admission.release()
+
+
+async def serve(args):
+    service = Service(args.workers, args.queue, args.max_cycles, args.timeout)
+    await service.fleet.start()
+    server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+    host, port = server.sockets[0].getsockname()[:2]
+    # loadtest.py reads this line to find a server started on port 0
+    print(f"listening on {host}:{port}", flush=True)
+    # Stop cleanly on `kill` too, so the workers go with us
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    try:
+        async with server:
+            await stopping.wait()
+    finally:
+        service.fleet.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run LS-8 programs for TCP clients")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT, help="0 picks a free port")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                        help="worker processes")
+    parser.add_argument("--queue", type=int, default=QUEUE_LIMIT,
+                        help="requests waiting for a worker before reading stops")
+    parser.add_argument("--max-cycles", type=int, default=MAX_CYCLES,
+                        help="most instructions one run may execute")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT,
+                        help="most wall-clock seconds one run may take")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"serve: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
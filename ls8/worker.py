@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""Long-lived worker that runs LS-8 programs sent to it.
+
+    python3 worker.py [--socket PATH] [--idle-timeout SECONDS] [--timeout SECONDS]
+                      [--max-cycles N] [--cache DIR] [--pool N]
+    python3 worker.py --stdio
+
+Starting Python and importing the emulator takes far longer than most
+programs take to run. The worker pays for that once: it keeps `cpu_fast`
+imported with its dispatch table built, and a pool of FastCPUs that are
+`reset()` between programs rather than constructed again. Parsed `.ls8`
+files are kept too, keyed on their path and mtime.
+
+It listens on a Unix socket (see `ls8c.socket_path()`), or with `--stdio`
+serves a single client on stdin/stdout. The protocol is newline-delimited
+JSON, described in `ls8c.py`. Requests on one connection are answered in
+order, each as soon as its program stops, so a client can keep several
+requests in flight (reading responses as it goes, or both sides end up
+blocked on full socket buffers); connections are served in parallel threads.
+
+Every run is bounded: by the request's own "max_cycles" and "timeout", or
+the worker's `--max-cycles` and `--timeout` if it doesn't give them, so one
+program that never halts can't hold a connection forever. With `--cache`,
+results go through `runcache.ResultCache` as well.
+"""
+
+import argparse
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from cpu_fast import FastCPU, LS8Error, ProgramLoadError, parse_program
+import ls8c
+import runcache
+
+# Wall-clock limit for a run when the request doesn't set one
+DEFAULT_TIMEOUT = 10.0
+
+# Idle CPUs kept for reuse
+POOL_SIZE = 8
+
+# Parsed programs kept, by path
+IMAGE_CACHE_SIZE = 256
+
+
+class CPUPool:
+    """FastCPUs to reuse, reset to their power-on state."""
+
+    def __init__(self, size = POOL_SIZE):
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        cpu = FastCPU()
+        cpu.out = io.StringIO()
+        return cpu
+
+    def release(self, cpu):
+        cpu.reset()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(cpu)
+
+
+class ImageCache:
+    """Parsed `.ls8` files, re-read when their mtime or size changes."""
+
+    def __init__(self, size = IMAGE_CACHE_SIZE):
+        self.size = size
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size)
+            cached = self.images.get(path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            with open(path) as f:
+                image = bytes(parse_program(f, path))
+        except OSError as e:
+            raise ProgramLoadError(f"{path}: {e.strerror}") from e
+
+        with self.lock:
+            if len(self.images) >= self.size:
+                # Dicts keep insertion order, so this drops the oldest
+                del self.images[next(iter(self.images))]
+            self.images[path] = (stamp, image)
+        return image
+
+
+class Worker:
+    def __init__(self, max_cycles = None, timeout = DEFAULT_TIMEOUT, cache = None,
+                 pool_size = POOL_SIZE):
+        self.max_cycles = max_cycles
+        self.timeout = timeout
+        self.cache = cache
+        self.pool = CPUPool(pool_size)
+        self.images = ImageCache()
+        self.served = 0
+
+    def image(self, request):
+        if "program" in request:
+            return self.images.load(request["program"])
+        if "image" in request:
+            try:
+                return bytes.fromhex(request["image"])
+            except (TypeError, ValueError):
+                raise ProgramLoadError("image is not a hex string") from None
+        raise ProgramLoadError("request has neither a program nor an image")
+
+    def run(self, request):
+        """The response to one request, as a dict."""
+
+        response = {"id": request.get("id")}
+        cpu = self.pool.acquire()
+        try:
+            image = self.image(request)
+            cpu.load_image(image)
+            events = [tuple(event) for event in request.get("events", ())]
+            # An explicit null means "the worker's limit", not "no limit"
+            max_cycles = request.get("max_cycles")
+            if max_cycles is None:
+                max_cycles = self.max_cycles
+            timeout = request.get("timeout")
+            if timeout is None:
+                timeout = self.timeout
+            watchdog = bool(request.get("watchdog", False))
+            if self.cache is not None:
+                result = self.cache.run(image, events, max_cycles, watchdog, cpu, timeout)
+            else:
+                result = runcache.run_uncached(image, events, max_cycles, watchdog, cpu, timeout)
+        except LS8Error as e:
+            response["error"] = str(e)
+        except (TypeError, ValueError) as e:
+            response["error"] = f"bad request: {e}"
+        else:
+            response.update(reason=result.reason, cycles=result.cycles,
+                            output=result.output, loop=result.loop)
+        finally:
+            self.pool.release(cpu)
+        self.served += 1
+        return response
+
+    def serve(self, rfile, wfile):
+        """Answer requests from `rfile` on `wfile` until EOF, one line each."""
+
+        for line in rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("not an object")
+            except ValueError as e:
+                response = {"id": None, "error": f"bad request: {e}"}
+            else:
+                response = self.run(request)
+            wfile.write(json.dumps(response).encode() + b"\n")
+            wfile.flush()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        server.connected(1)
+        try:
+            server.worker.serve(self.rfile, self.wfile)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            server.connected(-1)
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, worker, idle_timeout = None):
+        self.worker = worker
+        self.idle_timeout = idle_timeout
+        self.connections = 0
+        self.last_active = time.monotonic()
+        self.count_lock = threading.Lock()
+        self.stopping = False
+        super().__init__(path, Handler)
+
+    def connected(self, delta):
+        with self.count_lock:
+            self.connections += delta
+            self.last_active = time.monotonic()
+
+    def service_actions(self):
+        # Called by serve_forever() about twice a second
+        if self.idle_timeout is None:
+            return
+        with self.count_lock:
+            idle = not self.connections and time.monotonic() - self.last_active > self.idle_timeout
+        if idle and not self.stopping:
+            # shutdown() waits for serve_forever() to return, so it can't be
+            # called from the serving thread
+            self.stopping = True
+            threading.Thread(target=self.shutdown).start()
+
+
+def claim_socket(path):
+    """
+    Remove a socket file left behind by a worker that is no longer running.
+    Raises OSError if another worker is listening on `path`.
+    """
+
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+    else:
+        raise OSError(f"a worker is already listening on {path}")
+    finally:
+        probe.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serve LS-8 runs over a Unix socket or stdio")
+    parser.add_argument("--socket", default=None, help="socket path (default: ls8c.socket_path())")
+    parser.add_argument("--stdio", action="store_true", help="serve one client on stdin/stdout")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="exit after this many seconds without a connection")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="wall-clock seconds per run unless the request says otherwise")
+    parser.add_argument("--max-cycles", type=int, default=None,
+                        help="instructions per run unless the request says otherwise")
+    parser.add_argument("--cache", help="result cache directory")
+    parser.add_argument("--pool", type=int, default=POOL_SIZE, help="idle CPUs kept for reuse")
+    args = parser.parse_args(argv[1:])
+
+    cache = runcache.ResultCache(args.cache) if args.cache else None
+    worker = Worker(args.max_cycles, args.timeout, cache, args.pool)
+    try:
+        if args.stdio:
+            worker.serve(sys.stdin.buffer, sys.stdout.buffer)
+            return 0
+
+        path = args.socket or ls8c.socket_path()
+        try:
+            claim_socket(path)
+            server = Server(path, worker, args.idle_timeout)
+        except OSError as e:
+            print(f"worker: {e}", file=sys.stderr)
+            return 1
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    finally:
+        if cache is not None:
+            cache.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))